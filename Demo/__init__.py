@@ -1 +1,6 @@
-# Demo项目初始化文件 
\ No newline at end of file
+# Demo项目初始化文件
+
+# 确保Django启动时加载Celery应用，使@shared_task绑定到该应用
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
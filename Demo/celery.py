@@ -0,0 +1,17 @@
+"""
+Celery应用配置，worker启动方式:
+    celery -A Demo worker -l info
+"""
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Demo.settings')
+
+app = Celery('Demo')
+
+# 读取settings中以CELERY_开头的配置
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# 自动发现各应用下的tasks.py
+app.autodiscover_tasks()
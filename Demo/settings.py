@@ -143,6 +143,91 @@ MEDIA_ROOT = BASE_DIR / ''
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# MedCoss推理服务设置（服务端: MedCoss_inference/model_server.py）
+MEDCOSS_PATH = BASE_DIR / 'MedCoss_inference'
+MEDCOSS_CHECKPOINT = None  # 为空时在 MEDCOSS_PATH/pth 或 MEDCOSS_PATH/weights 中查找
+MEDCOSS_INPUT_SIZE = (64, 192, 192)
+MEDCOSS_NUM_CLASSES = 8
+MEDCOSS_FIT_STRATEGY = 'resize'  # 体数据调整到输入尺寸的方式: resize / center_crop / bbox_crop / none
+# 大体积病例按原始分辨率滑窗分类，例如 {'overlap': 0.25, 'max_tiles': 16, 'aggregation': 'max', 'tile_batch_size': 4}
+MEDCOSS_TILING = None
+# 丢弃背景patch的token剪枝推理，例如 {'min_fraction': 0.01, 'drop_after': [4, 8], 'keep_ratio': 0.7}
+MEDCOSS_TOKEN_PRUNING = None
+MEDCOSS_PRECISION = 'fp32'  # 推理精度: fp32 / bf16 / fp16（fp16需要GPU）
+MEDCOSS_PRECISION_MODE = 'autocast'  # autocast: 自动混合精度; cast: 权重整体转换
+MEDCOSS_SERVER_ADDRESS = ('127.0.0.1', 6100)
+MEDCOSS_SERVER_AUTHKEY = 'padiagnosis-medcoss'
+MEDCOSS_SERVER_TIMEOUT = 300  # 秒
+
+# 远程模型服务器（SSH连接池按 hostname/port/username 共用）
+REMOTE_SERVERS = {
+    # HUST-19 肺炎诊断
+    'hust19': {
+        'hostname': '202.197.33.114',
+        'port': 223,
+        'username': 'xuchang',
+        'password': '1',
+        'pool_size': 2,
+        'max_channels_per_session': 4,
+        'keepalive_interval': 30,
+        'project_path': '/data8t/xuchang/PycharmProjects/HUST-19',
+        'python_env': 'source /data8t/xuchang/anaconda3/etc/profile.d/conda.sh && conda activate hust19',
+        # 常驻worker（diagnosis/remote_worker.py 协议），三者都不配置时每次执行 python run.py
+        'daemon_command': None,  # 例如 'python remote_worker.py --stdio'
+        'daemon_port': None,  # 通过SSH转发到本地的worker端口
+        'local_worker': False,  # 使用本地替身worker（离线测试）
+    },
+    # LanGuideMedSeg X光分割
+    'lgms': {
+        'hostname': '202.197.33.114',
+        'port': 223,
+        'username': 'xuchang',
+        'password': '1',
+        'pool_size': 2,
+        'max_channels_per_session': 4,
+        'keepalive_interval': 30,
+        'project_path': '/data8t/xuchang/PycharmProjects/LanGuideMedSeg-MICCAI2023',
+        'python_env': 'source /data8t/xuchang/anaconda3/etc/profile.d/conda.sh && conda activate lgms',
+        # 常驻worker（diagnosis/remote_worker.py 协议），三者都不配置时每次执行 python run.py
+        'daemon_command': None,  # 例如 'python remote_worker.py --stdio'
+        'daemon_port': None,  # 通过SSH转发到本地的worker端口
+        'local_worker': False,  # 使用本地替身worker（离线测试）
+    },
+}
+
+# 分割结果文件等待（远程命令退出后对结果文件做有界stat轮询）
+SEGMENTATION_RESULT_TIMEOUT = 30  # 秒
+SEGMENTATION_RESULT_POLL_INTERVAL = 0.5  # 秒
+
+# Celery任务队列设置（Redis作为broker）
+CELERY_BROKER_URL = 'redis://127.0.0.1:6379/0'
+CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/1'
+CELERY_TIMEZONE = TIME_ZONE
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1  # 诊断任务耗时长，每个worker进程一次只取一个
+
+# 诊断任务设置
+DIAGNOSIS_JOB_STALE_SECONDS = 600  # 超过该时间仍未结束的任务视为失效，允许重新提交
+
+# 影像切片缓存设置（patient_records/volume_cache.py）
+VOLUME_CACHE_DIR = BASE_DIR / 'data' / 'volume_cache'  # 解码后的 .npy 缓存目录
+VOLUME_PYRAMID_LEVELS = (4, 2, 1)  # 降采样倍数，需互为整数倍
+VOLUME_CHUNK_DEPTH = 32  # 每个缓存块包含的轴位层数
+VOLUME_CACHE_OPEN_LIMIT = 8  # 每个进程保留的内存映射数量
+VOLUME_CACHE_MAX_AGE_DAYS = 30  # 超过该天数未打开的金字塔在清理时删除
+VOLUME_CACHE_MAX_BYTES = 20 * 1024 ** 3  # 缓存目录总大小上限
+VOLUME_PREFETCH_MAX_SLICES = 32  # 单次预取的最大切片数
+
+# 影像分块上传设置（diagnosis/uploads.py）
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024  # 每个数据块的大小
+UPLOAD_MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024  # 单个文件上限
+UPLOAD_PARTIAL_DIR = BASE_DIR / 'data' / 'upload' / '.partial'  # 未完成上传的临时文件
+
+# MedCoss推理结果缓存（diagnosis/inference_cache.py）
+INFERENCE_CACHE_ENABLED = True
+INFERENCE_CACHE_MAX_AGE_DAYS = 180  # 超过该天数未使用的结果在清理时删除
+INFERENCE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 缓存结果总大小上限
+
 # 登录相关设置
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/home/'
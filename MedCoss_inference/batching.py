@@ -0,0 +1,122 @@
+"""
+动态微批调度：在模型前面收集并发请求，
+等待最多 max_wait_ms 毫秒或凑满 max_batch_size 个病例后，
+把 shape 相同的体数据堆叠成一个 batch 做一次前向，再把每行结果分发回调用方。
+"""
+import time
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class _Request:
+    __slots__ = ("x", "dataset", "future", "submitted_at")
+
+    def __init__(self, x, dataset):
+        self.x = x
+        self.dataset = dataset
+        self.future = Future()
+        self.submitted_at = time.time()
+
+
+class BatchScheduler:
+    """
+    run_batch(x, dataset) 接收 [B,1,D,H,W] float32 数组，返回 [B,num_classes] 概率。
+    所有前向都在调度线程中串行执行。
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait_ms=20, latency_window=1000):
+        assert max_batch_size >= 1
+        self.run_batch = run_batch
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._latencies = deque(maxlen=latency_window)
+        self._completed = 0
+        self._failed = 0
+        self._thread = threading.Thread(target=self._worker, name="medcoss-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, x, dataset="custom"):
+        """x: [1,1,D,H,W] 或 [1,D,H,W]，返回 Future，结果为该病例的一行概率"""
+        if x.ndim == 5:
+            assert x.shape[0] == 1, "每个请求只能包含一个病例"
+            x = x[0]
+        request = _Request(x, dataset)
+        self._queue.put(request)
+        return request.future
+
+    def infer(self, x, dataset="custom", timeout=None):
+        return self.submit(x, dataset).result(timeout=timeout)
+
+    def _collect(self):
+        first = self._queue.get()
+        pending = [first]
+        deadline = time.time() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _worker(self):
+        while True:
+            pending = self._collect()
+
+            # 按 (shape, dataset) 分组，只有同形状的体数据才能堆叠
+            groups = {}
+            for request in pending:
+                groups.setdefault((request.x.shape, request.dataset), []).append(request)
+
+            for (_, dataset), group in groups.items():
+                self._run_group(group, dataset)
+
+    def _run_group(self, group, dataset):
+        try:
+            x = np.stack([request.x for request in group], axis=0)
+            probs = self.run_batch(x, dataset)
+        except Exception as e:
+            for request in group:
+                request.future.set_exception(e)
+            with self._stats_lock:
+                self._failed += len(group)
+            return
+
+        now = time.time()
+        with self._stats_lock:
+            self._batch_sizes[len(group)] += 1
+            for row, request in zip(probs, group):
+                self._latencies.append(now - request.submitted_at)
+            self._completed += len(group)
+        for row, request in zip(probs, group):
+            request.future.set_result(row)
+
+    def stats(self):
+        with self._stats_lock:
+            latencies = np.asarray(self._latencies, dtype=np.float64)
+            info = {
+                "queue_depth": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": round(self.max_wait * 1000, 1),
+                "completed": self._completed,
+                "failed": self._failed,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+            }
+        if latencies.size:
+            info["latency_ms"] = {
+                "p50": round(float(np.percentile(latencies, 50)) * 1000, 1),
+                "p95": round(float(np.percentile(latencies, 95)) * 1000, 1),
+                "max": round(float(latencies.max()) * 1000, 1),
+            }
+        else:
+            info["latency_ms"] = None
+        return info
@@ -0,0 +1,155 @@
+"""
+自注意力实现（torch / sdpa / chunked）按序列长度的峰值内存与延迟对比。
+
+用与 Encoder 相同配置的单个 TransformerEncoderLayer（d_model=768, 12 头）做前向，
+给出 --checkpoint_path 时加载 fused_encoder.layers.<layer>.* 的权重（验证各实现可直接使用原权重）。
+峰值内存: CUDA 上为 max_memory_allocated 相对前向前的增量；
+CPU 上为后台线程采样 /proc/self/statm 得到的常驻内存峰值增量（仅 Linux，约 1ms 精度）。
+
+示例:
+    python benchmark_attention.py --seq_lens 577,1153,2305,4097 --backends torch,sdpa,chunked
+"""
+import os
+import json
+import time
+import argparse
+import threading
+
+import torch
+
+from model.Base_module import ATTN_BACKENDS, TransformerEncoderLayer, set_attention_backend
+
+
+class RssSampler:
+    """后台采样当前进程的常驻内存，记录峰值"""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def rss(self):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * self.page_size
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.rss()
+        self.peak = self.baseline
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+    @property
+    def delta(self):
+        return self.peak - self.baseline
+
+
+def build_layer(checkpoint_path, layer_index, device):
+    layer = TransformerEncoderLayer(
+        d_model=768, nhead=12, dim_feedforward=3072, dropout=0., drop_path_ratio=0.1,
+        activation="gelu", layer_scale=True, ls_init_values=1e-3, batch_first=True, norm_first=True,
+    )
+    if checkpoint_path:
+        ckpt = torch.load(checkpoint_path, map_location="cpu")
+        state = ckpt["model"] if isinstance(ckpt, dict) and "model" in ckpt else ckpt
+        prefix = f"fused_encoder.layers.{layer_index}."
+        layer_state = {k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)}
+        print(f"[info] load_state_dict msg: {layer.load_state_dict(layer_state, strict=True)}")
+    return layer.to(device).eval()
+
+
+def measure(layer, x, device, warmup, repeats):
+    """返回 (输出, 平均耗时秒, 峰值内存增量字节)"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            layer(x)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            baseline = torch.cuda.memory_allocated()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                out = layer(x)
+            torch.cuda.synchronize()
+            seconds = (time.perf_counter() - start) / repeats
+            peak = torch.cuda.max_memory_allocated() - baseline
+        else:
+            with RssSampler() as sampler:
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    out = layer(x)
+                seconds = (time.perf_counter() - start) / repeats
+            peak = sampler.delta
+    return out, seconds, peak
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="自注意力实现的峰值内存与延迟")
+    p.add_argument("--seq_lens", type=str, default="577,1153,2305,4097", help="序列长度（含 cls token）")
+    p.add_argument("--backends", type=str, default=",".join(ATTN_BACKENDS))
+    p.add_argument("--batch_size", type=int, default=1)
+    p.add_argument("--chunk_size", type=int, default=None, help="chunked 每块的 query 数")
+    p.add_argument("--checkpoint_path", type=str, default=None)
+    p.add_argument("--layer", type=int, default=0)
+    p.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    p.add_argument("--warmup", type=int, default=1)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    layer = build_layer(args.checkpoint_path, args.layer, device)
+    backends = args.backends.split(",")
+
+    results = []
+    for seq_len in map(int, args.seq_lens.split(",")):
+        x = torch.randn(args.batch_size, seq_len, 768, device=device)
+        reference = None
+        for backend in backends:
+            set_attention_backend(layer, backend, args.chunk_size)
+            try:
+                out, seconds, peak = measure(layer, x, device, args.warmup, args.repeats)
+            except RuntimeError as e:
+                # 原实现在长序列上可能直接 OOM
+                print(f"[warn] seq_len={seq_len} {backend}: {e}")
+                results.append({"seq_len": seq_len, "backend": backend, "error": str(e)})
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()
+                continue
+            if reference is None:
+                reference = out
+            row = {
+                "seq_len": seq_len,
+                "backend": layer.attn_backend,
+                "seconds": round(seconds, 4),
+                "peak_bytes": int(peak),
+                "max_abs_diff": float((out - reference).abs().max()),
+            }
+            results.append(row)
+            print(f"[info] {row}")
+            del out
+
+    report = {"device": str(device), "batch_size": args.batch_size, "torch": torch.__version__, "results": results}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+CPU 推理延迟基准与精度漂移检查。
+
+同一份权重分别构建 fp32 模型和 optimize_for_cpu 之后的模型，在相同输入上:
+- 统计每次前向的延迟（预热后重复 --repeats 次，取均值 / P50 / P90）；
+- 比较两者输出概率: 最大/平均绝对误差、top-1 一致率、0.5 阈值下多标签结果一致率。
+最大绝对误差超过 --max_drift 时以非零状态码退出，便于在部署前检查。
+
+示例:
+    python benchmark_cpu.py --checkpoint_path pth/checkpoint.pth --nifti_path a.nii.gz b.nii.gz \\
+        --cpu_optimize --num_threads 8 --export torchscript
+未指定 --nifti_path 时使用 --input_size 大小的随机输入（只适合测延迟，精度漂移以真实病例为准）。
+"""
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from inference_single_case import build_model, preprocess_single_nifti, predict_probs
+from cpu_inference import add_cpu_args, cpu_options_from_args, optimize_for_cpu
+from preprocessing import FIT_STRATEGIES
+
+
+def time_forward(model, x, dataset, warmup, repeats):
+    """返回 (最后一次输出概率, 每次前向耗时列表)"""
+    for _ in range(warmup):
+        predict_probs(model, torch.device("cpu"), x, dataset)
+    latencies = []
+    probs = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        probs = predict_probs(model, torch.device("cpu"), x, dataset)
+        latencies.append(time.perf_counter() - start)
+    return probs, latencies
+
+
+def summarize(latencies):
+    values = np.asarray(latencies)
+    return {
+        "mean_seconds": round(float(values.mean()), 4),
+        "p50_seconds": round(float(np.percentile(values, 50)), 4),
+        "p90_seconds": round(float(np.percentile(values, 90)), 4),
+    }
+
+
+def drift(reference, candidate, dataset):
+    reference = np.concatenate(reference, axis=0)
+    candidate = np.concatenate(candidate, axis=0)
+    diff = np.abs(reference - candidate)
+    report = {
+        "cases": int(reference.shape[0]),
+        "max_abs_diff": float(diff.max()),
+        "mean_abs_diff": float(diff.mean()),
+        "top1_agreement": float((reference.argmax(axis=1) == candidate.argmax(axis=1)).mean()),
+    }
+    if dataset == "custom":
+        report["label_agreement"] = float(((reference > 0.5) == (candidate > 0.5)).mean())
+    return report
+
+
+def load_inputs(args, input_size):
+    if args.nifti_path:
+        return [preprocess_single_nifti(path, args.dataset, input_size=input_size, fit_strategy=args.fit_strategy)
+                for path in args.nifti_path]
+    rng = np.random.RandomState(args.seed)
+    shape = (args.batch_size, 1) + tuple(input_size)
+    return [rng.standard_normal(shape).astype(np.float32) for _ in range(args.random_cases)]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="MedCoss CPU 推理基准与精度漂移检查")
+    p.add_argument("--checkpoint_path", type=str, required=True)
+    p.add_argument("--nifti_path", type=str, nargs="*", default=None)
+    p.add_argument("--dataset", type=str, default="custom", choices=["custom", "ricord"])
+    p.add_argument("--input_size", type=str, default="64,192,192")
+    p.add_argument("--num_classes", type=int, default=None)
+    p.add_argument("--fit_strategy", type=str, default="resize", choices=FIT_STRATEGIES)
+    p.add_argument("--batch_size", type=int, default=1, help="随机输入的 batch 大小")
+    p.add_argument("--random_cases", type=int, default=2)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--warmup", type=int, default=1)
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--max_drift", type=float, default=0.02, help="允许的最大概率绝对误差")
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    add_cpu_args(p)
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    input_size = tuple(map(int, args.input_size.split(",")))
+    # 基准默认就是 CPU 优化路径，不必再单独加 --cpu_optimize
+    args.cpu_optimize = True
+    options = cpu_options_from_args(args)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    reference_model, _, num_classes = build_model(
+        args.checkpoint_path, input_size, num_classes=args.num_classes, device=torch.device("cpu")
+    )
+    optimized_model = optimize_for_cpu(reference_model, **options)
+    inputs = load_inputs(args, input_size)
+
+    reference_probs, candidate_probs = [], []
+    reference_latency, candidate_latency = [], []
+    for i, x in enumerate(inputs):
+        probs, latencies = time_forward(reference_model, x, args.dataset, args.warmup, args.repeats)
+        reference_probs.append(probs)
+        reference_latency += latencies
+
+        probs, latencies = time_forward(optimized_model, x, args.dataset, args.warmup, args.repeats)
+        candidate_probs.append(probs)
+        candidate_latency += latencies
+        print(f"[info] 输入 {i}: shape={x.shape}, fp32 {np.mean(reference_latency[-args.repeats:]):.3f}s, "
+              f"优化后 {np.mean(candidate_latency[-args.repeats:]):.3f}s")
+
+    fp32 = summarize(reference_latency)
+    optimized = summarize(candidate_latency)
+    report = {
+        "num_classes": num_classes,
+        "num_threads": torch.get_num_threads(),
+        "cpu_options": options,
+        "fp32": fp32,
+        "optimized": optimized,
+        "speedup": round(fp32["mean_seconds"] / optimized["mean_seconds"], 2) if optimized["mean_seconds"] else None,
+        "drift": drift(reference_probs, candidate_probs, args.dataset),
+        "max_drift": args.max_drift,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if report["drift"]["max_abs_diff"] > args.max_drift:
+        print(f"[warn] 最大概率误差 {report['drift']['max_abs_diff']:.4f} 超过阈值 {args.max_drift}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,89 @@
+"""
+embedding 推理冻结模式（位置编码缓存）的单次前向节省。
+
+分别计时:
+- Divide_ST_POS: 每次重新 arange + 两次 nn.Embedding 查表相加 vs. 命中缓存；
+- VideoBaseEmbedding: 完整 patch embedding（Conv3d + 位置编码 + LayerNorm），冻结前后。
+并检查两种模式输出一致。
+
+示例:
+    python benchmark_embedding.py --input_size 64,192,192 --repeats 200
+"""
+import json
+import time
+import argparse
+
+import torch
+
+from model.Base_module import VideoBaseEmbedding, freeze_for_inference
+
+
+def time_module(fn, device, warmup, repeats):
+    """返回 (输出, 平均每次微秒)"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    return out, (time.perf_counter() - start) / repeats * 1e6
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="位置编码缓存的前向节省")
+    p.add_argument("--input_size", type=str, default="64,192,192")
+    p.add_argument("--batch_size", type=int, default=1)
+    p.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    p.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    p.add_argument("--warmup", type=int, default=5)
+    p.add_argument("--repeats", type=int, default=100)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    input_size = tuple(map(int, args.input_size.split(",")))
+
+    embed = VideoBaseEmbedding(input_size_3D=(256, 256, 256), input_size_2D=(512, 512)).to(device, dtype).eval()
+    pos = embed.embeddings_st_pos_3D
+    tokens = 1
+    for s in input_size:
+        tokens *= s // embed.patch_size
+    # Divide_ST_POS 只用到输入的 shape / dtype / device
+    pos_input = torch.zeros(args.batch_size, 1, tokens, 768, device=device, dtype=dtype)
+    x = torch.randn((args.batch_size, 1) + input_size, device=device, dtype=dtype)
+
+    pos_plain, pos_plain_us = time_module(lambda: pos(pos_input), device, args.warmup, args.repeats)
+    embed_plain, embed_plain_us = time_module(lambda: embed(x), device, args.warmup, args.repeats)
+
+    freeze_for_inference(embed)
+    pos_cached, pos_cached_us = time_module(lambda: pos(pos_input), device, args.warmup, args.repeats)
+    embed_frozen, embed_frozen_us = time_module(lambda: embed(x), device, args.warmup, args.repeats)
+
+    report = {
+        "device": str(device),
+        "dtype": args.dtype,
+        "input_size": list(input_size),
+        "tokens": tokens,
+        "pos_embed_us": {"plain": round(pos_plain_us, 2), "cached": round(pos_cached_us, 2),
+                         "saved": round(pos_plain_us - pos_cached_us, 2)},
+        "video_embed_us": {"plain": round(embed_plain_us, 2), "frozen": round(embed_frozen_us, 2),
+                           "saved": round(embed_plain_us - embed_frozen_us, 2)},
+        "pos_max_abs_diff": float((pos_plain - pos_cached).abs().max()),
+        "embed_max_abs_diff": float((embed_plain - embed_frozen).abs().max()),
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+NIfTI 读取的峰值内存和耗时: 原 get_fdata 流程 vs. nifti_loader。
+
+每种方式在单独的子进程中运行一次，峰值 RSS 取 ru_maxrss 减去读取前的常驻内存，
+不受其他方式已分配内存的影响。方式:
+- legacy: get_fdata（float64）→ 转置 → clip / 归一化 → astype(float32)；
+- fast: 原始数据类型读取，float32 上原地缩放 / 归一化；
+- cache_cold / cache_warm: 启用磁盘缓存后第一次（解压并写入）和第二次（mmap）读取。
+最后在本进程中比较 legacy 与 fast 的输出。
+
+示例:
+    python benchmark_loading.py --nifti_path a.nii.gz --dataset ricord
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+from nifti_loader import NiftiCache, load_volume, truncate_hu
+
+
+MODES = ("legacy", "fast", "cache_cold", "cache_warm")
+
+
+def legacy_load(nifti_path, dataset):
+    image = nib.load(nifti_path).get_fdata()
+    image = image.transpose((2, 0, 1))
+    if dataset == "ricord":
+        image = np.clip(image, -1024, 325)
+        image = (image - 158.58) / 324.70
+    return image.astype(np.float32)
+
+
+def fast_load(nifti_path, dataset, cache=None):
+    image = load_volume(nifti_path, cache=cache)
+    if dataset == "ricord":
+        image = truncate_hu(image)
+    return image
+
+
+def current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def run_child(args):
+    """子进程: 读取一次，输出一行 JSON"""
+    cache = NiftiCache(args.cache_dir) if args.cache_dir else None
+    before = current_rss()
+    start = time.perf_counter()
+    if args.child == "legacy":
+        image = legacy_load(args.nifti_path[0], args.dataset)
+    else:
+        image = fast_load(args.nifti_path[0], args.dataset, cache=cache)
+    seconds = time.perf_counter() - start
+    # Linux 上 ru_maxrss 单位为 KB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps({
+        "seconds": round(seconds, 4),
+        "peak_rss_delta": peak - before,
+        "output_bytes": int(image.nbytes),
+        "shape": list(image.shape),
+    }))
+
+
+def spawn(mode, nifti_path, dataset, cache_dir=None):
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", mode, "--nifti_path", nifti_path,
+           "--dataset", dataset]
+    if cache_dir:
+        cmd += ["--cache_dir", cache_dir]
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="NIfTI 读取的峰值内存与耗时")
+    p.add_argument("--nifti_path", type=str, nargs="+", required=True)
+    p.add_argument("--dataset", type=str, default="ricord", choices=["custom", "ricord"])
+    p.add_argument("--cache_dir", type=str, default=None, help="磁盘缓存目录，默认使用临时目录并在结束后删除")
+    p.add_argument("--child", type=str, default=None, choices=MODES, help=argparse.SUPPRESS)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="nifti_cache_")
+    results = []
+    try:
+        for path in args.nifti_path:
+            row = {"nifti_path": path, "file_bytes": os.path.getsize(path)}
+            row["legacy"] = spawn("legacy", path, args.dataset)
+            row["fast"] = spawn("fast", path, args.dataset)
+            row["cache_cold"] = spawn("cache_cold", path, args.dataset, cache_dir)
+            row["cache_warm"] = spawn("cache_warm", path, args.dataset, cache_dir)
+            diff = np.abs(legacy_load(path, args.dataset) - fast_load(path, args.dataset))
+            row["max_abs_diff"] = float(diff.max())
+            row["peak_rss_saved"] = row["legacy"]["peak_rss_delta"] - row["fast"]["peak_rss_delta"]
+            results.append(row)
+            print(f"[info] {path}: 峰值 RSS {row['legacy']['peak_rss_delta'] >> 20} MB → "
+                  f"{row['fast']['peak_rss_delta'] >> 20} MB（缓存命中 {row['cache_warm']['peak_rss_delta'] >> 20} MB）")
+    finally:
+        if not args.cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    report = {"dataset": args.dataset, "results": results}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+nnU-Net 滑窗分割（SegmentationNetwork.predict_3D）在 CPU 上的吞吐。
+
+对每个 patch 尺寸构建一个与 nnUNetTrainerV2 相同结构的 Generic_UNet（随机权重，关闭深监督），
+在不同线程数下对 --volume_scale 倍 patch 大小的随机体数据做带高斯加权的滑窗推理，给出 tiles/s；
+有 CUDA 时再在 GPU 上跑一次（fp32），报告两者概率的最大偏差。
+
+示例:
+    python benchmark_nnunet_cpu.py --patch_sizes 128,128,128 80,192,160 --threads 1,4,8
+"""
+import copy
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch import nn
+
+from nnunet.network_architecture.generic_UNet import Generic_UNet
+from nnunet.network_architecture.initialization import InitWeights_He
+from nnunet.utilities.nd_softmax import softmax_helper
+
+
+# nnU-Net 3d_fullres 常见的 patch 尺寸
+DEFAULT_PATCH_SIZES = ("128,128,128", "96,160,160", "80,192,160", "64,192,192")
+
+
+def pool_kernel_sizes(patch_size, max_pools=5, min_feature_size=4):
+    """简化的 nnU-Net 规划: 每个 stage 对仍不小于 2*min_feature_size 的轴做 2 倍下采样"""
+    size = list(patch_size)
+    kernels = []
+    for _ in range(max_pools):
+        kernel = [2 if s >= 2 * min_feature_size and s % 2 == 0 else 1 for s in size]
+        if not any(k == 2 for k in kernel):
+            break
+        kernels.append(kernel)
+        size = [s // k for s, k in zip(size, kernel)]
+    return kernels
+
+
+def build_network(patch_size, num_classes, base_num_features=32):
+    pools = pool_kernel_sizes(patch_size)
+    convs = [[3, 3, 3]] * (len(pools) + 1)
+    network = Generic_UNet(1, base_num_features, num_classes, len(pools), 2, 2, nn.Conv3d, nn.InstanceNorm3d,
+                           {"eps": 1e-5, "affine": True}, nn.Dropout3d, {"p": 0, "inplace": True},
+                           nn.LeakyReLU, {"negative_slope": 1e-2, "inplace": True}, False, False, lambda x: x,
+                           InitWeights_He(1e-2), pools, convs, False, True, True, max_num_features=320)
+    network.inference_apply_nonlin = softmax_helper
+    return network.eval()
+
+
+def run(network, volume, patch_size, step_size, do_mirroring, num_threads=None):
+    """返回 (class_probabilities, 秒)"""
+    start = time.perf_counter()
+    _, probs = network.predict_3D(volume, do_mirroring=do_mirroring, mirror_axes=(0, 1, 2),
+                                  use_sliding_window=True, step_size=step_size, patch_size=patch_size,
+                                  use_gaussian=True, verbose=False, mixed_precision=False, num_threads=num_threads)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return probs, time.perf_counter() - start
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="nnU-Net 滑窗分割的 CPU 吞吐")
+    p.add_argument("--patch_sizes", type=str, nargs="+", default=list(DEFAULT_PATCH_SIZES))
+    p.add_argument("--volume_scale", type=float, default=1.5, help="体数据每个轴是 patch 的多少倍")
+    p.add_argument("--threads", type=str, default="1,4," + str(torch.get_num_threads()))
+    p.add_argument("--num_classes", type=int, default=3)
+    p.add_argument("--step_size", type=float, default=0.5)
+    p.add_argument("--mirroring", action="store_true", help="启用镜像 TTA（每个 tile 8 次前向）")
+    p.add_argument("--tolerance", type=float, default=1e-3, help="CPU 与 GPU 概率的允许偏差")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    threads = sorted({int(t) for t in args.threads.split(",") if t.strip()})
+    results = []
+
+    for patch in args.patch_sizes:
+        patch_size = tuple(int(s) for s in patch.split(","))
+        network = build_network(patch_size, args.num_classes)
+        shape = tuple(int(s * args.volume_scale) for s in patch_size)
+        volume = rng.standard_normal((1,) + shape).astype(np.float32)
+        steps = network._compute_steps_for_sliding_window(patch_size, shape, args.step_size)
+        num_tiles = int(np.prod([len(s) for s in steps]))
+        row = {"patch_size": list(patch_size), "volume": list(shape), "tiles": num_tiles, "cpu": []}
+
+        cpu_probs = None
+        for n in threads:
+            cpu_probs, seconds = run(network, volume, patch_size, args.step_size, args.mirroring, num_threads=n)
+            row["cpu"].append({"threads": n, "seconds": round(seconds, 3), "tiles_per_s": round(num_tiles / seconds, 3)})
+            print(f"[info] patch {patch_size}, {n} 线程: {num_tiles / seconds:.2f} tiles/s")
+
+        if torch.cuda.is_available():
+            gpu_network = copy.deepcopy(network).cuda()
+            gpu_probs, seconds = run(gpu_network, volume, patch_size, args.step_size, args.mirroring)
+            diff = float(np.abs(gpu_probs - cpu_probs).max())
+            row["gpu"] = {"seconds": round(seconds, 3), "tiles_per_s": round(num_tiles / seconds, 3),
+                          "max_abs_diff": diff, "within_tolerance": diff <= args.tolerance}
+            if diff > args.tolerance:
+                print(f"[warn] patch {patch_size}: CPU 与 GPU 概率最大偏差 {diff:.2e} 超过 {args.tolerance}")
+            del gpu_network
+            torch.cuda.empty_cache()
+        results.append(row)
+
+    report = {"step_size": args.step_size, "mirroring": args.mirroring, "results": results}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+nnU-Net 多折集成推理（nnunet/inference/predict.py 的 predict_ensemble）在不同 ensemble_mode 下的吞吐。
+
+构建 --folds 个随机权重的 Generic_UNet（与 benchmark_nnunet_cpu.py 相同结构）作为各折 checkpoint，
+对 --cases 个随机病例分别用 reload（每例逐折重新加载权重）、resident（每折一份常驻网络）
+和 fold_major（逐折跑完所有病例，softmax 累加落盘到 memmap）做集成推理，
+给出 病例/分钟、state_dict 加载次数、峰值显存，并检查与 reload 的 softmax 一致。
+
+示例:
+    python benchmark_nnunet_ensemble.py --patch_size 128,128,128 --folds 5 --cases 10
+"""
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from benchmark_nnunet_cpu import build_network
+from nnunet.inference.predict import predict_ensemble, choose_ensemble_mode, _network_bytes
+
+
+class SyntheticTrainer(object):
+    """predict_ensemble 用到的 nnUNetTrainer 接口，权重来自随机初始化的各折"""
+
+    def __init__(self, network, patch_size):
+        self.network = network
+        self.patch_size = patch_size
+        self.state_dict_loads = 0
+
+    def load_checkpoint_ram(self, checkpoint, train=True):
+        self.network.load_state_dict(checkpoint["state_dict"])
+        self.state_dict_loads += 1
+
+    def predict_preprocessed_data_return_seg_and_softmax(self, data, do_mirroring=True, mirror_axes=None,
+                                                         use_sliding_window=True, step_size=0.5, use_gaussian=True,
+                                                         all_in_gpu=False, mixed_precision=True):
+        self.network.eval()
+        return self.network.predict_3D(data, do_mirroring=do_mirroring, mirror_axes=mirror_axes,
+                                       use_sliding_window=use_sliding_window, step_size=step_size,
+                                       patch_size=self.patch_size, use_gaussian=use_gaussian, all_in_gpu=all_in_gpu,
+                                       verbose=False, mixed_precision=mixed_precision)
+
+
+def run(mode, params, volumes, args, patch_size, spill_folder):
+    """返回 ({病例号: softmax}, 秒, state_dict 加载次数, 峰值显存字节或 None)"""
+    torch.manual_seed(args.seed)
+    trainer = SyntheticTrainer(build_network(patch_size, args.num_classes).to(args.device), patch_size)
+    cuda = args.device == "cuda"
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    preprocessing = ((str(i), (v, {})) for i, v in enumerate(volumes))
+    predict_kwargs = dict(do_mirroring=args.mirroring, mirror_axes=(0, 1, 2), use_sliding_window=True,
+                          step_size=args.step_size, use_gaussian=True, all_in_gpu=False,
+                          mixed_precision=args.mixed_precision)
+    outputs = {}
+    start = time.perf_counter()
+    with torch.no_grad():
+        for name, _, softmax, _ in predict_ensemble(trainer, params, preprocessing, predict_kwargs, mode,
+                                                    spill_folder):
+            outputs[name] = softmax
+    if cuda:
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated() if cuda else None
+    loads = trainer.state_dict_loads
+    del trainer
+    if cuda:
+        torch.cuda.empty_cache()
+    return outputs, seconds, loads, peak
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="nnU-Net 多折集成推理的吞吐")
+    p.add_argument("--patch_size", type=str, default="96,160,160")
+    p.add_argument("--volume_scale", type=float, default=1.5, help="体数据每个轴是 patch 的多少倍")
+    p.add_argument("--folds", type=int, default=5)
+    p.add_argument("--cases", type=int, default=8)
+    p.add_argument("--modes", type=str, default="reload,resident,fold_major")
+    p.add_argument("--num_classes", type=int, default=3)
+    p.add_argument("--step_size", type=float, default=0.5)
+    p.add_argument("--mirroring", action="store_true", help="启用镜像 TTA")
+    p.add_argument("--mixed_precision", action="store_true")
+    p.add_argument("--spill_folder", type=str, default=None, help="fold_major 的临时目录，默认系统临时目录")
+    p.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    patch_size = tuple(int(s) for s in args.patch_size.split(","))
+    rng = np.random.RandomState(args.seed)
+    shape = tuple(int(s * args.volume_scale) for s in patch_size)
+    volumes = [rng.standard_normal((1,) + shape).astype(np.float32) for _ in range(args.cases)]
+
+    # 各折 checkpoint 与真实推理一样放在 CPU 上
+    params = []
+    for fold in range(args.folds):
+        torch.manual_seed(args.seed + fold)
+        params.append({"state_dict": build_network(patch_size, args.num_classes).state_dict()})
+
+    probe = SyntheticTrainer(build_network(patch_size, args.num_classes).to(args.device), patch_size)
+    report = {
+        "device": args.device, "patch_size": list(patch_size), "volume": list(shape), "folds": args.folds,
+        "cases": args.cases, "network_bytes": _network_bytes(probe.network),
+        "auto": choose_ensemble_mode(probe, params), "runs": [],
+    }
+    del probe
+
+    spill_folder = tempfile.mkdtemp(prefix="ensemble_bench_", dir=args.spill_folder)
+    reference = None
+    try:
+        for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+            outputs, seconds, loads, peak = run(mode, params, volumes, args, patch_size, spill_folder)
+            if reference is None:
+                reference = outputs
+            diff = max(float(np.abs(outputs[k].astype(np.float32) - reference[k].astype(np.float32)).max())
+                       for k in reference)
+            entry = {
+                "mode": mode,
+                "seconds": round(seconds, 3),
+                "cases_per_minute": round(args.cases / seconds * 60, 2),
+                "state_dict_loads": loads,
+                "peak_memory_bytes": peak,
+                "max_abs_diff": diff,
+            }
+            report["runs"].append(entry)
+            print(f"[info] {mode}: {entry['cases_per_minute']} 例/分钟，加载权重 {entry['state_dict_loads']} 次")
+    finally:
+        shutil.rmtree(spill_folder, ignore_errors=True)
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
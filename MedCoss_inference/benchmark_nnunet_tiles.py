@@ -0,0 +1,114 @@
+"""
+nnU-Net 滑窗推理中每次前向的 tile 数（tile_batch_size）对吞吐的影响。
+
+对每个 patch 尺寸，分别以 1..N 个 tile 为一个 batch 以及自动选择（按空闲显存 / 内存）做滑窗推理，
+给出 tiles/s 和峰值显存，并检查各 batch 大小的输出与逐 tile 推理一致。
+加 --pipelined 时每个 batch 大小再用流水线模式（切块 / 前向 / 累加分线程，见
+nnunet/network_architecture/tile_pipeline.py）跑一次，并给出各阶段的忙碌时间和利用率。
+
+示例:
+    python benchmark_nnunet_tiles.py --patch_sizes 128,128,128 --max_tile_batch_size 8 --mirroring
+"""
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from benchmark_nnunet_cpu import DEFAULT_PATCH_SIZES, build_network
+
+
+def run(network, volume, patch_size, args, tile_batch_size, pipelined=False):
+    """返回 (class_probabilities, 秒, 峰值显存字节或 None)"""
+    cuda = torch.cuda.is_available() and args.device == "cuda"
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    _, probs = network.predict_3D(volume, do_mirroring=args.mirroring, mirror_axes=(0, 1, 2),
+                                  use_sliding_window=True, step_size=args.step_size, patch_size=patch_size,
+                                  use_gaussian=True, verbose=False, mixed_precision=args.mixed_precision,
+                                  tile_batch_size=tile_batch_size, pipelined=pipelined)
+    if cuda:
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    return probs, seconds, torch.cuda.max_memory_allocated() if cuda else None
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="nnU-Net 滑窗推理的 tile batch 吞吐")
+    p.add_argument("--patch_sizes", type=str, nargs="+", default=list(DEFAULT_PATCH_SIZES))
+    p.add_argument("--volume_scale", type=float, default=2.0, help="体数据每个轴是 patch 的多少倍")
+    p.add_argument("--max_tile_batch_size", type=int, default=8)
+    p.add_argument("--num_classes", type=int, default=3)
+    p.add_argument("--step_size", type=float, default=0.5)
+    p.add_argument("--mirroring", action="store_true", help="启用镜像 TTA（每个 batch 8 次前向）")
+    p.add_argument("--mixed_precision", action="store_true")
+    p.add_argument("--pipelined", action="store_true", help="同时测量流水线模式")
+    p.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    results = []
+
+    for patch in args.patch_sizes:
+        patch_size = tuple(int(s) for s in patch.split(","))
+        network = build_network(patch_size, args.num_classes).to(args.device)
+        shape = tuple(int(s * args.volume_scale) for s in patch_size)
+        volume = rng.standard_normal((1,) + shape).astype(np.float32)
+        steps = network._compute_steps_for_sliding_window(patch_size, shape, args.step_size)
+        num_tiles = int(np.prod([len(s) for s in steps]))
+        auto = network._auto_tile_batch_size(patch_size, num_tiles)
+        row = {"patch_size": list(patch_size), "volume": list(shape), "tiles": num_tiles, "auto": auto, "runs": []}
+
+        # 预热（cudnn 选择算法等）
+        run(network, volume, patch_size, args, 1)
+        reference = None
+        modes = (False, True) if args.pipelined else (False,)
+        for batch_size in list(range(1, args.max_tile_batch_size + 1)) + [None]:
+            for pipelined in modes:
+                try:
+                    probs, seconds, peak = run(network, volume, patch_size, args, batch_size, pipelined)
+                except RuntimeError as e:
+                    # 显存不足时记录并跳过
+                    print(f"[warn] patch {patch_size}, tile_batch_size={batch_size}: {e}")
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                    continue
+                if reference is None:
+                    reference = probs
+                entry = {
+                    "tile_batch_size": batch_size if batch_size is not None else f"auto({auto})",
+                    "pipelined": pipelined,
+                    "seconds": round(seconds, 3),
+                    "tiles_per_s": round(num_tiles / seconds, 3),
+                    "peak_memory_bytes": peak,
+                    "max_abs_diff": float(np.abs(probs - reference).max()),
+                }
+                if pipelined:
+                    entry["stages"] = network.last_tile_pipeline_stats
+                row["runs"].append(entry)
+                print(f"[info] patch {patch_size}, tile_batch_size={entry['tile_batch_size']}"
+                      f"{'（流水线）' if pipelined else ''}: {entry['tiles_per_s']} tiles/s")
+        results.append(row)
+        del network
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    report = {"device": args.device, "step_size": args.step_size, "mirroring": args.mirroring,
+              "mixed_precision": args.mixed_precision, "pipelined": args.pipelined, "results": results}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
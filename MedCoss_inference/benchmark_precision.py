@@ -0,0 +1,138 @@
+"""
+推理精度（bf16 / fp16，autocast 或整体转换）相对 fp32 的数值偏差、延迟和内存。
+
+以 fp32 模型的输出为基准，对每种精度设置给出:
+- 每个类别的最大 / 平均绝对误差（sigmoid 或 softmax 之后）；
+- 平均延迟及相对 fp32 的加速比；
+- 峰值内存: CUDA 为 max_memory_allocated，CPU 为采样得到的常驻内存峰值增量；以及权重占用。
+
+示例:
+    python benchmark_precision.py --checkpoint_path pth/checkpoint.pth --nifti_path a.nii.gz \\
+        --precisions bf16,fp16 --modes autocast,cast
+"""
+import copy
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from benchmark_attention import RssSampler
+from inference_single_case import build_model, preprocess_single_nifti, predict_probs
+from model_server import model_nbytes
+from precision import PRECISION_MODES, apply_precision, check_precision
+
+
+def run(model, device, inputs, dataset, warmup, repeats):
+    """返回 (每个输入的概率, 平均延迟秒, 峰值内存增量字节)"""
+    for _ in range(warmup):
+        predict_probs(model, device, inputs[0], dataset)
+
+    probs, latencies = [], []
+
+    def loop():
+        for x in inputs:
+            for _ in range(repeats):
+                start = time.perf_counter()
+                out = predict_probs(model, device, x, dataset)
+                latencies.append(time.perf_counter() - start)
+            probs.append(out)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+        loop()
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        with RssSampler() as sampler:
+            loop()
+        peak = sampler.delta
+    return np.concatenate(probs, axis=0), float(np.mean(latencies)), int(peak)
+
+
+def load_inputs(args, input_size):
+    if args.nifti_path:
+        return [preprocess_single_nifti(path, args.dataset, input_size=input_size) for path in args.nifti_path]
+    rng = np.random.RandomState(args.seed)
+    return [rng.standard_normal((1, 1) + input_size).astype(np.float32) for _ in range(args.random_cases)]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="MedCoss 推理精度偏差与性能")
+    p.add_argument("--checkpoint_path", type=str, required=True)
+    p.add_argument("--nifti_path", type=str, nargs="*", default=None)
+    p.add_argument("--dataset", type=str, default="custom", choices=["custom", "ricord"])
+    p.add_argument("--input_size", type=str, default="64,192,192")
+    p.add_argument("--num_classes", type=int, default=None)
+    p.add_argument("--precisions", type=str, default="bf16,fp16")
+    p.add_argument("--modes", type=str, default=",".join(PRECISION_MODES))
+    p.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    p.add_argument("--random_cases", type=int, default=2)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--warmup", type=int, default=1)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    input_size = tuple(map(int, args.input_size.split(",")))
+    reference_model, _, num_classes = build_model(
+        args.checkpoint_path, input_size, num_classes=args.num_classes, device=device
+    )
+    inputs = load_inputs(args, input_size)
+
+    reference, fp32_seconds, fp32_peak = run(reference_model, device, inputs, args.dataset, args.warmup, args.repeats)
+    results = [{
+        "precision": "fp32",
+        "mode": None,
+        "seconds": round(fp32_seconds, 4),
+        "peak_bytes": fp32_peak,
+        "param_bytes": model_nbytes(reference_model),
+    }]
+
+    for precision in args.precisions.split(","):
+        for mode in args.modes.split(","):
+            try:
+                check_precision(precision, mode, device)
+            except ValueError as e:
+                print(f"[warn] 跳过 {precision}/{mode}: {e}")
+                continue
+            # 位置编码缓存是 inference_mode 下生成的张量，复制前先清空
+            for module in reference_model.modules():
+                if hasattr(module, "clear_cache"):
+                    module.clear_cache()
+            model = apply_precision(copy.deepcopy(reference_model), precision, mode)
+            probs, seconds, peak = run(model, device, inputs, args.dataset, args.warmup, args.repeats)
+            diff = np.abs(probs - reference)
+            row = {
+                "precision": precision,
+                "mode": mode,
+                "seconds": round(seconds, 4),
+                "speedup": round(fp32_seconds / seconds, 2),
+                "peak_bytes": peak,
+                "param_bytes": model_nbytes(model),
+                "max_abs_diff_per_class": [round(float(v), 6) for v in diff.max(axis=0)],
+                "mean_abs_diff_per_class": [round(float(v), 6) for v in diff.mean(axis=0)],
+            }
+            if args.dataset == "custom":
+                row["label_agreement"] = float(((probs > 0.5) == (reference > 0.5)).mean())
+            results.append(row)
+            print(f"[info] {precision}/{mode}: {row['seconds']}s, 最大误差 {float(diff.max()):.5f}")
+            del model
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+    report = {"device": str(device), "num_classes": num_classes, "cases": len(inputs), "results": results}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
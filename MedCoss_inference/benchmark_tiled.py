@@ -0,0 +1,123 @@
+"""
+滑窗分类与单次前向（resize 到 input_size）的吞吐对比。
+
+对每个病例分别计时:
+- single: preprocess(fit_strategy) + 一次前向；
+- tiled: 原始尺寸切窗 + 按 tile_batch_size 前向 + 聚合。
+输出每例耗时、每秒病例数、窗口数以及两种模式输出概率的差异。
+
+示例:
+    python benchmark_tiled.py --checkpoint_path pth/checkpoint.pth --nifti_path a.nii.gz b.nii.gz \\
+        --tile_overlap 0.25 --max_tiles 16 --tile_aggregation max
+未指定 --nifti_path 时使用 --volume_size 大小的随机体数据。
+"""
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from inference_single_case import build_model, preprocess_single_nifti, predict_probs
+from preprocessing import FIT_STRATEGIES, fit_to_input_size
+from tiled_inference import AGGREGATIONS, predict_probs_tiled
+
+
+def time_call(fn, warmup, repeats):
+    """返回 (最后一次结果, 每次耗时列表)"""
+    for _ in range(warmup):
+        fn()
+    result, latencies = None, []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - start)
+    return result, latencies
+
+
+def load_volumes(args):
+    """返回原始尺寸、已归一化的 [1,1,D,H,W] 列表"""
+    if args.nifti_path:
+        return [preprocess_single_nifti(path, args.dataset, fit_strategy="none", check_tokens=False)
+                for path in args.nifti_path]
+    rng = np.random.RandomState(args.seed)
+    shape = (1, 1) + tuple(map(int, args.volume_size.split(",")))
+    return [rng.standard_normal(shape).astype(np.float32) for _ in range(args.random_cases)]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="MedCoss 滑窗分类吞吐基准")
+    p.add_argument("--checkpoint_path", type=str, required=True)
+    p.add_argument("--nifti_path", type=str, nargs="*", default=None)
+    p.add_argument("--dataset", type=str, default="custom", choices=["custom", "ricord"])
+    p.add_argument("--input_size", type=str, default="64,192,192")
+    p.add_argument("--num_classes", type=int, default=None)
+    p.add_argument("--fit_strategy", type=str, default="resize", choices=FIT_STRATEGIES,
+                   help="单次前向模式的尺寸调整方式")
+    p.add_argument("--volume_size", type=str, default="128,384,384", help="随机体数据的尺寸")
+    p.add_argument("--random_cases", type=int, default=2)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--tile_overlap", type=float, default=0.25)
+    p.add_argument("--max_tiles", type=int, default=16)
+    p.add_argument("--tile_aggregation", type=str, default="max", choices=AGGREGATIONS)
+    p.add_argument("--tile_batch_size", type=int, default=4)
+    p.add_argument("--warmup", type=int, default=1)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--output", type=str, default=None, help="结果另存为 JSON")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    input_size = tuple(map(int, args.input_size.split(",")))
+    model, device, num_classes = build_model(args.checkpoint_path, input_size, num_classes=args.num_classes)
+    volumes = load_volumes(args)
+
+    cases = []
+    for i, volume in enumerate(volumes):
+        def single():
+            x = fit_to_input_size(volume[0, 0], input_size, args.fit_strategy)[np.newaxis, np.newaxis]
+            return predict_probs(model, device, np.ascontiguousarray(x), args.dataset)
+
+        def tiled():
+            return predict_probs_tiled(
+                model, device, volume, input_size, args.dataset,
+                overlap=args.tile_overlap, max_tiles=args.max_tiles,
+                aggregation=args.tile_aggregation, tile_batch_size=args.tile_batch_size,
+            )
+
+        single_probs, single_latency = time_call(single, args.warmup, args.repeats)
+        (tiled_probs, n_tiles), tiled_latency = time_call(tiled, args.warmup, args.repeats)
+        case = {
+            "shape": list(volume.shape[2:]),
+            "tiles": n_tiles,
+            "single_seconds": round(float(np.mean(single_latency)), 4),
+            "tiled_seconds": round(float(np.mean(tiled_latency)), 4),
+            "max_abs_diff": float(np.abs(single_probs - tiled_probs).max()),
+        }
+        cases.append(case)
+        print(f"[info] 病例 {i}: {case}")
+
+    single_mean = float(np.mean([c["single_seconds"] for c in cases]))
+    tiled_mean = float(np.mean([c["tiled_seconds"] for c in cases]))
+    report = {
+        "device": str(device),
+        "num_classes": num_classes,
+        "input_size": list(input_size),
+        "aggregation": args.tile_aggregation,
+        "tile_batch_size": args.tile_batch_size,
+        "single": {"seconds_per_case": round(single_mean, 4), "cases_per_second": round(1 / single_mean, 3)},
+        "tiled": {"seconds_per_case": round(tiled_mean, 4), "cases_per_second": round(1 / tiled_mean, 3),
+                  "mean_tiles": float(np.mean([c["tiles"] for c in cases]))},
+        "cases": cases,
+    }
+    if torch.cuda.is_available():
+        report["cuda_max_memory_allocated"] = torch.cuda.max_memory_allocated()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+checkpoint 清单: 在 .pth 旁边生成一次 <checkpoint>.manifest.json，记录
+类别数、输入尺寸、各张量的 shape / dtype、文件 SHA256 以及生成时的文件大小和修改时间。
+
+build_model 读取清单得到类别数，不再为了推断类别数把整个 checkpoint（含优化器状态）
+加载到目标设备上逐个扫描张量；文件大小或修改时间变化时清单自动重新生成。
+权重加载按以下顺序选择:
+1. 清单中登记且未过期的 .safetensors（只含模型权重，mmap 读取）；
+2. 支持 mmap 的 torch.load（torch >= 2.1）；
+3. 普通 torch.load，加载到 CPU 后再由 model.to(device) 搬到目标设备。
+
+示例:
+    python checkpoint_manifest.py --checkpoint_path pth/checkpoint.pth --input_size 64,192,192 --safetensors
+"""
+import os
+import json
+import inspect
+import hashlib
+import argparse
+
+import torch
+
+
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def manifest_path(checkpoint_path):
+    return checkpoint_path + ".manifest.json"
+
+
+def safetensors_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + ".safetensors"
+
+
+def file_sha256(path):
+    """按块计算文件内容的 SHA256（与 patient_records.tasks.file_sha256 一致）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def model_state(ckpt):
+    return ckpt["model"] if isinstance(ckpt, dict) and "model" in ckpt else ckpt
+
+
+def infer_num_classes_from_ckpt(state_dict, fallback=2):
+    """
+    从 checkpoint 的线性层权重推断类别数（out_features）。
+    优先选择包含 head/fc/classifier 且 out!=in 的层，否则取 out!=in 的最小值，再退回最小 out。
+    state_dict 的值可以是张量，也可以是清单中的 {"shape": [...]}。
+    """
+    candidates = []
+    for k, v in state_dict.items():
+        if isinstance(v, torch.Tensor):
+            shape = tuple(v.shape)
+        elif isinstance(v, dict) and "shape" in v:
+            shape = tuple(v["shape"])
+        else:
+            continue
+        if len(shape) == 2 and k.endswith("weight"):  # Linear: [out, in]
+            out_f, in_f = int(shape[0]), int(shape[1])
+            tag = "pri" if any(t in k.lower() for t in ["head", "classifier", "fc"]) else "sec"
+            candidates.append((tag, out_f, in_f, k))
+
+    if not candidates:
+        return int(fallback)
+
+    pri = [c for c in candidates if c[0] == "pri" and c[1] != c[2]]
+    if pri:
+        return int(pri[0][1])
+
+    diff = [c for c in candidates if c[1] != c[2]]
+    if diff:
+        diff.sort(key=lambda x: x[1])
+        return int(diff[0][1])
+
+    candidates.sort(key=lambda x: x[1])
+    return int(candidates[0][1])
+
+
+def build_manifest(checkpoint_path, input_size=None, num_classes=None, export_safetensors=False):
+    """加载一次 checkpoint（CPU）生成清单并写到 .pth 旁边，返回清单"""
+    ckpt = torch.load(checkpoint_path, map_location="cpu")
+    state = model_state(ckpt)
+    tensors = {
+        k: {"shape": list(v.shape), "dtype": str(v.dtype).replace("torch.", "")}
+        for k, v in state.items() if isinstance(v, torch.Tensor)
+    }
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "checkpoint": os.path.basename(checkpoint_path),
+        "source": _file_stat(checkpoint_path),
+        "sha256": file_sha256(checkpoint_path),
+        "num_classes": int(num_classes) if num_classes is not None else infer_num_classes_from_ckpt(tensors),
+        "input_size": None if input_size is None else [int(s) for s in input_size],
+        "epoch": ckpt.get("epoch") if isinstance(ckpt, dict) else None,
+        "param_count": sum(int(torch.Size(t["shape"]).numel()) for t in tensors.values()),
+        "tensors": tensors,
+        "safetensors": None,
+    }
+    if export_safetensors:
+        from safetensors.torch import save_file
+
+        path = safetensors_path(checkpoint_path)
+        save_file({k: v.contiguous() for k, v in state.items() if isinstance(v, torch.Tensor)}, path,
+                  metadata={"source_sha256": manifest["sha256"]})
+        manifest["safetensors"] = dict(_file_stat(path), path=os.path.basename(path))
+    del ckpt, state
+
+    try:
+        with open(manifest_path(checkpoint_path) + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path(checkpoint_path) + ".tmp", manifest_path(checkpoint_path))
+    except OSError as e:
+        # 权重目录只读时本次仍可使用，下次启动重新生成
+        print(f"[warn] 写入 checkpoint 清单失败: {e}")
+    return manifest
+
+
+def is_fresh(manifest, checkpoint_path):
+    return (
+        manifest.get("version") == MANIFEST_VERSION
+        and manifest.get("source") == _file_stat(checkpoint_path)
+    )
+
+
+def read_manifest(checkpoint_path):
+    """已存在且未过期的清单，否则返回 None"""
+    try:
+        with open(manifest_path(checkpoint_path), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if is_fresh(manifest, checkpoint_path) else None
+
+
+def load_manifest(checkpoint_path):
+    manifest = read_manifest(checkpoint_path)
+    if manifest is None:
+        print(f"[info] 生成 checkpoint 清单: {manifest_path(checkpoint_path)}")
+        manifest = build_manifest(checkpoint_path)
+    return manifest
+
+
+def _fresh_safetensors(manifest, checkpoint_path):
+    record = manifest.get("safetensors")
+    if not record:
+        return None
+    path = os.path.join(os.path.dirname(checkpoint_path), record["path"])
+    if not os.path.isfile(path) or _file_stat(path) != {"size": record["size"], "mtime_ns": record["mtime_ns"]}:
+        return None
+    return path
+
+
+def load_state_dict(checkpoint_path, manifest=None):
+    """返回 (CPU 上的模型 state_dict, 加载方式)"""
+    if manifest is not None:
+        path = _fresh_safetensors(manifest, checkpoint_path)
+        if path is not None:
+            try:
+                from safetensors.torch import load_file
+            except ImportError:
+                pass
+            else:
+                return load_file(path, device="cpu"), "safetensors"
+    if "mmap" in inspect.signature(torch.load).parameters:
+        ckpt = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+        return model_state(ckpt), "torch.load(mmap)"
+    ckpt = torch.load(checkpoint_path, map_location="cpu")
+    return model_state(ckpt), "torch.load"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="生成 MedCoss checkpoint 清单")
+    p.add_argument("--checkpoint_path", type=str, required=True)
+    p.add_argument("--input_size", type=str, default=None, help="训练时的输入尺寸，如 64,192,192")
+    p.add_argument("--num_classes", type=int, default=None, help="默认从线性层权重推断")
+    p.add_argument("--safetensors", action="store_true", help="同时导出只含模型权重的 .safetensors")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    input_size = tuple(map(int, args.input_size.split(","))) if args.input_size else None
+    manifest = build_manifest(args.checkpoint_path, input_size=input_size, num_classes=args.num_classes,
+                              export_safetensors=args.safetensors)
+    summary = {k: v for k, v in manifest.items() if k != "tensors"}
+    summary["tensors"] = len(manifest["tensors"])
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
@@ -0,0 +1,160 @@
+"""
+无 GPU 部署时的 CPU 推理优化。
+
+optimize_for_cpu 在 fp32 模型上依次做:
+- 设置 intra-op 线程数（torch.set_num_threads）；
+- 动态 int8 量化: Encoder 各层的 linear1 / linear2 以及分类 head 中的 nn.Linear。
+  nn.MultiheadAttention 的 in_proj 是裸参数、out_proj 是 NonDynamicallyQuantizableLinear，
+  quantize_dynamic 不会改动它们，注意力部分仍为 fp32；
+- VideoBaseEmbedding.embeddings_3D（16³ 步长的 Conv3d）权重转为 channels_last_3d，输入同样转换；
+- 可选导出: "torchscript"（按输入 shape 惰性 trace）或 "compile"（torch.compile，需 torch>=2.0）。
+
+量化后的精度漂移和延迟可用 benchmark_cpu.py 与 fp32 输出对比。
+"""
+import copy
+
+import torch
+from torch import nn
+
+
+EXPORT_CHOICES = ("none", "torchscript", "compile")
+
+
+def quantize_linears(model):
+    """对 Encoder 前馈层和 head 做动态 int8 量化（原地替换子模块），返回被量化的模块名"""
+    targets = []
+    for i, layer in enumerate(model.fused_encoder.layers):
+        targets += [f"fused_encoder.layers.{i}.linear1", f"fused_encoder.layers.{i}.linear2"]
+    for name, module in model.head.named_children():
+        if type(module) is nn.Linear:
+            targets.append(f"head.{name}")
+
+    qconfig = {name: torch.quantization.default_dynamic_qconfig for name in targets}
+    torch.quantization.quantize_dynamic(model, qconfig_spec=qconfig, dtype=torch.qint8, inplace=True)
+    return targets
+
+
+class ExportedModel(nn.Module):
+    """
+    保持 Unified_Model 的调用方式 model({"data": x, "modality": "3D image"})，
+    内部调用 trace / compile 后的张量接口。
+    trace 会固化输入 shape 相关的分支（rearrange、位置编码长度），因此每种 shape 单独 trace 一次，
+    常驻服务里 shape 只随 batch 大小变化，数量有限。
+    """
+
+    def __init__(self, model, export):
+        super(ExportedModel, self).__init__()
+        self.model = model
+        self.export = export
+        self._traced = {}
+        self._compiled = None
+        if export == "compile":
+            if not hasattr(torch, "compile"):
+                raise RuntimeError(f"当前 torch {torch.__version__} 不支持 torch.compile，请改用 torchscript")
+            self._compiled = torch.compile(_TensorForward(model).eval())
+
+    def __getattr__(self, name):
+        try:
+            return super(ExportedModel, self).__getattr__(name)
+        except AttributeError:
+            # cal_acc / now_input_size_3D 等属性转发给原模型
+            return getattr(super(ExportedModel, self).__getattr__("model"), name)
+
+    def _traced_for(self, x):
+        key = tuple(x.shape)
+        traced = self._traced.get(key)
+        if traced is None:
+            with torch.no_grad():
+                traced = torch.jit.trace(_TensorForward(self.model).eval(), x, check_trace=False)
+                traced = torch.jit.freeze(traced) if hasattr(torch.jit, "freeze") else traced
+            self._traced[key] = traced
+            print(f"[info] TorchScript trace 完成，输入 shape {key}")
+        return traced
+
+    def forward(self, data):
+        x = data["data"]
+        if data.get("modality") != "3D image":
+            return self.model(data)
+        if self.export == "torchscript":
+            return self._traced_for(x)(x)
+        return self._compiled(x)
+
+
+class _TensorForward(nn.Module):
+    """torch.jit.trace 只接受张量输入，包一层把 dict 接口展开"""
+
+    def __init__(self, model):
+        super(_TensorForward, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model({"data": x, "modality": "3D image"})
+
+
+def _channels_last_input(module, inputs):
+    """embeddings_3D 的 forward_pre_hook: 输入转为 channels_last_3d，与权重布局一致"""
+    return (inputs[0].contiguous(memory_format=torch.channels_last_3d),) + tuple(inputs[1:])
+
+
+def optimize_for_cpu(model, quantize=True, num_threads=None, channels_last=True, export="none", inplace=False):
+    """
+    返回 CPU 推理用的模型（默认复制一份，fp32 原模型保持不变以便对比精度）。
+    model 需已 load_state_dict 并处于 eval 模式。
+    """
+    if export not in EXPORT_CHOICES:
+        raise ValueError(f"不支持的导出方式: {export}")
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.to("cpu")
+    model.eval()
+
+    options = {
+        "quantize": bool(quantize),
+        "num_threads": torch.get_num_threads(),
+        "channels_last": bool(channels_last),
+        "export": export,
+    }
+
+    if quantize:
+        quantized = quantize_linears(model)
+        print(f"[info] 动态 int8 量化 {len(quantized)} 个 Linear")
+
+    if channels_last:
+        embed = model.video_embed
+        embed.embeddings_3D = embed.embeddings_3D.to(memory_format=torch.channels_last_3d)
+        embed.embeddings_3D.register_forward_pre_hook(_channels_last_input)
+
+    for p in model.parameters():
+        p.requires_grad_(False)
+
+    if export != "none":
+        model = ExportedModel(model, export)
+        model.eval()
+
+    model.cpu_options = options
+    print(f"[info] CPU 推理配置: {options}")
+    return model
+
+
+def add_cpu_args(parser):
+    """命令行参数（model_server / inference_single_case / benchmark_cpu 共用）"""
+    parser.add_argument("--cpu_optimize", action="store_true", help="在 CPU 上运行时启用下列优化")
+    parser.add_argument("--no_quantize", action="store_true", help="不做动态 int8 量化")
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op 线程数，默认由 torch 决定")
+    parser.add_argument("--no_channels_last", action="store_true")
+    parser.add_argument("--export", type=str, default="none", choices=EXPORT_CHOICES)
+    return parser
+
+
+def cpu_options_from_args(args):
+    if not args.cpu_optimize:
+        return None
+    return {
+        "quantize": not args.no_quantize,
+        "num_threads": args.num_threads,
+        "channels_last": not args.no_channels_last,
+        "export": args.export,
+    }
@@ -2,105 +2,151 @@ import os
 import argparse
 import numpy as np
 import torch
-import nibabel as nib
 
 from model.Unimodel import Unified_Model
-
-
-def infer_num_classes_from_ckpt(state_dict, fallback=2):
+from model.Base_module import ATTN_BACKENDS, freeze_for_inference, set_attention_backend
+from cpu_inference import add_cpu_args, cpu_options_from_args, optimize_for_cpu
+from tiled_inference import add_tiling_args, predict_probs_tiled, tiling_from_args
+from token_pruning import add_pruning_args, predict_probs_pruned, pruning_from_args
+from precision import add_precision_args, apply_precision, cast_input, check_precision, inference_context
+from preprocessing import FIT_STRATEGIES, PreprocessCache, check_token_count, fit_to_input_size, token_count
+from checkpoint_manifest import load_manifest, load_state_dict
+from nifti_loader import NiftiCache, add_nifti_cache_args, configure_nifti_cache, load_volume, truncate_hu
+
+# 常驻服务中同一病例重复推理时复用预处理结果
+preprocess_cache = PreprocessCache(max_entries=8, max_bytes=1 << 30)
+# 解压后的原始体数据，跨进程 / 跨预处理参数复用（默认不启用）
+nifti_cache = NiftiCache(cache_dir=os.environ.get("MEDCOSS_NIFTI_CACHE_DIR"))
+
+
+def build_model(checkpoint_path, input_size, num_classes=None, device=None, cpu_options=None,
+                attn_backend="torch", attn_chunk_size=None, freeze_embeddings=True,
+                precision="fp32", precision_mode="autocast"):
     """
-    从 checkpoint 的线性层权重推断类别数（out_features）。
-    优先选择包含 head/fc/classifier 且 out!=in 的层，否则取 out!=in 的最小值，再退回最小 out。
+    cpu_options 不为空且运行在 CPU 上时，按 cpu_inference.optimize_for_cpu 做量化/导出；
+    attn_backend 选择自注意力实现（torch / sdpa / chunked），不影响权重加载；
+    freeze_embeddings 开启 embedding 的推理冻结模式（缓存位置编码）；
+    precision / precision_mode 见 precision.py。
+    类别数取自 checkpoint 清单（见 checkpoint_manifest.py，缺失或过期时自动生成），
+    权重在 CPU 上加载（优先 safetensors / mmap）后再搬到目标设备。
     """
-    candidates = []
-    for k, v in state_dict.items():
-        if not isinstance(v, torch.Tensor):
-            continue
-        if v.ndim == 2 and k.endswith("weight"):  # Linear: [out, in]
-            out_f, in_f = int(v.shape[0]), int(v.shape[1])
-            tag = "pri" if any(t in k.lower() for t in ["head", "classifier", "fc"]) else "sec"
-            candidates.append((tag, out_f, in_f, k))
-
-    if not candidates:
-        return int(fallback)
-
-    pri = [c for c in candidates if c[0] == "pri" and c[1] != c[2]]
-    if pri:
-        return int(pri[0][1])
-
-    diff = [c for c in candidates if c[1] != c[2]]
-    if diff:
-        diff.sort(key=lambda x: x[1])
-        return int(diff[0][1])
-
-    candidates.sort(key=lambda x: x[1])
-    return int(candidates[0][1])
-
-
-def build_model(checkpoint_path, input_size, num_classes=None, device=None):
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    check_precision(precision, precision_mode, device)
+    use_cpu_options = cpu_options is not None and torch.device(device).type == "cpu"
+    if use_cpu_options and precision != "fp32":
+        raise ValueError("CPU 量化推理只支持 fp32，不能与 bf16/fp16 同时使用")
 
-    ckpt = torch.load(checkpoint_path, map_location=device)
-    state = ckpt["model"] if isinstance(ckpt, dict) and "model" in ckpt else ckpt
-
-    actual_num_classes = num_classes if num_classes is not None else infer_num_classes_from_ckpt(state, fallback=2)
+    manifest = load_manifest(checkpoint_path)
+    actual_num_classes = num_classes if num_classes is not None else manifest["num_classes"]
     print(f"[info] 推断到 num_classes = {actual_num_classes}")
+    if manifest.get("input_size") and tuple(manifest["input_size"]) != tuple(input_size):
+        print(f"[warn] 输入尺寸 {tuple(input_size)} 与训练时 {tuple(manifest['input_size'])} 不一致")
 
     model = Unified_Model(now_3D_input_size=input_size, num_classes=actual_num_classes, pre_trained=False)
+    state, source = load_state_dict(checkpoint_path, manifest)
     msg = model.load_state_dict(state, strict=True)
-    print(f"[info] load_state_dict msg: {msg}")
+    del state
+    print(f"[info] load_state_dict msg: {msg}（{source}）")
     model.to(device)
     model.eval()
     if hasattr(model, "cal_acc"):
         model.cal_acc = False
+    if freeze_embeddings:
+        freeze_for_inference(model)
+    if attn_backend != "torch":
+        layers = set_attention_backend(model, attn_backend, attn_chunk_size)
+        print(f"[info] {layers} 层自注意力使用 {attn_backend}")
+    if use_cpu_options:
+        model = optimize_for_cpu(model, inplace=True, **cpu_options)
+    apply_precision(model, precision, precision_mode)
+    if precision != "fp32":
+        print(f"[info] 推理精度 {precision}（{precision_mode}）")
     return model, device, actual_num_classes
 
 
 def load_nifti_as_chw(nifti_path):
-    nii = nib.load(nifti_path)
-    image = nii.get_fdata()
-    image = image.transpose((2, 0, 1))  # [D,H,W]
-    return image
+    # 按原始数据类型读取，直接得到 float32 [D,H,W]，不经过 get_fdata 的 float64
+    return load_volume(nifti_path, cache=nifti_cache)
 
 
 def truncate_ct_like_dataset(image):
-    # 与 RICORD_Dataset.truncate 一致
-    min_HU = -1024
-    max_HU = 325
-    subtract = 158.58
-    divide = 324.70
-    image = np.clip(image, min_HU, max_HU)
-    image = (image - subtract) / divide
-    return image
-
-
-def preprocess_single_nifti(nifti_path, dataset):
-    img = load_nifti_as_chw(nifti_path)
-    if dataset == "ricord":
-        img = truncate_ct_like_dataset(img)
-    # [B,C,D,H,W]
-    img = img[np.newaxis, np.newaxis, :]
-    return img.astype(np.float32)
-
-
-def inference_single_case(nifti_path, checkpoint_path, input_size, dataset="custom", num_classes=None):
-    assert os.path.isfile(nifti_path), f"找不到文件 `{nifti_path}`"
-    assert os.path.isfile(checkpoint_path), f"找不到文件 `{checkpoint_path}`"
+    # 与 RICORD_Dataset.truncate 一致，float32 输入原地修改
+    return truncate_hu(image)
 
-    model, device, actual_num_classes = build_model(checkpoint_path, input_size, num_classes=num_classes)
 
-    x = preprocess_single_nifti(nifti_path, dataset)
-    x = torch.from_numpy(x).to(device)
+def preprocess_single_nifti(nifti_path, dataset, input_size=None, fit_strategy="resize", check_tokens=True):
+    """
+    读取并预处理单个病例，返回 [1,1,D,H,W] float32。
+    input_size 不为空时先按 fit_strategy 调整到模型输入尺寸（在原始值上做，再归一化），
+    结果按文件和参数缓存。滑窗模式保留原始尺寸，不检查整体 token 数（check_tokens=False）。
+    """
+    if input_size is None:
+        fit_strategy = "none"
+    key = preprocess_cache.make_key(
+        nifti_path, dataset, None if input_size is None else tuple(input_size), fit_strategy
+    )
+
+    def compute():
+        img = load_nifti_as_chw(nifti_path)
+        img = fit_to_input_size(img, input_size, fit_strategy)
+        if dataset == "ricord":
+            img = truncate_ct_like_dataset(img)
+        # [B,C,D,H,W]
+        img = img[np.newaxis, np.newaxis, :]
+        return np.ascontiguousarray(img, dtype=np.float32)
+
+    x = preprocess_cache.get_or_compute(key, compute)
+    if check_tokens:
+        check_token_count(x.shape)
+    return x
+
+
+def predict_probs(model, device, x, dataset="custom"):
+    """
+    对已预处理好的 [B,1,D,H,W] 数组做一次前向，返回 numpy 概率。
+    custom 为多标签（sigmoid），其余为 softmax。
+    """
+    x = cast_input(model, torch.from_numpy(x).to(device))
 
-    with torch.no_grad():
+    with inference_context(model, device):
         data = {"data": x, "modality": "3D image"}
-        logits = model(data)
+        logits = model(data).float()
         if dataset == "custom":
             probs = torch.sigmoid(logits)                  # 多标签
         else:
             probs = torch.softmax(logits, dim=1)           # 单/多类
         probs = probs.cpu().numpy()
+    return probs
+
+
+def inference_single_case(nifti_path, checkpoint_path, input_size, dataset="custom", num_classes=None,
+                          cpu_options=None, fit_strategy="resize", tiling=None, attn_backend="torch",
+                          pruning=None, precision="fp32", precision_mode="autocast"):
+    """
+    tiling 不为空时按原始分辨率滑窗分类，参数见 tiled_inference.predict_probs_tiled；
+    pruning 不为空时（单次前向模式）丢弃背景 token，参数见 token_pruning.predict_probs_pruned。
+    """
+    assert os.path.isfile(nifti_path), f"找不到文件 `{nifti_path}`"
+    assert os.path.isfile(checkpoint_path), f"找不到文件 `{checkpoint_path}`"
+
+    model, device, actual_num_classes = build_model(
+        checkpoint_path, input_size, num_classes=num_classes, cpu_options=cpu_options, attn_backend=attn_backend,
+        precision=precision, precision_mode=precision_mode
+    )
+
+    if tiling:
+        x = preprocess_single_nifti(nifti_path, dataset, fit_strategy="none", check_tokens=False)
+        probs, n_tiles = predict_probs_tiled(model, device, x, input_size, dataset, **tiling)
+        print(f"[info] 原始 shape={x.shape[2:]}，{n_tiles} 个窗口，聚合方式 {tiling['aggregation']}")
+    else:
+        x = preprocess_single_nifti(nifti_path, dataset, input_size=input_size, fit_strategy=fit_strategy)
+        print(f"[info] 输入 shape={x.shape[2:]}（{fit_strategy}），token 数={token_count(x.shape)}")
+        if pruning:
+            probs, report = predict_probs_pruned(model, device, x, dataset, **pruning)
+            print(f"[info] token 剪枝: {report}")
+        else:
+            probs = predict_probs(model, device, x, dataset)
 
     print(f"[done] num_classes={actual_num_classes}, probs shape={probs.shape}")
     print("probs:", probs[0])
@@ -108,25 +154,48 @@ def inference_single_case(nifti_path, checkpoint_path, input_size, dataset="cust
 
 
 def parse_args():
-    p = argparse.ArgumentParser(description="一致的推理脚本（单例）")
-    p.add_argument("--mode", type=str, default="single", choices=["single"])
+    p = argparse.ArgumentParser(description="一致的推理脚本（单例 / 批量）")
+    p.add_argument("--mode", type=str, default="single", choices=["single", "batch"])
     p.add_argument("--dataset", type=str, default="custom", choices=["custom", "ricord"])
-    p.add_argument("--nifti_path", type=str, required=True)
+    p.add_argument("--nifti_path", type=str, default=None, help="single 模式的病例")
     p.add_argument("--checkpoint_path", type=str, required=True)
     p.add_argument("--input_size", type=str, default="64,192,192")
     p.add_argument("--num_classes", type=int, default=None)
+    p.add_argument("--fit_strategy", type=str, default="resize", choices=FIT_STRATEGIES,
+                   help="把体数据调整到 input_size 的方式")
+    p.add_argument("--attn_backend", type=str, default="torch", choices=ATTN_BACKENDS)
+    add_tiling_args(p)
+    add_pruning_args(p)
+    add_precision_args(p)
+    add_cpu_args(p)
+    add_nifti_cache_args(p)
+    from batch_inference import add_batch_args
+    add_batch_args(p)
     return p.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
+    configure_nifti_cache(nifti_cache, args)
     d, h, w = map(int, args.input_size.split(","))
     input_size = (d, h, w)
 
-    inference_single_case(
-        nifti_path=args.nifti_path,
+    kwargs = dict(
         checkpoint_path=args.checkpoint_path,
         input_size=input_size,
         dataset=args.dataset,
-        num_classes=args.num_classes
-    )
\ No newline at end of file
+        num_classes=args.num_classes,
+        cpu_options=cpu_options_from_args(args),
+        fit_strategy=args.fit_strategy,
+        tiling=tiling_from_args(args),
+        attn_backend=args.attn_backend,
+        pruning=pruning_from_args(args),
+        precision=args.precision,
+        precision_mode=args.precision_mode
+    )
+    if args.mode == "batch":
+        from batch_inference import collect_cases, run_batch_inference
+        run_batch_inference(args, collect_cases(args), **kwargs)
+    else:
+        assert args.nifti_path, "single 模式需要 --nifti_path"
+        inference_single_case(nifti_path=args.nifti_path, **kwargs)
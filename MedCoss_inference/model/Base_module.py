@@ -114,6 +114,64 @@ def get_activation(activation_string):
             )
         )
 
+# 自注意力实现: torch 为 nn.MultiheadAttention 原实现（会生成完整的 [B*h, L, S] 注意力矩阵），
+# sdpa 走 F.scaled_dot_product_attention（torch>=2.0，可用 flash / memory-efficient 内核），
+# chunked 按 query 分块计算，峰值显存/内存约为 chunk_size / L。三者都直接使用 self_attn 的权重。
+ATTN_BACKENDS = ("torch", "sdpa", "chunked")
+ATTN_CHUNK_SIZE = 1024
+has_sdpa = hasattr(F, "scaled_dot_product_attention")
+
+
+def _additive_attn_mask(attn_mask, key_padding_mask, bs, num_heads, tgt_len, src_len, dtype):
+    """把 nn.MultiheadAttention 形式的 attn_mask / key_padding_mask 合并成加性 mask [B,h|1,L,S]"""
+    mask = None
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            attn_mask = torch.zeros_like(attn_mask, dtype=dtype).masked_fill(attn_mask, float("-inf"))
+        if attn_mask.dim() == 2:
+            mask = attn_mask.to(dtype).view(1, 1, tgt_len, src_len)
+        else:
+            mask = attn_mask.to(dtype).view(bs, num_heads, tgt_len, src_len)
+    if key_padding_mask is not None:
+        padding = torch.zeros((bs, 1, 1, src_len), dtype=dtype, device=key_padding_mask.device)
+        padding = padding.masked_fill(key_padding_mask.view(bs, 1, 1, src_len).bool(), float("-inf"))
+        mask = padding if mask is None else mask + padding
+    return mask
+
+
+def chunked_attention(q, k, v, mask=None, chunk_size=ATTN_CHUNK_SIZE, dropout_p=0.):
+    """q: [B,h,L,d]，k/v: [B,h,S,d]；每次只为 chunk_size 个 query 生成注意力矩阵"""
+    scale = q.shape[-1] ** -0.5
+    out = torch.empty_like(q)
+    for start in range(0, q.shape[2], chunk_size):
+        stop = start + chunk_size
+        scores = torch.matmul(q[:, :, start:stop] * scale, k.transpose(-2, -1))
+        if mask is not None:
+            scores = scores + (mask[:, :, start:stop] if mask.shape[2] > 1 else mask)
+        probs = torch.softmax(scores, dim=-1)
+        if dropout_p > 0.:
+            probs = F.dropout(probs, p=dropout_p)
+        out[:, :, start:stop] = torch.matmul(probs, v)
+    return out
+
+
+def set_attention_backend(model, backend="torch", chunk_size=None):
+    """切换模型中所有 TransformerEncoderLayer 的注意力实现，返回修改的层数；权重不受影响"""
+    if backend not in ATTN_BACKENDS:
+        raise ValueError(f"不支持的注意力实现: {backend}")
+    if backend == "sdpa" and not has_sdpa:
+        print(f"[warn] 当前 torch {torch.__version__} 没有 scaled_dot_product_attention，改用 chunked")
+        backend = "chunked"
+    count = 0
+    for module in model.modules():
+        if isinstance(module, TransformerEncoderLayer):
+            module.attn_backend = backend
+            if chunk_size:
+                module.attn_chunk_size = int(chunk_size)
+            count += 1
+    return count
+
+
 class TransformerEncoderLayer(nn.Module):
     r"""TransformerEncoderLayer is made up of self-attn and feedforward network.
     This standard encoder layer is based on the paper "Attention Is All You Need".
@@ -218,11 +276,15 @@ class TransformerEncoderLayer(nn.Module):
 
         self.activation = activation
         self.deep_prompt = None
+        self.attn_backend = "torch"
+        self.attn_chunk_size = ATTN_CHUNK_SIZE
 
 
     def __setstate__(self, state):
         if 'activation' not in state:
             state['activation'] = F.relu
+        state.setdefault('attn_backend', "torch")
+        state.setdefault('attn_chunk_size', ATTN_CHUNK_SIZE)
         super(TransformerEncoderLayer, self).__setstate__(state)
 
     def forward(self,
@@ -289,16 +351,57 @@ class TransformerEncoderLayer(nn.Module):
                 key_padding_mask = torch.cat(
                     [torch.zeros((bs, pe_length), dtype=key_padding_mask.dtype, device=key_padding_mask.device), key_padding_mask], dim=1)
 
-        x = self.self_attn(x, kv, kv,
-                           attn_mask=attn_mask,
-                           key_padding_mask=key_padding_mask,
-                           need_weights=False)[0]
+        if self.attn_backend == "torch":
+            x = self.self_attn(x, kv, kv,
+                               attn_mask=attn_mask,
+                               key_padding_mask=key_padding_mask,
+                               need_weights=False)[0]
+        else:
+            x = self._efficient_attention(x, kv, attn_mask, key_padding_mask)
         x = self.drop_path1(self.dropout1(x))
         if self.layer_scale:
             x = self.gamma_1 * x
         return x
 
 
+    def _efficient_attention(self, x: Tensor, kv: Tensor, attn_mask: Optional[Tensor],
+                             key_padding_mask: Optional[Tensor]) -> Tensor:
+        """与 self_attn(x, kv, kv) 等价（使用同一组 in_proj / out_proj 权重），不生成完整注意力矩阵"""
+        mha = self.self_attn
+        batch_first = self.batch_first and self._torch_nn_new_interface
+        self_attention = kv is x
+        if not batch_first:
+            x, kv = x.transpose(0, 1), kv.transpose(0, 1)
+
+        bs, tgt_len, embed_dim = x.shape
+        src_len = kv.shape[1]
+        num_heads = mha.num_heads
+        head_dim = embed_dim // num_heads
+
+        if self_attention:
+            qkv = F.linear(x, mha.in_proj_weight, mha.in_proj_bias)
+            q, k, v = qkv.view(bs, tgt_len, 3, num_heads, head_dim).permute(2, 0, 3, 1, 4).unbind(0)
+        else:
+            w_q, w_kv = mha.in_proj_weight.split([embed_dim, 2 * embed_dim])
+            if mha.in_proj_bias is not None:
+                b_q, b_kv = mha.in_proj_bias.split([embed_dim, 2 * embed_dim])
+            else:
+                b_q = b_kv = None
+            q = F.linear(x, w_q, b_q).view(bs, tgt_len, num_heads, head_dim).transpose(1, 2)
+            k, v = F.linear(kv, w_kv, b_kv).view(bs, src_len, 2, num_heads, head_dim).permute(2, 0, 3, 1, 4).unbind(0)
+
+        mask = _additive_attn_mask(attn_mask, key_padding_mask, bs, num_heads, tgt_len, src_len, q.dtype)
+        dropout_p = mha.dropout if self.training else 0.
+        if self.attn_backend == "sdpa" and has_sdpa:
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+        else:
+            out = chunked_attention(q, k, v, mask, chunk_size=self.attn_chunk_size, dropout_p=dropout_p)
+
+        out = mha.out_proj(out.transpose(1, 2).reshape(bs, tgt_len, embed_dim))
+        if not batch_first:
+            out = out.transpose(0, 1)
+        return out
+
     # feed forward block
     def _ff_block(self, x: Tensor, **kwargs) -> Tensor:
         x = self.linear2(self.dropout(self.activation(self.linear1(x))))
@@ -503,6 +606,7 @@ class VideoBaseEmbedding(nn.Module):
             self.random_temporal_pos)
         # self.embeddings_pos = None
         del self.embeddings
+        self.frozen = False
 
         self.embeddings = nn.Conv2d(3, out_dim, kernel_size=self.patch_size, stride=self.patch_size)
         self.embeddings_3D = nn.Conv3d(1, out_dim, kernel_size=self.patch_size, stride=self.patch_size)
@@ -531,7 +635,11 @@ class VideoBaseEmbedding(nn.Module):
             x = self.embeddings_3D(data)  # b*t, dim, 14, 14
             x = x.flatten(2)  # .flatten(2)
             # print(x.size())
-            embeddings = rearrange(x, '(b t s) c dhw -> b t dhw (s c)', b=bs, s=self.time_span)
+            if self.frozen and self.time_span == 1 and x.size(0) == bs:
+                # t = s = 1 时 rearrange 等价于转置，省去每次解析 einops 表达式
+                embeddings = x.transpose(1, 2).unsqueeze(1)
+            else:
+                embeddings = rearrange(x, '(b t s) c dhw -> b t dhw (s c)', b=bs, s=self.time_span)
             # print(embeddings.size())
             embeddings_pos = self.embeddings_st_pos_3D(embeddings).unsqueeze(
                 0).flatten(1, 2)
@@ -564,8 +672,39 @@ class Divide_ST_POS(nn.Module):
         self.spatial_pos_embed_index = 0 # sometimes image has cls_token
         self.max_frames = max_time_len
         self.random_temporal_pos = random_temporal_pos
+        # 推理冻结模式下按 (时间长度, 空间长度, dtype, device) 缓存合并后的位置编码
+        self.cache_enabled = False
+        self._pos_cache = {}
+        self._pos_cache_state = None
+
+    def _weights_state(self):
+        # 权重被替换（data_ptr 变化）或原地修改（_version 递增，如 load_state_dict）时缓存失效
+        return tuple((p.data_ptr(), p._version) for p in (self.spatial_pos_embed.weight, self.temporal_pos_embed.weight))
+
+    def clear_cache(self):
+        self._pos_cache = {}
+        self._pos_cache_state = None
+
+    def train(self, mode=True):
+        self.clear_cache()
+        return super(Divide_ST_POS, self).train(mode)
 
     def forward(self, x):
+        if self.cache_enabled and not self.training:
+            state = self._weights_state()
+            if state != self._pos_cache_state:
+                self.clear_cache()
+                self._pos_cache_state = state
+            key = (x.size(1), x.size(2), x.dtype, x.device)
+            pos_embed = self._pos_cache.get(key)
+            if pos_embed is None:
+                with torch.no_grad():
+                    pos_embed = self._compute(x)
+                self._pos_cache[key] = pos_embed
+            return pos_embed
+        return self._compute(x)
+
+    def _compute(self, x):
         dtype = x.dtype
         temp_len, spatial_size = x.size(1), x.size(2)
 
@@ -576,4 +715,23 @@ class Divide_ST_POS(nn.Module):
             temporal_pos_ids = torch.arange(temp_len, dtype=torch.long, device=x.device)
         pos_embed = self.temporal_pos_embed(temporal_pos_ids).unsqueeze(1).to(dtype=dtype) + \
             self.spatial_pos_embed(torch.arange(start= self.spatial_pos_embed_index, end=spatial_size +  self.spatial_pos_embed_index , dtype=torch.long, device=x.device)).unsqueeze(0).to(dtype=dtype)
-        return pos_embed
\ No newline at end of file
+        return pos_embed
+
+
+def freeze_for_inference(model, enabled=True):
+    """
+    embedding 部分的推理冻结模式: 参数不再求梯度，Divide_ST_POS 缓存合并后的位置编码，
+    VideoBaseEmbedding 在单帧 3D 输入上跳过 rearrange。
+    切回 train() 或权重变化时缓存自动失效。返回处理的 embedding 模块数。
+    """
+    count = 0
+    for module in model.modules():
+        if isinstance(module, VideoBaseEmbedding):
+            module.frozen = enabled
+            for p in module.parameters():
+                p.requires_grad_(not enabled)
+            count += 1
+        elif isinstance(module, Divide_ST_POS):
+            module.cache_enabled = enabled
+            module.clear_cache()
+    return count
@@ -0,0 +1,355 @@
+"""
+MedCoss 常驻推理服务。
+
+模型按 (checkpoint 路径, input_size, num_classes, 推理精度) 只加载一次，常驻 eval 模式，
+通过本地 socket（multiprocessing.connection）接收推理请求，
+避免 Django 每次诊断都重新 torch.load + 构建 Unified_Model。
+
+启动示例:
+    python model_server.py --checkpoint_path pth/checkpoint.pth --input_size 64,192,192 --num_classes 8
+    # 无 GPU 时: 动态 int8 量化 + 8 线程 + TorchScript
+    python model_server.py --checkpoint_path pth/checkpoint.pth --cpu_optimize --num_threads 8 --export torchscript
+
+协议: 客户端发送 dict，服务端返回 dict（ok=True/False）
+    {"cmd": "ping"}
+    {"cmd": "status"}
+    {"cmd": "infer", "nifti_path": ..., "checkpoint_path": ..., "input_size": [D,H,W],
+     "num_classes": 8, "dataset": "custom", "fit_strategy": "resize",
+     "tiling": None 或 False 或 {"overlap": 0.25, "max_tiles": 16, "aggregation": "max", "tile_batch_size": 4},
+     "pruning": None 或 False 或 {"min_fraction": 0.01, "drop_after": [4, 8], "keep_ratio": 0.7, "compare": False},
+     "precision": "fp32" / "bf16" / "fp16", "precision_mode": "autocast" / "cast"}
+    infer 的返回中 tokens 为实际前向的 token 总数，tiles 为滑窗模式的窗口数（单次前向为 1），
+    剪枝模式下 pruning 为保留的 token 数等信息。
+    tiling / pruning 为 None 或缺省时使用服务端启动参数，False 或 {} 表示本次请求关闭。
+"""
+import os
+import time
+import argparse
+import threading
+import traceback
+from multiprocessing.connection import Listener
+
+import numpy as np
+import torch
+
+from inference_single_case import build_model, preprocess_single_nifti, predict_probs, preprocess_cache, nifti_cache
+from preprocessing import FIT_STRATEGIES, token_count
+from nifti_loader import add_nifti_cache_args, configure_nifti_cache
+from tiled_inference import add_tiling_args, predict_probs_tiled, tiling_from_args
+from token_pruning import add_pruning_args, predict_probs_pruned, pruning_from_args
+from model.Base_module import ATTN_BACKENDS
+from precision import add_precision_args
+from cpu_inference import add_cpu_args, cpu_options_from_args
+from batching import BatchScheduler
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 6100
+DEFAULT_AUTHKEY = "padiagnosis-medcoss"
+
+
+def model_nbytes(model):
+    """state_dict 中所有张量占用的字节数（含动态量化后打包的 int8 权重）"""
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(v) for v in value)
+        return 0
+
+    return sum(nbytes(v) for v in model.state_dict().values())
+
+
+class LoadedModel:
+    """registry 中的一个常驻模型"""
+
+    def __init__(self, key, model, device, num_classes, load_seconds):
+        self.key = key
+        self.model = model
+        self.device = device
+        self.num_classes = num_classes
+        self.load_seconds = load_seconds
+        self.warmup_seconds = None
+        self.loaded_at = time.time()
+        self.requests = 0
+        self.total_infer_seconds = 0.0
+        # 同一模型的前向串行执行，避免多线程争抢显存
+        self.lock = threading.Lock()
+        # 请求统计由多个连接线程更新；不与 self.lock 共用，微批调度时不用等前向结束
+        self.stats_lock = threading.Lock()
+        self.scheduler = None
+
+    def run_batch(self, x, dataset):
+        with self.lock:
+            return predict_probs(self.model, self.device, x, dataset)
+
+    def run_pruned(self, x, dataset, pruning):
+        """剪枝后每个病例的 token 数不同，不经过微批调度器"""
+        with self.lock:
+            return predict_probs_pruned(self.model, self.device, x, dataset, **pruning)
+
+    def run_tiled(self, x, dataset, tiling):
+        """滑窗模式本身已按 batch 前向，不经过微批调度器"""
+        with self.lock:
+            return predict_probs_tiled(self.model, self.device, x, self.key[1], dataset, **tiling)
+
+    def record(self, seconds):
+        with self.stats_lock:
+            self.requests += 1
+            self.total_infer_seconds += seconds
+
+    def describe(self):
+        with self.stats_lock:
+            requests, total_infer_seconds = self.requests, self.total_infer_seconds
+        checkpoint_path, input_size, requested_classes, precision, precision_mode = self.key
+        info = {
+            "checkpoint_path": checkpoint_path,
+            "input_size": list(input_size),
+            "num_classes": self.num_classes,
+            "requested_num_classes": requested_classes,
+            "precision": precision,
+            "precision_mode": precision_mode,
+            "device": str(self.device),
+            "cpu_options": getattr(self.model, "cpu_options", None),
+            "param_bytes": model_nbytes(self.model),
+            "load_seconds": round(self.load_seconds, 3),
+            "warmup_seconds": None if self.warmup_seconds is None else round(self.warmup_seconds, 3),
+            "loaded_at": self.loaded_at,
+            "requests": requests,
+            "avg_infer_seconds": round(total_infer_seconds / requests, 4) if requests else None,
+            "batching": self.scheduler.stats() if self.scheduler is not None else None,
+        }
+        return info
+
+
+class ModelRegistry:
+    """按 checkpoint + 输入尺寸 + 类别数 + 推理精度缓存已加载的模型"""
+
+    def __init__(self, device=None, max_batch_size=4, max_wait_ms=20, cpu_options=None, fit_strategy="resize",
+                 tiling=None, attn_backend="torch", attn_chunk_size=None, pruning=None,
+                 precision="fp32", precision_mode="autocast"):
+        self.device = device
+        self.precision = precision
+        self.precision_mode = precision_mode
+        self.pruning = pruning
+        self.attn_backend = attn_backend
+        self.attn_chunk_size = attn_chunk_size
+        self.cpu_options = cpu_options
+        self.fit_strategy = fit_strategy
+        self.tiling = tiling
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def make_key(self, checkpoint_path, input_size, num_classes=None, precision=None, precision_mode=None):
+        return (
+            os.path.abspath(checkpoint_path),
+            tuple(int(v) for v in input_size),
+            None if num_classes is None else int(num_classes),
+            precision or self.precision,
+            precision_mode or self.precision_mode,
+        )
+
+    def get(self, checkpoint_path, input_size, num_classes=None, warmup=True, precision=None, precision_mode=None):
+        key = self.make_key(checkpoint_path, input_size, num_classes, precision, precision_mode)
+        entry = self._models.get(key)
+        if entry is not None:
+            return entry
+
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                return entry
+
+            assert os.path.isfile(key[0]), f"找不到文件 `{key[0]}`"
+            print(f"[info] 加载模型: {key}")
+            start = time.time()
+            model, device, actual_num_classes = build_model(
+                key[0], key[1], num_classes=key[2], device=self.device, cpu_options=self.cpu_options,
+                attn_backend=self.attn_backend, attn_chunk_size=self.attn_chunk_size,
+                precision=key[3], precision_mode=key[4],
+            )
+            entry = LoadedModel(key, model, device, actual_num_classes, time.time() - start)
+            if warmup:
+                self.warmup(entry)
+            entry.scheduler = BatchScheduler(
+                entry.run_batch, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms
+            )
+            self._models[key] = entry
+            return entry
+
+    def warmup(self, entry):
+        """用全零输入跑一次前向，触发 cudnn 选型 / 内存分配"""
+        start = time.time()
+        dummy = np.zeros((1, 1) + tuple(entry.key[1]), dtype=np.float32)
+        entry.run_batch(dummy, "custom")
+        entry.warmup_seconds = time.time() - start
+        print(f"[info] 预热完成: {entry.warmup_seconds:.2f}s")
+
+    def infer(self, nifti_path, checkpoint_path, input_size, dataset="custom", num_classes=None,
+              fit_strategy=None, tiling=None, pruning=None, precision=None, precision_mode=None):
+        assert os.path.isfile(nifti_path), f"找不到文件 `{nifti_path}`"
+        entry = self.get(
+            checkpoint_path, input_size, num_classes=num_classes, precision=precision, precision_mode=precision_mode
+        )
+        # None 使用服务端默认值，False / {} 表示本次请求关闭
+        tiling = self.tiling if tiling is None else tiling
+        pruning = self.pruning if pruning is None else pruning
+        report = None
+
+        start = time.time()
+        if tiling:
+            x = preprocess_single_nifti(nifti_path, dataset, fit_strategy="none", check_tokens=False)
+            probs, tiles = entry.run_tiled(x, dataset, tiling)
+            tokens = tiles * token_count(entry.key[1])
+        else:
+            x = preprocess_single_nifti(
+                nifti_path, dataset, input_size=entry.key[1], fit_strategy=fit_strategy or self.fit_strategy
+            )
+            tiles = 1
+            if pruning:
+                probs, report = entry.run_pruned(x, dataset, pruning)
+                tokens = report["tokens_kept"][0]
+            else:
+                # 并发请求在调度器中合并成 batch
+                probs = entry.scheduler.infer(x, dataset)[np.newaxis]
+                tokens = token_count(x.shape)
+        entry.record(time.time() - start)
+        return probs, entry, tokens, tiles, report
+
+    def status(self):
+        models = [entry.describe() for entry in list(self._models.values())]
+        info = {
+            "models": models,
+            "total_param_bytes": sum(m["param_bytes"] for m in models),
+            "pid": os.getpid(),
+            "fit_strategy": self.fit_strategy,
+            "tiling": self.tiling,
+            "attn_backend": self.attn_backend,
+            "pruning": self.pruning,
+            "preprocess_cache": preprocess_cache.stats(),
+            "nifti_cache": nifti_cache.stats(),
+        }
+        if torch.cuda.is_available():
+            info["cuda_memory_allocated"] = torch.cuda.memory_allocated()
+            info["cuda_max_memory_allocated"] = torch.cuda.max_memory_allocated()
+        return info
+
+
+class ModelServer:
+    """Listener 接收连接，每个连接一个线程，请求/响应均为 dict"""
+
+    def __init__(self, registry, host=DEFAULT_HOST, port=DEFAULT_PORT, authkey=DEFAULT_AUTHKEY):
+        self.registry = registry
+        self.address = (host, int(port))
+        self.authkey = authkey.encode() if isinstance(authkey, str) else authkey
+        self.started_at = time.time()
+
+    def handle(self, message):
+        cmd = message.get("cmd")
+        if cmd == "ping":
+            return {"ok": True}
+        if cmd == "status":
+            status = self.registry.status()
+            status["uptime_seconds"] = round(time.time() - self.started_at, 1)
+            return {"ok": True, "status": status}
+        if cmd == "infer":
+            probs, entry, tokens, tiles, report = self.registry.infer(
+                nifti_path=message["nifti_path"],
+                checkpoint_path=message["checkpoint_path"],
+                input_size=message["input_size"],
+                dataset=message.get("dataset", "custom"),
+                num_classes=message.get("num_classes"),
+                fit_strategy=message.get("fit_strategy"),
+                tiling=message.get("tiling"),
+                pruning=message.get("pruning"),
+                precision=message.get("precision"),
+                precision_mode=message.get("precision_mode"),
+            )
+            return {
+                "ok": True,
+                "probs": probs.tolist(),
+                "num_classes": entry.num_classes,
+                "tokens": tokens,
+                "tiles": tiles,
+                "pruning": report,
+            }
+        return {"ok": False, "error": f"未知命令: {cmd}"}
+
+    def _serve_connection(self, conn):
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    reply = self.handle(message)
+                except Exception as e:
+                    traceback.print_exc()
+                    reply = {"ok": False, "error": str(e)}
+                conn.send(reply)
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"[info] MedCoss 推理服务监听 {self.address[0]}:{self.address[1]}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"[warn] 连接握手失败: {e}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="MedCoss 常驻推理服务")
+    p.add_argument("--host", type=str, default=DEFAULT_HOST)
+    p.add_argument("--port", type=int, default=DEFAULT_PORT)
+    p.add_argument("--authkey", type=str, default=os.environ.get("MEDCOSS_SERVER_AUTHKEY", DEFAULT_AUTHKEY))
+    p.add_argument("--checkpoint_path", type=str, default=None, help="启动时预加载并预热的权重")
+    p.add_argument("--input_size", type=str, default="64,192,192")
+    p.add_argument("--num_classes", type=int, default=None)
+    p.add_argument("--max_batch_size", type=int, default=4, help="单次前向最多合并的病例数")
+    p.add_argument("--max_wait_ms", type=float, default=20, help="凑 batch 的最长等待时间")
+    p.add_argument("--fit_strategy", type=str, default="resize", choices=FIT_STRATEGIES,
+                   help="请求未指定时把体数据调整到 input_size 的方式")
+    p.add_argument("--attn_backend", type=str, default="torch", choices=ATTN_BACKENDS,
+                   help="自注意力实现，长序列时 sdpa / chunked 显著降低峰值显存")
+    p.add_argument("--attn_chunk_size", type=int, default=None, help="chunked 每块的 query 数")
+    add_tiling_args(p)
+    add_pruning_args(p)
+    p.add_argument("--preprocess_cache_size", type=int, default=8, help="缓存的预处理结果个数，0 为不缓存")
+    p.add_argument("--preprocess_cache_mb", type=int, default=1024, help="预处理结果缓存的总大小上限（MB）")
+    add_nifti_cache_args(p)
+    add_precision_args(p)
+    add_cpu_args(p)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    registry = ModelRegistry(
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        cpu_options=cpu_options_from_args(args),
+        fit_strategy=args.fit_strategy,
+        tiling=tiling_from_args(args),
+        attn_backend=args.attn_backend,
+        attn_chunk_size=args.attn_chunk_size,
+        pruning=pruning_from_args(args),
+        precision=args.precision,
+        precision_mode=args.precision_mode,
+    )
+    preprocess_cache.max_entries = args.preprocess_cache_size
+    preprocess_cache.max_bytes = args.preprocess_cache_mb << 20
+    configure_nifti_cache(nifti_cache, args)
+
+    if args.checkpoint_path:
+        d, h, w = map(int, args.input_size.split(","))
+        registry.get(args.checkpoint_path, (d, h, w), num_classes=args.num_classes)
+
+    ModelServer(registry, host=args.host, port=args.port, authkey=args.authkey).serve_forever()
@@ -0,0 +1,178 @@
+"""
+推理用的 NIfTI 快速读取。
+
+nii.get_fdata() 会把整个体数据升到 float64，之后的转置、clip、归一化和 astype(float32)
+又各产生一份整幅临时数组，512×512×300 的 CT 读一次就有数 GB 的瞬时分配。这里:
+1. 通过 dataobj 读取原始数据类型（int16 等）的未缩放数据；
+2. 转置视图一次性拷贝成连续的 float32，再原地乘 slope、加 inter；
+3. RICORD 的 clip / 归一化同样在这份 float32 数组上原地完成；
+4. 可选的磁盘缓存把 .nii.gz 解压后的原始数据存成 .npy，再次读取时 mmap，不再解压。
+"""
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+import nibabel as nib
+
+
+# 与 RICORD_Dataset.truncate 一致
+RICORD_MIN_HU = -1024
+RICORD_MAX_HU = 325
+RICORD_SUBTRACT = 158.58
+RICORD_DIVIDE = 324.70
+
+
+def read_native(nifti_path):
+    """返回 ([D,H,W] 原始数据类型的数组（转置视图）, slope, inter)"""
+    nii = nib.load(nifti_path)
+    proxy = nii.dataobj
+    if nib.is_proxy(proxy) and hasattr(proxy, "get_unscaled"):
+        raw = np.asarray(proxy.get_unscaled())
+        slope, inter = float(proxy.slope), float(proxy.inter)
+    else:
+        raw = np.asarray(proxy)
+        slope, inter = 1.0, 0.0
+    return raw.transpose((2, 0, 1)), slope, inter
+
+
+def to_float32(raw, slope=1.0, inter=0.0):
+    """一次拷贝得到连续的 float32 [D,H,W]，缩放原地完成"""
+    image = np.empty(raw.shape, dtype=np.float32)
+    np.copyto(image, raw, casting="unsafe")
+    if slope != 1.0:
+        np.multiply(image, np.float32(slope), out=image)
+    if inter != 0.0:
+        np.add(image, np.float32(inter), out=image)
+    return image
+
+
+def truncate_hu(image):
+    """RICORD 的 HU 截断和归一化，float32 输入原地修改"""
+    image = np.asarray(image, dtype=np.float32)
+    np.clip(image, RICORD_MIN_HU, RICORD_MAX_HU, out=image)
+    image -= np.float32(RICORD_SUBTRACT)
+    image /= np.float32(RICORD_DIVIDE)
+    return image
+
+
+class NiftiCache:
+    """
+    解压后原始数据的磁盘缓存，键为 (文件路径, 大小, 修改时间)。
+    每个病例存一个转置后的 [D,H,W] .npy（原始数据类型）和记录 slope / inter 的 .json，
+    读取时 mmap，只有转换成 float32 的那一份占用进程内存。
+    cache_dir 为空时不缓存；总大小超过 max_bytes 时按最近使用时间淘汰。
+    只缓存压缩文件（.nii.gz），未压缩的 .nii 由 nibabel 直接 mmap。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=8 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(self.cache_dir) and self.max_bytes > 0
+
+    def _paths(self, nifti_path):
+        stat = os.stat(nifti_path)
+        ident = f"{os.path.abspath(nifti_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        name = hashlib.sha1(ident.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, name)
+        return base + ".npy", base + ".json"
+
+    def read(self, nifti_path):
+        """返回 ([D,H,W] 原始数据类型数组, slope, inter)，必要时写入缓存"""
+        if not self.enabled or not nifti_path.endswith(".gz"):
+            return read_native(nifti_path)
+        npy_path, meta_path = self._paths(nifti_path)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            raw = np.load(npy_path, mmap_mode="r")
+            os.utime(npy_path)
+            with self._lock:
+                self.hits += 1
+            return raw, meta["slope"], meta["inter"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with self._lock:
+            self.misses += 1
+        raw, slope, inter = read_native(nifti_path)
+        try:
+            self._store(npy_path, meta_path, raw, slope, inter)
+        except OSError as e:
+            print(f"[warn] 写入 NIfTI 缓存失败: {e}")
+        return raw, slope, inter
+
+    def _store(self, npy_path, meta_path, raw, slope, inter):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(meta_path + suffix, "w", encoding="utf-8") as f:
+            json.dump({"slope": slope, "inter": inter}, f)
+        os.replace(meta_path + suffix, meta_path)
+        # 先写临时文件再替换，并发读取不会读到半个文件
+        with open(npy_path + suffix, "wb") as f:
+            np.save(f, np.ascontiguousarray(raw))
+        os.replace(npy_path + suffix, npy_path)
+        self.prune()
+
+    def _files(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def prune(self):
+        with self._lock:
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                for p in (path, path[:-len(".npy")] + ".json"):
+                    try:
+                        os.remove(p)
+                    except OSError:
+                        pass
+                total -= size
+
+    def stats(self):
+        info = {"cache_dir": self.cache_dir, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+        if self.enabled and os.path.isdir(self.cache_dir):
+            files = self._files()
+            info["entries"] = len(files)
+            info["bytes"] = sum(size for _, size, _ in files)
+        return info
+
+
+def load_volume(nifti_path, cache=None):
+    """读取为 float32 [D,H,W]（已按 slope / inter 缩放，与 get_fdata 的取值一致）"""
+    if cache is not None:
+        raw, slope, inter = cache.read(nifti_path)
+    else:
+        raw, slope, inter = read_native(nifti_path)
+    return to_float32(raw, slope, inter)
+
+
+def add_nifti_cache_args(parser):
+    parser.add_argument("--nifti_cache_dir", type=str, default=os.environ.get("MEDCOSS_NIFTI_CACHE_DIR"),
+                        help="解压后体数据的磁盘缓存目录，默认不缓存")
+    parser.add_argument("--nifti_cache_gb", type=float, default=8.0, help="磁盘缓存的总大小上限（GB）")
+    return parser
+
+
+def configure_nifti_cache(cache, args):
+    cache.cache_dir = args.nifti_cache_dir
+    cache.max_bytes = int(args.nifti_cache_gb * (1 << 30))
+    return cache
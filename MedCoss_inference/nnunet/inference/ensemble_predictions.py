@@ -17,6 +17,7 @@ import shutil
 from copy import deepcopy
 
 from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+from nnunet.inference.softmax_accumulator import SoftmaxAccumulator
 from batchgenerators.utilities.file_and_folder_operations import *
 import numpy as np
 from multiprocessing import Pool
@@ -25,9 +26,11 @@ from nnunet.postprocessing.connected_components import apply_postprocessing_to_f
 
 def merge_files(files, properties_files, out_file, override, store_npz):
     if override or not isfile(out_file):
-        softmax = [np.load(f)['softmax'][None] for f in files]
-        softmax = np.vstack(softmax)
-        softmax = np.mean(softmax, 0)
+        # running mean, only one softmax is in memory next to the accumulation buffer
+        accumulator = SoftmaxAccumulator()
+        for f in files:
+            accumulator.add(np.load(f)['softmax'], copy=False)
+        softmax = accumulator.mean()
         props = [load_pickle(f) for f in properties_files]
 
         reg_class_orders = [p['regions_class_order'] if 'regions_class_order' in p.keys() else None
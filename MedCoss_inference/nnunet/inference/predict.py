@@ -14,12 +14,16 @@
 
 
 import argparse
+import itertools
+import tempfile
 from copy import deepcopy
 from typing import Tuple, Union, List
 
 import numpy as np
 from batchgenerators.augmentations.utils import resize_segmentation
+from nnunet.network_architecture.neural_network import available_memory
 from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax, save_segmentation_nifti
+from nnunet.inference.softmax_accumulator import SoftmaxAccumulator
 from batchgenerators.utilities.file_and_folder_operations import *
 from multiprocessing import Process, Queue
 import torch
@@ -130,10 +134,128 @@ def preprocess_multithreaded(trainer, list_of_lists, output_files, num_processes
         q.close()
 
 
+ENSEMBLE_MODES = ("reload", "resident", "fold_major", "auto")
+
+
+def _network_bytes(network):
+    return sum(t.numel() * t.element_size() for t in itertools.chain(network.parameters(), network.buffers()))
+
+
+def choose_ensemble_mode(trainer, params, memory_fraction=0.25):
+    """
+    'resident' if the additional network copies (one per fold but the first) fit into memory_fraction of the free
+    device (or host) memory, 'fold_major' otherwise. The remaining memory is needed for the sliding window prediction
+    """
+    if len(params) < 2:
+        return "resident"
+    free = available_memory(trainer.network.get_device())
+    needed = _network_bytes(trainer.network) * (len(params) - 1)
+    if free is not None and needed <= free * memory_fraction:
+        return "resident"
+    return "fold_major"
+
+
+def load_fold_networks(trainer, params):
+    """one network per fold with the weights of that fold loaded once. The last fold reuses trainer.network"""
+    networks = []
+    for i, p in enumerate(params):
+        trainer.load_checkpoint_ram(p, False)
+        networks.append(trainer.network if i == len(params) - 1 else deepcopy(trainer.network))
+    return networks
+
+
+def _maybe_load(d):
+    if isinstance(d, str):
+        data = np.load(d)
+        os.remove(d)
+        d = data
+    return d
+
+
+def predict_ensemble(trainer, params, preprocessing, predict_kwargs: dict, ensemble_mode: str = "reload",
+                     spill_folder: str = None, accumulator_dtype=np.float32):
+    """
+    yields (output_filename, dct, softmax_mean, seg) for the cases coming out of preprocessing. seg is the
+    segmentation returned by the network if there is only one fold, None otherwise. The softmax of the folds is
+    averaged with a SoftmaxAccumulator of accumulator_dtype
+
+    ensemble_mode:
+    reload: the weights of every fold are loaded into trainer.network for every case (one state dict copy per fold and
+    case)
+    resident: one network per fold is kept in memory and reused for all cases
+    fold_major: all cases go through fold 0, then fold 1, ... so only one set of weights is needed at any time. The
+    preprocessed data and the running softmax sums are spilled to .npy memmaps in spill_folder, the cases are yielded
+    during the last fold
+    auto: resident if the network copies fit in memory, fold_major otherwise (see choose_ensemble_mode)
+    """
+    assert ensemble_mode in ENSEMBLE_MODES, "ensemble_mode must be one of %s" % str(ENSEMBLE_MODES)
+    if ensemble_mode == "auto":
+        ensemble_mode = choose_ensemble_mode(trainer, params)
+        print("ensemble mode:", ensemble_mode)
+    if ensemble_mode == "fold_major" and len(params) > 1:
+        for res in _predict_fold_major(trainer, params, preprocessing, predict_kwargs, spill_folder,
+                                       accumulator_dtype):
+            yield res
+        return
+
+    networks = load_fold_networks(trainer, params) if ensemble_mode != "reload" else None
+    for output_filename, (d, dct) in preprocessing:
+        d = _maybe_load(d)
+        print("predicting", output_filename)
+        if len(params) == 1:
+            if networks is None:
+                trainer.load_checkpoint_ram(params[0], False)
+            seg, softmax = trainer.predict_preprocessed_data_return_seg_and_softmax(d, **predict_kwargs)
+            yield output_filename, dct, softmax, seg
+            continue
+        accumulator = SoftmaxAccumulator(accumulator_dtype)
+        for i, p in enumerate(params):
+            if networks is None:
+                trainer.load_checkpoint_ram(p, False)
+            else:
+                trainer.network = networks[i]
+            accumulator.add(trainer.predict_preprocessed_data_return_seg_and_softmax(d, **predict_kwargs)[1],
+                            copy=False)
+        yield output_filename, dct, accumulator.mean(), None
+
+
+def _predict_fold_major(trainer, params, preprocessing, predict_kwargs, spill_folder, accumulator_dtype):
+    tmp = tempfile.mkdtemp(prefix="fold_major_", dir=spill_folder)
+    cases = []
+    try:
+        for i, p in enumerate(params):
+            trainer.load_checkpoint_ram(p, False)
+            for c, item in enumerate(preprocessing if i == 0 else list(cases)):
+                if i == 0:
+                    output_filename, (d, dct) = item
+                    data_file = join(tmp, "%d_data.npy" % c)
+                    # keep the preprocessed data for the next folds
+                    if isinstance(d, str):
+                        shutil.move(d, data_file)
+                    else:
+                        np.save(data_file, d)
+                    accumulator = SoftmaxAccumulator(accumulator_dtype, join(tmp, "%d_softmax.npy" % c))
+                    cases.append((output_filename, dct, data_file, accumulator))
+                else:
+                    output_filename, dct, data_file, accumulator = item
+                d = np.load(data_file, mmap_mode='r')
+                print("predicting", output_filename, "with fold %d of %d" % (i + 1, len(params)))
+                accumulator.add(trainer.predict_preprocessed_data_return_seg_and_softmax(d, **predict_kwargs)[1])
+                del d
+                if i == len(params) - 1:
+                    os.remove(data_file)
+                    yield output_filename, dct, accumulator.mean(), None
+                else:
+                    # only the mapping of the case that is being predicted stays open
+                    accumulator.release()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
 def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_threads_preprocessing,
                   num_threads_nifti_save, segs_from_prev_stage=None, do_tta=True, mixed_precision=True, overwrite_existing=False,
                   all_in_gpu=False, step_size=0.5, checkpoint_name="model_final_checkpoint",
-                  segmentation_export_kwargs: dict = None):
+                  segmentation_export_kwargs: dict = None, ensemble_mode: str = "reload"):
     """
     :param segmentation_export_kwargs:
     :param model: folder where the model is saved, must contain fold_x subfolders
@@ -148,6 +270,8 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
     :param do_tta: default: True, can be set to False for a 8x speedup at the cost of a reduced segmentation quality
     :param overwrite_existing: default: True
     :param mixed_precision: if None then we take no action. If True/False we overwrite what the model has in its init
+    :param ensemble_mode: how the folds are applied to the cases: reload, resident, fold_major or auto, see
+    predict_ensemble
     :return:
     """
     assert len(list_of_lists) == len(output_filenames)
@@ -202,27 +326,13 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
     preprocessing = preprocess_multithreaded(trainer, list_of_lists, cleaned_output_files, num_threads_preprocessing,
                                              segs_from_prev_stage)
     print("starting prediction...")
-    all_output_files = []
-    for preprocessed in preprocessing:
-        output_filename, (d, dct) = preprocessed
-        all_output_files.append(all_output_files)
-        if isinstance(d, str):
-            data = np.load(d)
-            os.remove(d)
-            d = data
-
-        print("predicting", output_filename)
-        softmax = []
-        for p in params:
-            trainer.load_checkpoint_ram(p, False)
-            softmax.append(trainer.predict_preprocessed_data_return_seg_and_softmax(
-                d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
-                step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
-                mixed_precision=mixed_precision)[1][None])
-
-        softmax = np.vstack(softmax)
-        softmax_mean = np.mean(softmax, 0)
-
+    predict_kwargs = dict(do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'],
+                          use_sliding_window=True, step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
+                          mixed_precision=mixed_precision)
+    # fold_major spills next to the output files
+    spill_folder = os.path.dirname(cleaned_output_files[0]) or None if len(cleaned_output_files) > 0 else None
+    for output_filename, dct, softmax_mean, _ in predict_ensemble(trainer, params, preprocessing, predict_kwargs,
+                                                                  ensemble_mode, spill_folder):
         transpose_forward = trainer.plans.get('transpose_forward')
         if transpose_forward is not None:
             transpose_backward = trainer.plans.get('transpose_backward')
@@ -290,7 +400,7 @@ def predict_cases_fast(model, list_of_lists, output_filenames, folds, num_thread
                        num_threads_nifti_save, segs_from_prev_stage=None, do_tta=True, mixed_precision=True,
                        overwrite_existing=False,
                        all_in_gpu=False, step_size=0.5, checkpoint_name="model_final_checkpoint",
-                       segmentation_export_kwargs: dict = None):
+                       segmentation_export_kwargs: dict = None, ensemble_mode: str = "reload"):
     assert len(list_of_lists) == len(output_filenames)
     if segs_from_prev_stage is not None: assert len(segs_from_prev_stage) == len(output_filenames)
 
@@ -343,47 +453,19 @@ def predict_cases_fast(model, list_of_lists, output_filenames, folds, num_thread
                                              segs_from_prev_stage)
 
     print("starting prediction...")
-    for preprocessed in preprocessing:
-        print("getting data from preprocessor")
-        output_filename, (d, dct) = preprocessed
-        print("got something")
-        if isinstance(d, str):
-            print("what I got is a string, so I need to load a file")
-            data = np.load(d)
-            os.remove(d)
-            d = data
-
-        # preallocate the output arrays
-        # same dtype as the return value in predict_preprocessed_data_return_seg_and_softmax (saves time)
-        softmax_aggr = None  # np.zeros((trainer.num_classes, *d.shape[1:]), dtype=np.float16)
-        all_seg_outputs = np.zeros((len(params), *d.shape[1:]), dtype=int)
-        print("predicting", output_filename)
-
-        for i, p in enumerate(params):
-            trainer.load_checkpoint_ram(p, False)
-
-            res = trainer.predict_preprocessed_data_return_seg_and_softmax(d, do_mirroring=do_tta,
-                                                                           mirror_axes=trainer.data_aug_params['mirror_axes'],
-                                                                           use_sliding_window=True,
-                                                                           step_size=step_size, use_gaussian=True,
-                                                                           all_in_gpu=all_in_gpu,
-                                                                           mixed_precision=mixed_precision)
-
-            if len(params) > 1:
-                # otherwise we dont need this and we can save ourselves the time it takes to copy that
-                print("aggregating softmax")
-                if softmax_aggr is None:
-                    softmax_aggr = res[1]
-                else:
-                    softmax_aggr += res[1]
-            all_seg_outputs[i] = res[0]
-
+    predict_kwargs = dict(do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'],
+                          use_sliding_window=True, step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
+                          mixed_precision=mixed_precision)
+    # fold_major spills next to the output files
+    spill_folder = os.path.dirname(cleaned_output_files[0]) or None if len(cleaned_output_files) > 0 else None
+    # only the argmax is needed, so the folds are summed in the dtype of the prediction
+    for output_filename, dct, softmax_mean, seg in predict_ensemble(trainer, params, preprocessing, predict_kwargs,
+                                                                    ensemble_mode, spill_folder,
+                                                                    accumulator_dtype=None):
         print("obtaining segmentation map")
-        if len(params) > 1:
-            # we dont need to normalize the softmax by 1 / len(params) because this would not change the outcome of the argmax
-            seg = softmax_aggr.argmax(0)
-        else:
-            seg = all_seg_outputs[0]
+        if seg is None:
+            seg = softmax_mean.argmax(0)
+        del softmax_mean
 
         print("applying transpose_backward")
         transpose_forward = trainer.plans.get('transpose_forward')
@@ -478,7 +560,7 @@ def predict_cases_fastest(model, list_of_lists, output_filenames, folds, num_thr
 
         # preallocate the output arrays
         # same dtype as the return value in predict_preprocessed_data_return_seg_and_softmax (saves time)
-        all_softmax_outputs = np.zeros((len(params), trainer.num_classes, *d.shape[1:]), dtype=np.float16)
+        accumulator = SoftmaxAccumulator()
         all_seg_outputs = np.zeros((len(params), *d.shape[1:]), dtype=int)
         print("predicting", output_filename)
 
@@ -491,14 +573,14 @@ def predict_cases_fastest(model, list_of_lists, output_filenames, folds, num_thr
                                                                            all_in_gpu=all_in_gpu,
                                                                            mixed_precision=mixed_precision)
             if len(params) > 1:
-                # otherwise we dont need this and we can save ourselves the time it takes to copy that
-                all_softmax_outputs[i] = res[1]
+                # otherwise we dont need this and we can save ourselves the time it takes to copy that. The softmax
+                # is rounded to float16 as it was when all folds were stored in one float16 array
+                accumulator.add(res[1].astype(np.float16, copy=False), copy=False)
             all_seg_outputs[i] = res[0]
 
         print("aggregating predictions")
         if len(params) > 1:
-            softmax_mean = np.mean(all_softmax_outputs, 0)
-            seg = softmax_mean.argmax(0)
+            seg = accumulator.mean().argmax(0)
         else:
             seg = all_seg_outputs[0]
 
@@ -583,7 +665,7 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                         part_id: int, num_parts: int, tta: bool, mixed_precision: bool = True,
                         overwrite_existing: bool = True, mode: str = 'normal', overwrite_all_in_gpu: bool = None,
                         step_size: float = 0.5, checkpoint_name: str = "model_final_checkpoint",
-                        segmentation_export_kwargs: dict = None):
+                        segmentation_export_kwargs: dict = None, ensemble_mode: str = "reload"):
     """
         here we use the standard naming scheme to generate list_of_lists and output_files needed by predict_cases
 
@@ -600,6 +682,7 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
     :param tta:
     :param mixed_precision:
     :param overwrite_existing: if not None then it will be overwritten with whatever is in there. None is default (no overwrite)
+    :param ensemble_mode: reload, resident, fold_major or auto (see predict_ensemble). Has no effect if mode=fastest
     :return:
     """
     maybe_mkdir_p(output_folder)
@@ -635,7 +718,7 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                              save_npz, num_threads_preprocessing, num_threads_nifti_save, lowres_segmentations, tta,
                              mixed_precision=mixed_precision, overwrite_existing=overwrite_existing, all_in_gpu=all_in_gpu,
                              step_size=step_size, checkpoint_name=checkpoint_name,
-                             segmentation_export_kwargs=segmentation_export_kwargs)
+                             segmentation_export_kwargs=segmentation_export_kwargs, ensemble_mode=ensemble_mode)
     elif mode == "fast":
         if overwrite_all_in_gpu is None:
             all_in_gpu = True
@@ -647,7 +730,7 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                                   num_threads_preprocessing, num_threads_nifti_save, lowres_segmentations,
                                   tta, mixed_precision=mixed_precision, overwrite_existing=overwrite_existing, all_in_gpu=all_in_gpu,
                                   step_size=step_size, checkpoint_name=checkpoint_name,
-                                  segmentation_export_kwargs=segmentation_export_kwargs)
+                                  segmentation_export_kwargs=segmentation_export_kwargs, ensemble_mode=ensemble_mode)
     elif mode == "fastest":
         if overwrite_all_in_gpu is None:
             all_in_gpu = True
@@ -724,6 +807,11 @@ if __name__ == "__main__":
     parser.add_argument("--mode", type=str, default="normal", required=False)
     parser.add_argument("--all_in_gpu", type=str, default="None", required=False, help="can be None, False or True")
     parser.add_argument("--step_size", type=float, default=0.5, required=False, help="don't touch")
+    parser.add_argument("--ensemble_mode", type=str, default="reload", required=False, choices=ENSEMBLE_MODES,
+                        help="reload: load the weights of every fold for every case. resident: keep one network per "
+                             "fold in memory. fold_major: predict all cases with one fold after the other, spilling "
+                             "the softmax sums to disk. auto: resident if it fits in memory, else fold_major. Has no "
+                             "effect if mode=fastest")
     # parser.add_argument("--interp_order", required=False, default=3, type=int,
     #                     help="order of interpolation for segmentations, has no effect if mode=fastest")
     # parser.add_argument("--interp_order_z", required=False, default=0, type=int,
@@ -803,4 +891,5 @@ if __name__ == "__main__":
 
     predict_from_folder(model, input_folder, output_folder, folds, save_npz, num_threads_preprocessing,
                         num_threads_nifti_save, lowres_segmentations, part_id, num_parts, tta, mixed_precision=not args.disable_mixed_precision,
-                        overwrite_existing=overwrite, mode=mode, overwrite_all_in_gpu=all_in_gpu, step_size=step_size)
+                        overwrite_existing=overwrite, mode=mode, overwrite_all_in_gpu=all_in_gpu, step_size=step_size,
+                        ensemble_mode=args.ensemble_mode)
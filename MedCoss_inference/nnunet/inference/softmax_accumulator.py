@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+
+class SoftmaxAccumulator(object):
+    """
+    Running mean of softmax predictions (folds of an ensemble, merged models) in a single buffer. This replaces
+    np.mean(np.vstack(softmaxes), 0): the predictions are added one at a time and in place, so the peak memory is one
+    buffer plus the prediction being added instead of n_predictions x classes x volume.
+
+    With the default dtype (float32) the predictions are summed sequentially in float32 and the mean is cast back to
+    the dtype of the first prediction, which is exactly what np.mean does on the stacked array (it accumulates float16
+    in float32 as well), so the results are identical. dtype=np.float16 halves the buffer at the cost of precision,
+    dtype=None accumulates in the dtype of the predictions (enough if only the argmax is needed).
+
+    If filename is given the buffer is a .npy memmap on disk. release() drops the mapping between adds (for example
+    when many cases are accumulated at the same time, see predict._predict_fold_major), the next add reopens it.
+    """
+    def __init__(self, dtype=np.float32, filename: str = None):
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.filename = filename
+        self.count = 0
+        self.result_dtype = None
+        self._buffer = None
+
+    def add(self, softmax: np.ndarray, copy: bool = True):
+        """
+        adds one prediction. With copy=False the first prediction may be taken over as the buffer (no copy) if it
+        already has the right dtype, it must not be used by the caller afterwards
+        """
+        if self.count == 0:
+            self.result_dtype = softmax.dtype
+            if self.dtype is None:
+                self.dtype = softmax.dtype
+            if self.filename is not None:
+                self._buffer = np.lib.format.open_memmap(self.filename, mode='w+', dtype=self.dtype,
+                                                         shape=softmax.shape)
+                self._buffer[:] = softmax
+            elif not copy and softmax.dtype == self.dtype:
+                self._buffer = softmax
+            else:
+                self._buffer = softmax.astype(self.dtype)
+        else:
+            if self._buffer is None:
+                self._buffer = np.load(self.filename, mmap_mode='r+')
+            assert self._buffer.shape == softmax.shape, "shape mismatch: %s vs %s" % (str(self._buffer.shape),
+                                                                                      str(softmax.shape))
+            np.add(self._buffer, softmax, out=self._buffer)
+        self.count += 1
+
+    def release(self):
+        """flushes a memmapped buffer to disk and closes the mapping"""
+        if self.filename is not None and self._buffer is not None:
+            self._buffer.flush()
+            self._buffer = None
+
+    def mean(self) -> np.ndarray:
+        """
+        the mean of all predictions added so far, in the dtype of the first one. The division is done in place, the
+        accumulator cannot be used any more afterwards. A memmapped buffer is read into memory and its file removed
+        """
+        assert self.count > 0, "no predictions were added"
+        if self._buffer is None:
+            self._buffer = np.load(self.filename, mmap_mode='r')
+        if self.filename is not None:
+            result = np.divide(self._buffer, self.count, dtype=self.dtype)
+        else:
+            result = self._buffer
+            if self.count > 1:
+                result /= self.count
+        result = np.asarray(result).astype(self.result_dtype, copy=False)
+        self.close()
+        return result
+
+    def close(self):
+        """drops the buffer and removes a memmapped file"""
+        self._buffer = None
+        if self.filename is not None and os.path.isfile(self.filename):
+            os.remove(self.filename)
+        self.count = 0
@@ -13,10 +13,13 @@
 #    limitations under the License.
 
 
+import itertools
+
 import numpy as np
 from batchgenerators.augmentations.utils import pad_nd_image
 from nnunet.utilities.random_stuff import no_op
 from nnunet.utilities.to_torch import to_cuda, maybe_to_torch
+from nnunet.network_architecture.tile_pipeline import TilePipeline
 from torch import nn
 import torch
 from scipy.ndimage.filters import gaussian_filter
@@ -25,16 +28,48 @@ from typing import Union, Tuple, List
 from torch.cuda.amp import autocast
 
 
+def _available_host_memory():
+    """MemAvailable from /proc/meminfo in bytes, None if it cannot be read"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def available_memory(device):
+    """free bytes on device ("cpu" or a cuda device index), None if it cannot be determined"""
+    if device == "cpu":
+        return _available_host_memory()
+    if hasattr(torch.cuda, "mem_get_info"):
+        free = torch.cuda.mem_get_info(device)[0]
+    else:
+        free = torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+    # memory held by the caching allocator but not in use is free for us as well
+    return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+
 class NeuralNetwork(nn.Module):
     def __init__(self):
         super(NeuralNetwork, self).__init__()
 
     def get_device(self):
-        if next(self.parameters()).device == "cpu":
+        # compare the device type, torch.device("cpu") == "cpu" is False in older torch versions
+        if next(self.parameters()).device.type == "cpu":
             return "cpu"
         else:
             return next(self.parameters()).device.index
 
+    def _to_device(self, data):
+        """moves tensors to the GPU the network lives on, leaves them alone if the network runs on the CPU"""
+        device = self.get_device()
+        if device == "cpu":
+            return data
+        return to_cuda(data, gpu_id=device)
+
     def set_device(self, device):
         if device == "cpu":
             self.cpu()
@@ -46,6 +81,11 @@ class NeuralNetwork(nn.Module):
 
 
 class SegmentationNetwork(NeuralNetwork):
+    # rough upper bound of the inference activation memory per input voxel of one tile (Generic_UNet, float32,
+    # including the mirroring buffers). Used to derive the number of tiles per forward pass from the free memory
+    tile_bytes_per_voxel = 1024
+    max_tile_batch_size = 8
+
     def __init__(self):
         super(NeuralNetwork, self).__init__()
 
@@ -70,12 +110,17 @@ class SegmentationNetwork(NeuralNetwork):
         self._gaussian_3d = self._patch_size_for_gaussian_3d = None
         self._gaussian_2d = self._patch_size_for_gaussian_2d = None
 
+        # per stage timings of the last pipelined sliding window prediction (see tile_pipeline.py)
+        self.last_tile_pipeline_stats = None
+
     def predict_3D(self, x: np.ndarray, do_mirroring: bool, mirror_axes: Tuple[int, ...] = (0, 1, 2),
                    use_sliding_window: bool = False,
                    step_size: float = 0.5, patch_size: Tuple[int, ...] = None, regions_class_order: Tuple[int, ...] = None,
                    use_gaussian: bool = False, pad_border_mode: str = "constant",
                    pad_kwargs: dict = None, all_in_gpu: bool = False,
-                   verbose: bool = True, mixed_precision: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+                   verbose: bool = True, mixed_precision: bool = True,
+                   num_threads: int = None, tile_batch_size: int = None,
+                   pipelined: bool = False) -> Tuple[np.ndarray, np.ndarray]:
         """
         Use this function to predict a 3D image. It does not matter whether the network is a 2D or 3D U-Net, it will
         detect that automatically and run the appropriate code.
@@ -105,17 +150,26 @@ class SegmentationNetwork(NeuralNetwork):
         :param pad_kwargs: leave this alone
         :param all_in_gpu: experimental. You probably want to leave this as is it
         :param verbose: Do you want a wall of text? If yes then set this to True
-        :param mixed_precision: if True, will run inference in mixed precision with autocast()
+        :param mixed_precision: if True, will run inference in mixed precision with autocast(). Ignored on the CPU,
+        CPU inference always runs in float32
+        :param num_threads: number of intra-op threads used for CPU inference (torch.set_num_threads). None keeps the
+        current setting. Ignored on the GPU
+        :param tile_batch_size: (Only applies to sliding window prediction) number of tiles that go through the network
+        in one forward pass. None picks it from the free memory of the device
+        :param pipelined: (Only applies to 3D sliding window prediction) overlap tile extraction, the forward passes and
+        the aggregation in separate threads with bounded queues (tile_pipeline.py). Stage timings are stored in
+        self.last_tile_pipeline_stats
         :return:
         """
         torch.cuda.empty_cache()
+        on_cpu = self.get_device() == "cpu"
 
         assert step_size <= 1, 'step_size must be smaller than 1. Otherwise there will be a gap between consecutive ' \
                                'predictions'
 
         if verbose: print("debug: mirroring", do_mirroring, "mirror_axes", mirror_axes)
 
-        assert self.get_device() != "cpu", "CPU not implemented"
+        assert not on_cpu or self.conv_op == nn.Conv3d, "CPU inference is only implemented for 3D networks"
 
         if pad_kwargs is None:
             pad_kwargs = {'constant_values': 0}
@@ -135,32 +189,43 @@ class SegmentationNetwork(NeuralNetwork):
 
         assert len(x.shape) == 4, "data must have shape (c,x,y,z)"
 
-        if mixed_precision:
+        if mixed_precision and not on_cpu:
             context = autocast
         else:
             context = no_op
 
-        with context():
-            with torch.no_grad():
-                if self.conv_op == nn.Conv3d:
-                    if use_sliding_window:
-                        res = self._internal_predict_3D_3Dconv_tiled(x, step_size, do_mirroring, mirror_axes, patch_size,
-                                                                     regions_class_order, use_gaussian, pad_border_mode,
-                                                                     pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu,
-                                                                     verbose=verbose)
+        prev_threads = torch.get_num_threads()
+        if on_cpu and num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        try:
+            with context():
+                with torch.no_grad():
+                    if self.conv_op == nn.Conv3d:
+                        if use_sliding_window:
+                            res = self._internal_predict_3D_3Dconv_tiled(x, step_size, do_mirroring, mirror_axes, patch_size,
+                                                                         regions_class_order, use_gaussian, pad_border_mode,
+                                                                         pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu,
+                                                                         verbose=verbose, tile_batch_size=tile_batch_size,
+                                                                         pipelined=pipelined)
+                        else:
+                            res = self._internal_predict_3D_3Dconv(x, patch_size, do_mirroring, mirror_axes, regions_class_order,
+                                                                   pad_border_mode, pad_kwargs=pad_kwargs, verbose=verbose)
+                    elif self.conv_op == nn.Conv2d:
+                        if use_sliding_window:
+                            res = self._internal_predict_3D_2Dconv_tiled(x, patch_size, do_mirroring, mirror_axes, step_size,
+                                                                         regions_class_order, use_gaussian, pad_border_mode,
+                                                                         pad_kwargs, all_in_gpu, False,
+                                                                         tile_batch_size=tile_batch_size)
+                        else:
+                            res = self._internal_predict_3D_2Dconv(x, patch_size, do_mirroring, mirror_axes, regions_class_order,
+                                                                   pad_border_mode, pad_kwargs, all_in_gpu, False)
                     else:
-                        res = self._internal_predict_3D_3Dconv(x, patch_size, do_mirroring, mirror_axes, regions_class_order,
-                                                               pad_border_mode, pad_kwargs=pad_kwargs, verbose=verbose)
-                elif self.conv_op == nn.Conv2d:
-                    if use_sliding_window:
-                        res = self._internal_predict_3D_2Dconv_tiled(x, patch_size, do_mirroring, mirror_axes, step_size,
-                                                                     regions_class_order, use_gaussian, pad_border_mode,
-                                                                     pad_kwargs, all_in_gpu, False)
-                    else:
-                        res = self._internal_predict_3D_2Dconv(x, patch_size, do_mirroring, mirror_axes, regions_class_order,
-                                                               pad_border_mode, pad_kwargs, all_in_gpu, False)
-                else:
-                    raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the network is")
+                        raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the network is")
+        finally:
+            # restore the thread count even if the prediction raises
+            if on_cpu and num_threads is not None:
+                torch.set_num_threads(prev_threads)
 
         return res
 
@@ -168,7 +233,8 @@ class SegmentationNetwork(NeuralNetwork):
                    step_size: float = 0.5, patch_size: tuple = None, regions_class_order: tuple = None,
                    use_gaussian: bool = False, pad_border_mode: str = "constant",
                    pad_kwargs: dict = None, all_in_gpu: bool = False,
-                   verbose: bool = True, mixed_precision: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+                   verbose: bool = True, mixed_precision: bool = True,
+                   tile_batch_size: int = None) -> Tuple[np.ndarray, np.ndarray]:
         """
         Use this function to predict a 2D image. If this is a 3D U-Net it will crash because you cannot predict a 2D
         image with that (you dummy).
@@ -237,7 +303,8 @@ class SegmentationNetwork(NeuralNetwork):
                     if use_sliding_window:
                         res = self._internal_predict_2D_2Dconv_tiled(x, step_size, do_mirroring, mirror_axes, patch_size,
                                                                      regions_class_order, use_gaussian, pad_border_mode,
-                                                                     pad_kwargs, all_in_gpu, verbose)
+                                                                     pad_kwargs, all_in_gpu, verbose,
+                                                                     tile_batch_size=tile_batch_size)
                     else:
                         res = self._internal_predict_2D_2Dconv(x, patch_size, do_mirroring, mirror_axes, regions_class_order,
                                                                pad_border_mode, pad_kwargs, verbose)
@@ -288,18 +355,49 @@ class SegmentationNetwork(NeuralNetwork):
 
         return steps
 
+    def _auto_tile_batch_size(self, patch_size, num_tiles, memory_fraction=0.5) -> int:
+        """
+        number of tiles per forward pass such that the estimated activation memory (tile_bytes_per_voxel) stays below
+        memory_fraction of the currently free device (or host) memory
+        """
+        free = available_memory(self.get_device())
+        if free is None:
+            return 1
+        per_tile = int(np.prod(patch_size)) * self.tile_bytes_per_voxel
+        return int(max(1, min(free * memory_fraction // per_tile, self.max_tile_batch_size, num_tiles)))
+
+    @staticmethod
+    def _iterate_tile_batches(data, steps, patch_size, tile_batch_size):
+        """
+        yields (tiles, slicers): tiles is a (b, c, *patch_size) batch cut from data (c, *spatial, np.ndarray or
+        torch.Tensor), slicers are the spatial slices of each tile (without the channel axis)
+        """
+        slicers = [tuple(slice(lb, lb + p) for lb, p in zip(lbs, patch_size)) for lbs in itertools.product(*steps)]
+        for i in range(0, len(slicers), tile_batch_size):
+            batch_slicers = slicers[i:i + tile_batch_size]
+            tiles = [data[(slice(None),) + s] for s in batch_slicers]
+            if isinstance(data, torch.Tensor):
+                yield torch.stack(tiles), batch_slicers
+            else:
+                yield np.stack(tiles), batch_slicers
+
     def _internal_predict_3D_3Dconv_tiled(self, x: np.ndarray, step_size: float, do_mirroring: bool, mirror_axes: tuple,
                                           patch_size: tuple, regions_class_order: tuple, use_gaussian: bool,
                                           pad_border_mode: str, pad_kwargs: dict, all_in_gpu: bool,
-                                          verbose: bool) -> Tuple[np.ndarray, np.ndarray]:
+                                          verbose: bool, tile_batch_size: int = None,
+                                          pipelined: bool = False) -> Tuple[np.ndarray, np.ndarray]:
         # better safe than sorry
         assert len(x.shape) == 4, "x must be (c, x, y, z)"
-        assert self.get_device() != "cpu"
         if verbose: print("step_size:", step_size)
         if verbose: print("do mirror:", do_mirroring)
 
         assert patch_size is not None, "patch_size cannot be None for tiled prediction"
 
+        # on the CPU the network output already is a CPU tensor, so we accumulate in float32 torch tensors (same code
+        # path as all_in_gpu, without half precision). This saves the per-tile .cpu().numpy() copy
+        on_cpu = self.get_device() == "cpu"
+        keep_on_device = all_in_gpu or on_cpu
+
         # for sliding window inference the image must at least be as large as the patch size. It does not matter
         # whether the shape is divisible by 2**num_pool as long as the patch size is
         data, slicer = pad_nd_image(x, patch_size, pad_border_mode, pad_kwargs, True, None)
@@ -329,20 +427,22 @@ class SegmentationNetwork(NeuralNetwork):
                 if verbose: print("using precomputed Gaussian")
                 gaussian_importance_map = self._gaussian_3d
 
-            gaussian_importance_map = torch.from_numpy(gaussian_importance_map).cuda(self.get_device(),
-                                                                                     non_blocking=True)
+            gaussian_importance_map = self._to_device(torch.from_numpy(gaussian_importance_map))
 
         else:
             gaussian_importance_map = None
 
-        if all_in_gpu:
+        if keep_on_device:
             # If we run the inference in GPU only (meaning all tensors are allocated on the GPU, this reduces
-            # CPU-GPU communication but required more GPU memory) we need to preallocate a few things on GPU
+            # CPU-GPU communication but required more GPU memory) we need to preallocate a few things on GPU.
+            # On the CPU we keep float32 so that the result matches the non all_in_gpu GPU path
+            device = torch.device("cpu") if on_cpu else torch.device("cuda", self.get_device())
+            accumulation_dtype = torch.float if on_cpu else torch.half
 
             if use_gaussian and num_tiles > 1:
                 # half precision for the outputs should be good enough. If the outputs here are half, the
                 # gaussian_importance_map should be as well
-                gaussian_importance_map = gaussian_importance_map.half()
+                gaussian_importance_map = gaussian_importance_map.to(accumulation_dtype)
 
                 # make sure we did not round anything to 0
                 gaussian_importance_map[gaussian_importance_map == 0] = gaussian_importance_map[
@@ -350,18 +450,18 @@ class SegmentationNetwork(NeuralNetwork):
 
                 add_for_nb_of_preds = gaussian_importance_map
             else:
-                add_for_nb_of_preds = torch.ones(data.shape[1:], device=self.get_device())
+                add_for_nb_of_preds = torch.ones(data.shape[1:], device=device)
 
-            if verbose: print("initializing result array (on GPU)")
-            aggregated_results = torch.zeros([self.num_classes] + list(data.shape[1:]), dtype=torch.half,
-                                             device=self.get_device())
+            if verbose: print("initializing result array (on %s)" % device)
+            aggregated_results = torch.zeros([self.num_classes] + list(data.shape[1:]), dtype=accumulation_dtype,
+                                             device=device)
 
-            if verbose: print("moving data to GPU")
-            data = torch.from_numpy(data).cuda(self.get_device(), non_blocking=True)
+            if verbose: print("moving data to %s" % device)
+            data = self._to_device(torch.from_numpy(data).float())
 
-            if verbose: print("initializing result_numsamples (on GPU)")
-            aggregated_nb_of_predictions = torch.zeros([self.num_classes] + list(data.shape[1:]), dtype=torch.half,
-                                                       device=self.get_device())
+            if verbose: print("initializing result_numsamples (on %s)" % device)
+            aggregated_nb_of_predictions = torch.zeros([self.num_classes] + list(data.shape[1:]),
+                                                       dtype=accumulation_dtype, device=device)
         else:
             if use_gaussian and num_tiles > 1:
                 add_for_nb_of_preds = self._gaussian_3d
@@ -370,27 +470,31 @@ class SegmentationNetwork(NeuralNetwork):
             aggregated_results = np.zeros([self.num_classes] + list(data.shape[1:]), dtype=np.float32)
             aggregated_nb_of_predictions = np.zeros([self.num_classes] + list(data.shape[1:]), dtype=np.float32)
 
-        for x in steps[0]:
-            lb_x = x
-            ub_x = x + patch_size[0]
-            for y in steps[1]:
-                lb_y = y
-                ub_y = y + patch_size[1]
-                for z in steps[2]:
-                    lb_z = z
-                    ub_z = z + patch_size[2]
-
-                    predicted_patch = self._internal_maybe_mirror_and_pred_3D(
-                        data[None, :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z], mirror_axes, do_mirroring,
-                        gaussian_importance_map)[0]
-
-                    if all_in_gpu:
-                        predicted_patch = predicted_patch.half()
-                    else:
-                        predicted_patch = predicted_patch.cpu().numpy()
+        if tile_batch_size is None:
+            tile_batch_size = self._auto_tile_batch_size(patch_size, num_tiles)
+        if verbose: print("tiles per forward pass:", tile_batch_size)
+
+        if pipelined:
+            pipeline = TilePipeline(self, data, steps, patch_size, tile_batch_size, aggregated_results,
+                                    aggregated_nb_of_predictions, add_for_nb_of_preds, mirror_axes, do_mirroring,
+                                    gaussian_importance_map)
+            pipeline.run()
+            self.last_tile_pipeline_stats = pipeline.stats()
+            if verbose: print("pipeline stages:", self.last_tile_pipeline_stats)
+        else:
+            # tiles are predicted in batches (one forward pass per batch and mirror) and scattered back one by one
+            for tiles, slicers in self._iterate_tile_batches(data, steps, patch_size, tile_batch_size):
+                predicted_patches = self._internal_maybe_mirror_and_pred_3D(tiles, mirror_axes, do_mirroring,
+                                                                            gaussian_importance_map)
+
+                if keep_on_device:
+                    predicted_patches = predicted_patches.to(aggregated_results.dtype)
+                else:
+                    predicted_patches = predicted_patches.cpu().numpy()
 
-                    aggregated_results[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += predicted_patch
-                    aggregated_nb_of_predictions[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add_for_nb_of_preds
+                for predicted_patch, s in zip(predicted_patches, slicers):
+                    aggregated_results[(slice(None),) + s] += predicted_patch
+                    aggregated_nb_of_predictions[(slice(None),) + s] += add_for_nb_of_preds
 
         # we reverse the padding here (remeber that we padded the input to be at least as large as the patch size
         slicer = tuple(
@@ -405,7 +509,7 @@ class SegmentationNetwork(NeuralNetwork):
         if regions_class_order is None:
             predicted_segmentation = class_probabilities.argmax(0)
         else:
-            if all_in_gpu:
+            if keep_on_device:
                 class_probabilities_here = class_probabilities.detach().cpu().numpy()
             else:
                 class_probabilities_here = class_probabilities
@@ -413,8 +517,8 @@ class SegmentationNetwork(NeuralNetwork):
             for i, c in enumerate(regions_class_order):
                 predicted_segmentation[class_probabilities_here[i] > 0.5] = c
 
-        if all_in_gpu:
-            if verbose: print("copying results to CPU")
+        if keep_on_device:
+            if verbose and not on_cpu: print("copying results to CPU")
 
             if regions_class_order is None:
                 predicted_segmentation = predicted_segmentation.detach().cpu().numpy()
@@ -468,7 +572,6 @@ class SegmentationNetwork(NeuralNetwork):
         This one does fully convolutional inference. No sliding window
         """
         assert len(x.shape) == 4, "x must be (c, x, y, z)"
-        assert self.get_device() != "cpu"
         assert self.input_shape_must_be_divisible_by is not None, 'input_shape_must_be_divisible_by must be set to ' \
                                                                   'run _internal_predict_3D_3Dconv'
         if verbose: print("do mirror:", do_mirroring)
@@ -503,12 +606,12 @@ class SegmentationNetwork(NeuralNetwork):
         # everything in here takes place on the GPU. If x and mult are not yet on GPU this will be taken care of here
         # we now return a cuda tensor! Not numpy array!
 
-        x = to_cuda(maybe_to_torch(x), gpu_id=self.get_device())
-        result_torch = torch.zeros([1, self.num_classes] + list(x.shape[2:]),
-                                   dtype=torch.float).cuda(self.get_device(), non_blocking=True)
+        x = self._to_device(maybe_to_torch(x))
+        result_torch = torch.zeros([x.shape[0], self.num_classes] + list(x.shape[2:]), dtype=torch.float,
+                                   device=x.device)
 
         if mult is not None:
-            mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
+            mult = self._to_device(maybe_to_torch(mult))
 
         if do_mirroring:
             mirror_idx = 8
@@ -605,7 +708,7 @@ class SegmentationNetwork(NeuralNetwork):
     def _internal_predict_2D_2Dconv_tiled(self, x: np.ndarray, step_size: float, do_mirroring: bool, mirror_axes: tuple,
                                           patch_size: tuple, regions_class_order: tuple, use_gaussian: bool,
                                           pad_border_mode: str, pad_kwargs: dict, all_in_gpu: bool,
-                                          verbose: bool) -> Tuple[np.ndarray, np.ndarray]:
+                                          verbose: bool, tile_batch_size: int = None) -> Tuple[np.ndarray, np.ndarray]:
         # better safe than sorry
         assert len(x.shape) == 3, "x must be (c, x, y)"
         assert self.get_device() != "cpu"
@@ -683,24 +786,22 @@ class SegmentationNetwork(NeuralNetwork):
             aggregated_results = np.zeros([self.num_classes] + list(data.shape[1:]), dtype=np.float32)
             aggregated_nb_of_predictions = np.zeros([self.num_classes] + list(data.shape[1:]), dtype=np.float32)
 
-        for x in steps[0]:
-            lb_x = x
-            ub_x = x + patch_size[0]
-            for y in steps[1]:
-                lb_y = y
-                ub_y = y + patch_size[1]
+        if tile_batch_size is None:
+            tile_batch_size = self._auto_tile_batch_size(patch_size, num_tiles)
+        if verbose: print("tiles per forward pass:", tile_batch_size)
 
-                predicted_patch = self._internal_maybe_mirror_and_pred_2D(
-                    data[None, :, lb_x:ub_x, lb_y:ub_y], mirror_axes, do_mirroring,
-                    gaussian_importance_map)[0]
+        for tiles, slicers in self._iterate_tile_batches(data, steps, patch_size, tile_batch_size):
+            predicted_patches = self._internal_maybe_mirror_and_pred_2D(tiles, mirror_axes, do_mirroring,
+                                                                        gaussian_importance_map)
 
-                if all_in_gpu:
-                    predicted_patch = predicted_patch.half()
-                else:
-                    predicted_patch = predicted_patch.cpu().numpy()
+            if all_in_gpu:
+                predicted_patches = predicted_patches.half()
+            else:
+                predicted_patches = predicted_patches.cpu().numpy()
 
-                aggregated_results[:, lb_x:ub_x, lb_y:ub_y] += predicted_patch
-                aggregated_nb_of_predictions[:, lb_x:ub_x, lb_y:ub_y] += add_for_nb_of_preds
+            for predicted_patch, s in zip(predicted_patches, slicers):
+                aggregated_results[(slice(None),) + s] += predicted_patch
+                aggregated_nb_of_predictions[(slice(None),) + s] += add_for_nb_of_preds
 
         # we reverse the padding here (remeber that we padded the input to be at least as large as the patch size
         slicer = tuple(
@@ -789,7 +890,7 @@ class SegmentationNetwork(NeuralNetwork):
                                           regions_class_order: tuple = None, use_gaussian: bool = False,
                                           pad_border_mode: str = "edge", pad_kwargs: dict =None,
                                           all_in_gpu: bool = False,
-                                          verbose: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+                                          verbose: bool = True, tile_batch_size: int = None) -> Tuple[np.ndarray, np.ndarray]:
         if all_in_gpu:
             raise NotImplementedError
 
@@ -801,7 +902,7 @@ class SegmentationNetwork(NeuralNetwork):
         for s in range(x.shape[1]):
             pred_seg, softmax_pres = self._internal_predict_2D_2Dconv_tiled(
                 x[:, s], step_size, do_mirroring, mirror_axes, patch_size, regions_class_order, use_gaussian,
-                pad_border_mode, pad_kwargs, all_in_gpu, verbose)
+                pad_border_mode, pad_kwargs, all_in_gpu, verbose, tile_batch_size=tile_batch_size)
 
             predicted_segmentation.append(pred_seg[None])
             softmax_pred.append(softmax_pres[None])
@@ -0,0 +1,233 @@
+"""
+Pipelined execution of the sliding window loop in SegmentationNetwork._internal_predict_3D_3Dconv_tiled.
+
+Three stages connected by bounded queues:
+1. producer thread: cuts tile batches out of the padded input, converts them to float tensors and pins them in
+   page-locked memory when the network runs on the GPU, so the host-to-device copy can be asynchronous
+2. compute (calling thread, so the no_grad / autocast contexts of predict_3D apply): runs the network including
+   mirroring and the Gaussian weighting, then starts an asynchronous copy of the result back to the host
+3. aggregation threads: wait for that copy and add every tile into the output buffers. The buffers are split into
+   slabs along the first spatial axis, each guarded by its own lock, so several threads can add overlapping tiles at
+   the same time (a thread never holds more than one slab lock). numpy / torch release the GIL for these adds
+
+Every stage records how long it was busy and how long it waited on its queues, see TilePipeline.stats(). On the GPU
+the network runs asynchronously: the compute stage only measures the kernel launches, the time spent waiting for the
+device shows up as device_wait_s of the aggregation stage.
+"""
+import os
+import queue
+import threading
+import time
+
+import torch
+
+_DONE = object()
+
+
+class _StageTimer(object):
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.busy = 0.
+        self.wait = 0.
+        self.device_wait = 0.
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add(self, busy=0., wait=0., items=0, device_wait=0.):
+        with self._lock:
+            self.busy += busy
+            self.wait += wait
+            self.items += items
+            self.device_wait += device_wait
+
+
+class TilePipeline(object):
+    def __init__(self, network, data, steps, patch_size, tile_batch_size, aggregated_results,
+                 aggregated_nb_of_predictions, add_for_nb_of_preds, mirror_axes, do_mirroring,
+                 gaussian_importance_map=None, queue_size: int = 2, aggregation_threads: int = None,
+                 slab_size: int = None):
+        self.network = network
+        self.data = data
+        self.steps = steps
+        self.patch_size = patch_size
+        self.tile_batch_size = tile_batch_size
+        self.aggregated_results = aggregated_results
+        self.aggregated_nb_of_predictions = aggregated_nb_of_predictions
+        self.add_for_nb_of_preds = add_for_nb_of_preds
+        self.mirror_axes = mirror_axes
+        self.do_mirroring = do_mirroring
+        self.gaussian_importance_map = gaussian_importance_map
+
+        self.on_gpu = network.get_device() != "cpu"
+        # results aggregated on the GPU (all_in_gpu) are added in stream order, more threads would not help
+        self.buffers_on_gpu = isinstance(aggregated_results, torch.Tensor) and aggregated_results.is_cuda
+        if aggregation_threads is None:
+            aggregation_threads = 1 if self.buffers_on_gpu else min(4, os.cpu_count() or 1)
+        self.aggregation_threads = max(1, int(aggregation_threads))
+        if slab_size is None:
+            slab_size = max(1, patch_size[0] // 4)
+        self.slab_size = int(slab_size)
+        num_slabs = (aggregated_results.shape[1] + self.slab_size - 1) // self.slab_size
+        self._slab_locks = [threading.Lock() for _ in range(num_slabs)]
+
+        self._tiles = queue.Queue(maxsize=queue_size)
+        self._predictions = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._errors = []
+        self._timers = {
+            "producer": _StageTimer(),
+            "compute": _StageTimer(),
+            "aggregation": _StageTimer(self.aggregation_threads),
+        }
+        self._wall = 0.
+
+    def _put(self, q, item, timer):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        timer.add(wait=time.perf_counter() - start)
+
+    def _get(self, q, timer):
+        start = time.perf_counter()
+        item = q.get()
+        timer.add(wait=time.perf_counter() - start)
+        return item
+
+    def _produce(self):
+        timer = self._timers["producer"]
+        try:
+            batches = self.network._iterate_tile_batches(self.data, self.steps, self.patch_size, self.tile_batch_size)
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    tiles, slicers = next(batches)
+                except StopIteration:
+                    break
+                if not isinstance(tiles, torch.Tensor):
+                    tiles = torch.from_numpy(tiles).float()
+                    if self.on_gpu:
+                        tiles = tiles.pin_memory()
+                timer.add(busy=time.perf_counter() - start, items=len(slicers))
+                self._put(self._tiles, (tiles, slicers), timer)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._put_done(self._tiles, 1)
+
+    def _put_done(self, q, n):
+        # the consumer may have stopped reading, so never block here
+        for _ in range(n):
+            while True:
+                try:
+                    q.put(_DONE, timeout=0.1)
+                    break
+                except queue.Full:
+                    if self._stop.is_set():
+                        try:
+                            q.get_nowait()
+                        except queue.Empty:
+                            pass
+
+    def _compute(self):
+        timer = self._timers["compute"]
+        try:
+            while True:
+                item = self._get(self._tiles, timer)
+                if item is _DONE or self._stop.is_set():
+                    break
+                start = time.perf_counter()
+                tiles, slicers = item
+                predicted = self.network._internal_maybe_mirror_and_pred_3D(tiles, self.mirror_axes,
+                                                                            self.do_mirroring,
+                                                                            self.gaussian_importance_map)
+                event = None
+                if isinstance(self.aggregated_results, torch.Tensor):
+                    predicted = predicted.to(self.aggregated_results.dtype)
+                elif predicted.is_cuda:
+                    host = torch.empty(predicted.shape, dtype=predicted.dtype, pin_memory=True)
+                    host.copy_(predicted, non_blocking=True)
+                    event = torch.cuda.Event()
+                    event.record()
+                    predicted = host
+                timer.add(busy=time.perf_counter() - start, items=len(slicers))
+                self._put(self._predictions, (predicted, event, slicers), timer)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._put_done(self._predictions, self.aggregation_threads)
+
+    def _add(self, patch, slicer):
+        x = slicer[0]
+        for slab in range(x.start // self.slab_size, (x.stop - 1) // self.slab_size + 1):
+            lb = max(x.start, slab * self.slab_size)
+            ub = min(x.stop, (slab + 1) * self.slab_size)
+            local = slice(lb - x.start, ub - x.start)
+            region = (slice(None), slice(lb, ub)) + tuple(slicer[1:])
+            with self._slab_locks[slab]:
+                self.aggregated_results[region] += patch[:, local]
+                self.aggregated_nb_of_predictions[region] += self.add_for_nb_of_preds[local]
+
+    def _aggregate(self):
+        timer = self._timers["aggregation"]
+        try:
+            while True:
+                item = self._get(self._predictions, timer)
+                if item is _DONE:
+                    break
+                if self._stop.is_set():
+                    continue
+                predicted, event, slicers = item
+                if event is not None:
+                    start = time.perf_counter()
+                    event.synchronize()
+                    timer.add(device_wait=time.perf_counter() - start)
+                start = time.perf_counter()
+                if not isinstance(self.aggregated_results, torch.Tensor):
+                    predicted = predicted.numpy()
+                for patch, slicer in zip(predicted, slicers):
+                    self._add(patch, slicer)
+                timer.add(busy=time.perf_counter() - start, items=len(slicers))
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def run(self):
+        start = time.perf_counter()
+        producer = threading.Thread(target=self._produce, name="tile-producer", daemon=True)
+        aggregators = [threading.Thread(target=self._aggregate, name="tile-aggregation-%d" % i, daemon=True)
+                       for i in range(self.aggregation_threads)]
+        producer.start()
+        for t in aggregators:
+            t.start()
+        self._compute()
+        producer.join()
+        for t in aggregators:
+            t.join()
+        if self.buffers_on_gpu:
+            torch.cuda.synchronize()
+        self._wall = time.perf_counter() - start
+        if self._errors:
+            raise self._errors[0]
+        return self.aggregated_results, self.aggregated_nb_of_predictions
+
+    def stats(self) -> dict:
+        """busy / wait seconds and utilization (busy time per worker relative to the wall time) of every stage"""
+        wall = max(self._wall, 1e-9)
+        res = {"wall_s": round(self._wall, 4)}
+        for name, timer in self._timers.items():
+            res[name] = {
+                "workers": timer.workers,
+                "busy_s": round(timer.busy, 4),
+                "wait_s": round(timer.wait, 4),
+                "tiles": timer.items,
+                "utilization": round(timer.busy / (wall * timer.workers), 3),
+            }
+            if timer.device_wait:
+                res[name]["device_wait_s"] = round(timer.device_wait, 4)
+        return res
@@ -0,0 +1,68 @@
+"""
+推理精度设置（fp32 / bf16 / fp16）。
+
+- autocast: 权重保持 fp32，前向在 torch.autocast 下运行，矩阵乘法等算子自动降精度；
+- cast: 权重和输入整体转换为目标精度，显存占用减半，数值偏差略大。
+CPU 上 autocast 只支持 bf16；fp16 需要 CUDA。
+build_model 把设置记录在 model.inference_precision 上，predict_probs / 滑窗 / 剪枝推理
+统一通过 inference_context 进入 torch.inference_mode（及 autocast）。
+"""
+import contextlib
+
+import torch
+
+
+PRECISIONS = ("fp32", "bf16", "fp16")
+PRECISION_MODES = ("autocast", "cast")
+DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def check_precision(precision, mode, device):
+    if precision not in PRECISIONS:
+        raise ValueError(f"不支持的推理精度: {precision}")
+    if mode not in PRECISION_MODES:
+        raise ValueError(f"不支持的精度模式: {mode}")
+    if precision == "fp16" and torch.device(device).type != "cuda":
+        raise ValueError("fp16 推理需要 CUDA，CPU 上请使用 bf16")
+
+
+def apply_precision(model, precision="fp32", mode="autocast"):
+    """cast 模式下转换权重精度，并在模型上记录精度设置"""
+    if precision != "fp32" and mode == "cast":
+        model.to(DTYPES[precision])
+    model.inference_precision = (precision, mode)
+    return model
+
+
+def inference_context(model, device):
+    """
+    torch.inference_mode，autocast 模式下再叠加 torch.autocast。
+    TorchScript / torch.compile 导出的模型在 inference_mode 下 trace 会失败，仍使用 no_grad。
+    """
+    precision, mode = getattr(model, "inference_precision", ("fp32", "autocast"))
+    stack = contextlib.ExitStack()
+    if getattr(model, "export", "none") != "none":
+        stack.enter_context(torch.no_grad())
+    else:
+        stack.enter_context(torch.inference_mode())
+    if precision != "fp32" and mode == "autocast":
+        stack.enter_context(torch.autocast(device_type=torch.device(device).type, dtype=DTYPES[precision]))
+    return stack
+
+
+def cast_input(model, x):
+    """cast 模式下输入与权重保持同一精度"""
+    precision, mode = getattr(model, "inference_precision", ("fp32", "autocast"))
+    if precision != "fp32" and mode == "cast":
+        return x.to(DTYPES[precision])
+    return x
+
+
+def add_precision_args(parser):
+    parser.add_argument("--precision", type=str, default="fp32", choices=PRECISIONS)
+    parser.add_argument("--precision_mode", type=str, default="autocast", choices=PRECISION_MODES)
+    return parser
@@ -0,0 +1,171 @@
+"""
+把任意扫描尺寸的 [D,H,W] 体数据调整到模型输入尺寸 now_3D_input_size。
+
+VideoBaseEmbedding 以 16³ 为一个 patch，token 数 = (D/16)·(H/16)·(W/16)，
+注意力开销与 token 数平方成正比，且不能超过 spatial_pos_embed 的 4096 个位置。
+固定输入尺寸后（如 64×192×192 → 576 个 token）开销与扫描仪输出无关，
+同 shape 的病例也能在 batching.BatchScheduler 中合并成一个 batch。
+
+策略:
+- resize: 三线性插值整体缩放到目标尺寸（默认，与训练时预先 resize 的数据一致）；
+- center_crop: 各轴居中裁剪，不足处用最小值补齐，不改变体素间距；
+- bbox_crop: 先按体表掩膜裁掉空气/床板，再缩放到目标尺寸；
+- none: 不做调整（旧行为），只检查 token 数。
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+PATCH_SIZE = 16
+MAX_TOKENS = 4096  # (256 / 16)^3，即 spatial_pos_embed 的大小
+FIT_STRATEGIES = ("resize", "center_crop", "bbox_crop", "none")
+
+BODY_THRESHOLD_HU = -500.0  # 高于该值视为人体（CT）
+BODY_MIN_FRACTION = 0.001   # 每层掩膜体素占比低于该值视为噪声
+BODY_MARGIN = 4             # bbox 四周保留的体素数
+
+
+def token_count(shape, patch_size=PATCH_SIZE):
+    """[D,H,W] 输入经 patch embedding 后的 token 数"""
+    d, h, w = (int(s) // patch_size for s in shape[-3:])
+    return d * h * w
+
+
+def check_token_count(shape, patch_size=PATCH_SIZE):
+    tokens = token_count(shape, patch_size)
+    if tokens == 0:
+        raise ValueError(f"输入尺寸 {tuple(shape[-3:])} 小于一个 patch（{patch_size}）")
+    if tokens > MAX_TOKENS:
+        raise ValueError(f"输入尺寸 {tuple(shape[-3:])} 对应 {tokens} 个 token，超过位置编码上限 {MAX_TOKENS}")
+    return tokens
+
+
+def resize_volume(image, input_size):
+    if tuple(image.shape) == tuple(input_size):
+        return image
+    x = torch.from_numpy(np.ascontiguousarray(image, dtype=np.float32))[None, None]
+    x = F.interpolate(x, size=tuple(input_size), mode="trilinear", align_corners=False)
+    return x[0, 0].numpy()
+
+
+def center_crop_or_pad(image, input_size, pad_value=None):
+    if pad_value is None:
+        pad_value = float(image.min()) if image.size else 0.0
+    out = np.full(tuple(input_size), pad_value, dtype=image.dtype)
+    src, dst = [], []
+    for size, target in zip(image.shape, input_size):
+        if size >= target:
+            start = (size - target) // 2
+            src.append(slice(start, start + target))
+            dst.append(slice(0, target))
+        else:
+            start = (target - size) // 2
+            src.append(slice(0, size))
+            dst.append(slice(start, start + size))
+    out[tuple(dst)] = image[tuple(src)]
+    return out
+
+
+def body_bbox(image, threshold=None, min_fraction=BODY_MIN_FRACTION, margin=BODY_MARGIN):
+    """
+    体表掩膜的包围盒，返回每个轴的 slice。
+    CT（最小值低于 -500 HU）按 HU 阈值；其他数据按最小值到 99 分位数的 10% 处。
+    """
+    if threshold is None:
+        low = float(image.min())
+        if low < BODY_THRESHOLD_HU:
+            threshold = BODY_THRESHOLD_HU
+        else:
+            threshold = low + 0.1 * (float(np.percentile(image, 99)) - low)
+    mask = image > threshold
+
+    bbox = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        plane_size = np.prod([image.shape[a] for a in other])
+        counts = mask.sum(axis=other)
+        keep = np.flatnonzero(counts > plane_size * min_fraction)
+        if keep.size == 0:
+            # 找不到人体时保留整个轴
+            bbox.append(slice(0, image.shape[axis]))
+            continue
+        start = max(int(keep[0]) - margin, 0)
+        stop = min(int(keep[-1]) + 1 + margin, image.shape[axis])
+        bbox.append(slice(start, stop))
+    return tuple(bbox)
+
+
+def fit_to_input_size(image, input_size, strategy="resize"):
+    """image 为原始值（未归一化）的 [D,H,W]，返回调整后的 float32 数组"""
+    if strategy not in FIT_STRATEGIES:
+        raise ValueError(f"不支持的尺寸调整策略: {strategy}")
+    image = np.asarray(image, dtype=np.float32)
+    if strategy == "none" or input_size is None:
+        return image
+    input_size = tuple(int(s) for s in input_size)
+    if strategy == "resize":
+        return resize_volume(image, input_size)
+    if strategy == "center_crop":
+        return center_crop_or_pad(image, input_size)
+    return resize_volume(image[body_bbox(image)], input_size)
+
+
+class PreprocessCache:
+    """
+    预处理结果的进程内 LRU 缓存，键为 (文件路径, 大小, 修改时间, 预处理参数)。
+    同一病例重复诊断（或批量任务中重试）时跳过解码和插值。
+    同时限制条目数和总字节数：滑窗模式（fit_strategy="none"）的条目是原始分辨率的整个体数据，
+    单个可达数百MB，超过 max_bytes 的结果不缓存。
+    调用方不得原地修改返回的数组。
+    """
+
+    def __init__(self, max_entries=8, max_bytes=1 << 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(path, *params):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns) + tuple(params)
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = compute()
+        if self.max_entries > 0 and value.nbytes <= self.max_bytes:
+            with self._lock:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self._bytes -= old.nbytes
+                self._entries[key] = value
+                self._bytes += value.nbytes
+                while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
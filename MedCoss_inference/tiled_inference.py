@@ -0,0 +1,124 @@
+"""
+大体积病例的滑窗（多裁块）分类。
+
+扫描尺寸大于训练窗口（64×192×192）时，居中裁剪会丢掉解剖结构，整体缩放又会改变体素尺度。
+滑窗模式在原始分辨率上把体数据切成相互重叠的窗口，按 batch 前向，
+再把各窗口的 logits 聚合成一个病例的结果:
+- max: 每个类别取所有窗口中的最大 logit（任一区域有损伤即为阳性）；
+- mean: 各窗口 logits 取平均；
+- attention: 每个类别按 softmax(logit / temperature) 对窗口加权求和，介于 mean 和 max 之间。
+窗口数超过 max_tiles 时先减少重叠，仍不够覆盖整个体数据则报错（可改用 resize 单次前向）。
+"""
+import math
+
+import numpy as np
+import torch
+
+from precision import cast_input, inference_context
+
+
+AGGREGATIONS = ("max", "mean", "attention")
+
+
+def tile_starts(size, window, count=None, overlap=0.25):
+    """一个轴上的窗口起点，均匀分布且首尾对齐边界"""
+    if size <= window:
+        return [0]
+    if count is None:
+        step = max(int(window * (1 - overlap)), 1)
+        count = int(math.ceil((size - window) / step)) + 1
+    count = max(int(count), 2)
+    actual_step = (size - window) / (count - 1)
+    return [int(round(actual_step * i)) for i in range(count)]
+
+
+def plan_tiles(shape, window, overlap=0.25, max_tiles=16):
+    """
+    返回每个轴的窗口起点列表。
+    窗口总数超过 max_tiles 时，每次把窗口最多的轴减少一个（不低于刚好覆盖该轴所需的个数）。
+    """
+    counts = [len(tile_starts(s, w, overlap=overlap)) for s, w in zip(shape, window)]
+    minimum = [int(math.ceil(s / w)) for s, w in zip(shape, window)]
+    while np.prod(counts) > max_tiles:
+        reducible = [i for i in range(3) if counts[i] > minimum[i]]
+        if not reducible:
+            raise ValueError(
+                f"体数据 {tuple(shape)} 至少需要 {int(np.prod(minimum))} 个 {tuple(window)} 窗口才能覆盖，"
+                f"超过上限 {max_tiles}"
+            )
+        axis = max(reducible, key=lambda i: counts[i])
+        counts[axis] -= 1
+    return [tile_starts(s, w, count=c) for s, w, c in zip(shape, window, counts)]
+
+
+def extract_tiles(volume, window, overlap=0.25, max_tiles=16, pad_value=None):
+    """
+    volume 为 [D,H,W]，返回 ([N,1,d,h,w] float32, 各窗口起点列表)。
+    小于窗口的轴先用最小值补齐。
+    """
+    window = tuple(int(w) for w in window)
+    pad = [(0, max(w - s, 0)) for s, w in zip(volume.shape, window)]
+    if any(p[1] for p in pad):
+        if pad_value is None:
+            pad_value = float(volume.min()) if volume.size else 0.0
+        volume = np.pad(volume, pad, mode="constant", constant_values=pad_value)
+
+    starts = plan_tiles(volume.shape, window, overlap=overlap, max_tiles=max_tiles)
+    positions = [(z, y, x) for z in starts[0] for y in starts[1] for x in starts[2]]
+    tiles = np.empty((len(positions), 1) + window, dtype=np.float32)
+    d, h, w = window
+    for i, (z, y, x) in enumerate(positions):
+        tiles[i, 0] = volume[z:z + d, y:y + h, x:x + w]
+    return tiles, positions
+
+
+def aggregate_logits(logits, method="max", temperature=1.0):
+    """logits: [N,C] 张量，返回 [1,C]"""
+    if method == "max":
+        return logits.max(dim=0, keepdim=True)[0]
+    if method == "mean":
+        return logits.mean(dim=0, keepdim=True)
+    if method == "attention":
+        weights = torch.softmax(logits / temperature, dim=0)
+        return (weights * logits).sum(dim=0, keepdim=True)
+    raise ValueError(f"不支持的聚合方式: {method}")
+
+
+def predict_probs_tiled(model, device, x, window, dataset="custom", overlap=0.25, max_tiles=16,
+                        aggregation="max", tile_batch_size=4):
+    """
+    x 为单个病例 [1,1,D,H,W]（原始尺寸、已归一化），
+    返回 ([1,num_classes] numpy 概率, 窗口数)。窗口每 tile_batch_size 个做一次前向。
+    """
+    tiles, positions = extract_tiles(x[0, 0], window, overlap=overlap, max_tiles=max_tiles)
+    outputs = []
+    with inference_context(model, device):
+        for start in range(0, len(tiles), tile_batch_size):
+            batch = cast_input(model, torch.from_numpy(tiles[start:start + tile_batch_size]).to(device))
+            outputs.append(model({"data": batch, "modality": "3D image"}).float())
+        logits = aggregate_logits(torch.cat(outputs, dim=0), aggregation)
+        if dataset == "custom":
+            probs = torch.sigmoid(logits)
+        else:
+            probs = torch.softmax(logits, dim=1)
+    return probs.cpu().numpy(), len(positions)
+
+
+def add_tiling_args(parser):
+    parser.add_argument("--tiled", action="store_true", help="按原始分辨率滑窗分类")
+    parser.add_argument("--tile_overlap", type=float, default=0.25)
+    parser.add_argument("--max_tiles", type=int, default=16)
+    parser.add_argument("--tile_aggregation", type=str, default="max", choices=AGGREGATIONS)
+    parser.add_argument("--tile_batch_size", type=int, default=4)
+    return parser
+
+
+def tiling_from_args(args):
+    if not args.tiled:
+        return None
+    return {
+        "overlap": args.tile_overlap,
+        "max_tiles": args.max_tiles,
+        "aggregation": args.tile_aggregation,
+        "tile_batch_size": args.tile_batch_size,
+    }
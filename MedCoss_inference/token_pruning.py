@@ -0,0 +1,159 @@
+"""
+背景主导的 CT 体数据的 token 剪枝推理。
+
+腹部 CT 的 16³ patch 大多是空气或床板，原 forward 仍让它们通过全部 12 层 Encoder，
+最后再对所有 token 取平均。剪枝模式:
+1. 输入剪枝: patch embedding（含位置编码）之后，丢弃高于阈值的体素占比不足 min_fraction 的 patch；
+2. 渐进剪枝（可选）: 在 drop_after 指定的层之后，按下一层 cls token 对各 token 的注意力
+   （各头平均）只保留 keep_ratio 比例的 token；
+最后只对保留下来的 token 做全局平均，再经过 fc_norm / head。
+位置编码在剪枝前已加到 token 上，因此保留的 token 仍对应原来的空间位置。
+每个病例剩余的 token 数不同，batch 内逐例前向。
+"""
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from preprocessing import BODY_THRESHOLD_HU, PATCH_SIZE
+from precision import cast_input, inference_context
+# 与 truncate_ct_like_dataset 一致的归一化，ricord 输入上的阈值需换算
+from nifti_loader import RICORD_DIVIDE, RICORD_SUBTRACT
+
+
+def default_threshold(dataset):
+    """体表阈值（-500 HU）在各数据集输入上的取值"""
+    if dataset == "ricord":
+        return (BODY_THRESHOLD_HU - RICORD_SUBTRACT) / RICORD_DIVIDE
+    return BODY_THRESHOLD_HU
+
+
+def patch_keep_mask(x, threshold, min_fraction=0.01, patch_size=PATCH_SIZE):
+    """
+    x: [B,1,D,H,W] 张量，返回 [B,N] bool（N 与 patch embedding 输出的 token 顺序一致，d-h-w 行优先）。
+    一个 patch 都不保留的病例退回保留全部 token。
+    """
+    b = x.shape[0]
+    d, h, w = (s // patch_size for s in x.shape[2:])
+    x = x[:, 0, :d * patch_size, :h * patch_size, :w * patch_size]
+    patches = x.reshape(b, d, patch_size, h, patch_size, w, patch_size)
+    fraction = (patches > threshold).float().mean(dim=(2, 4, 6)).reshape(b, d * h * w)
+    keep = fraction >= min_fraction
+    empty = ~keep.any(dim=1)
+    if empty.any():
+        keep[empty] = True
+    return keep
+
+
+def cls_attention(layer, x):
+    """layer 中 cls token（第 0 个）对其余 token 的注意力，各头平均，返回 [B,N-1]"""
+    mha = layer.self_attn
+    h = layer.norm1(x) if layer.norm_first else x
+    embed_dim = h.shape[-1]
+    num_heads = mha.num_heads
+    head_dim = embed_dim // num_heads
+    w_q, w_k, _ = mha.in_proj_weight.split(embed_dim)
+    if mha.in_proj_bias is not None:
+        b_q, b_k, _ = mha.in_proj_bias.split(embed_dim)
+    else:
+        b_q = b_k = None
+    q = F.linear(h[:, :1], w_q, b_q).view(h.shape[0], 1, num_heads, head_dim).transpose(1, 2)
+    k = F.linear(h[:, 1:], w_k, b_k).view(h.shape[0], -1, num_heads, head_dim).transpose(1, 2)
+    scores = torch.matmul(q, k.transpose(-2, -1)) * head_dim ** -0.5
+    return torch.softmax(scores, dim=-1).mean(dim=1)[:, 0]
+
+
+def pruned_logits(model, x, threshold, min_fraction=0.01, drop_after=(), keep_ratio=0.7):
+    """
+    单个病例 x: [1,1,D,H,W] 张量的剪枝前向，返回 (logits [1,C], 各阶段 token 数列表)。
+    token 数列表第一项为剪枝前的 patch 数，其后为输入剪枝及每次渐进剪枝后的数量（不含 cls）。
+    """
+    keep = patch_keep_mask(x, threshold, min_fraction)[0]
+    tokens = model.video_embed(x)
+    counts = [int(tokens.shape[1])]
+    tokens = tokens[:, keep]
+    counts.append(int(tokens.shape[1]))
+
+    h = torch.cat((model.cls_token.expand(1, -1, -1).to(tokens.dtype), tokens), dim=1)
+    layers = model.fused_encoder.layers
+    for i, layer in enumerate(layers):
+        h = layer(src=h, src_mask=None)
+        if (i + 1) in drop_after and i + 1 < len(layers):
+            n = h.shape[1] - 1
+            n_keep = max(int(math.ceil(n * keep_ratio)), 1)
+            if n_keep < n:
+                scores = cls_attention(layers[i + 1], h)
+                # 保持剩余 token 的原有顺序
+                index = scores[0].topk(n_keep).indices.sort().values + 1
+                h = torch.cat((h[:, :1], h[:, index]), dim=1)
+            counts.append(int(h.shape[1] - 1))
+
+    pooled = model.fc_norm(h[:, 1:, :].mean(dim=1))
+    return model.head(pooled), counts
+
+
+def predict_probs_pruned(model, device, x, dataset="custom", threshold=None, min_fraction=0.01,
+                         drop_after=(), keep_ratio=0.7, compare=False):
+    """
+    对 [B,1,D,H,W] numpy 数组做剪枝推理，返回 (numpy 概率, 报告)。
+    compare=True 时额外跑一次完整前向，报告中给出 sigmoid/softmax 输出的最大偏移。
+    """
+    if threshold is None:
+        threshold = default_threshold(dataset)
+    drop_after = tuple(int(i) for i in drop_after)
+    xt = cast_input(model, torch.from_numpy(x).to(device))
+
+    logits, counts = [], []
+    with inference_context(model, device):
+        for i in range(xt.shape[0]):
+            case_logits, case_counts = pruned_logits(
+                model, xt[i:i + 1], threshold, min_fraction=min_fraction,
+                drop_after=drop_after, keep_ratio=keep_ratio,
+            )
+            logits.append(case_logits.float())
+            counts.append(case_counts)
+        logits = torch.cat(logits, dim=0)
+        if dataset == "custom":
+            probs = torch.sigmoid(logits)
+        else:
+            probs = torch.softmax(logits, dim=1)
+        probs = probs.cpu().numpy()
+
+    report = {
+        "tokens_total": counts[0][0],
+        "tokens_kept": [c[1] for c in counts],
+        "tokens_final": [c[-1] for c in counts],
+        "kept_fraction": round(float(np.mean([c[1] / c[0] for c in counts])), 4),
+    }
+    if compare:
+        from inference_single_case import predict_probs
+        full = predict_probs(model, device, x, dataset)
+        report["max_abs_diff"] = float(np.abs(full - probs).max())
+        report["mean_abs_diff"] = float(np.abs(full - probs).mean())
+    return probs, report
+
+
+def add_pruning_args(parser):
+    parser.add_argument("--prune_tokens", action="store_true", help="丢弃背景 patch 后再进入 Encoder")
+    parser.add_argument("--prune_threshold", type=float, default=None,
+                        help="体表阈值（输入数值），默认 -500 HU 换算到对应数据集")
+    parser.add_argument("--prune_min_fraction", type=float, default=0.01,
+                        help="patch 内高于阈值的体素占比低于该值时丢弃")
+    parser.add_argument("--drop_after_layers", type=str, default="",
+                        help="渐进剪枝的层号，如 4,8（第4、8层之后）")
+    parser.add_argument("--keep_ratio", type=float, default=0.7, help="每次渐进剪枝保留的比例")
+    parser.add_argument("--compare_full", action="store_true", help="同时跑完整推理并报告输出偏移")
+    return parser
+
+
+def pruning_from_args(args):
+    if not args.prune_tokens:
+        return None
+    return {
+        "threshold": args.prune_threshold,
+        "min_fraction": args.prune_min_fraction,
+        "drop_after": [int(i) for i in args.drop_after_layers.split(",") if i.strip()],
+        "keep_ratio": args.keep_ratio,
+        "compare": args.compare_full,
+    }
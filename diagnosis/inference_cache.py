@@ -0,0 +1,188 @@
+"""
+MedCoss推理结果缓存
+
+缓存键为 (影像内容SHA256, 权重文件SHA256, 预处理版本)：
+- 影像哈希优先使用上传后处理任务写入的 PatientInfo.content_sha256，缺失时现算并回写；
+- 权重哈希按 (路径, 大小, 修改时间) 在进程内记忆，避免每次诊断都读取整个权重文件；
+  checkpoint 旁的清单（<checkpoint>.manifest.json，由推理服务生成）未过期时直接使用其中的哈希，
+  Web请求中的预检查只用这两者，都没有时跳过预检查；
+- 预处理流程、输入尺寸、尺寸调整策略、滑窗/剪枝参数或推理精度变化时版本字符串随之变化，旧结果自然失效。
+只缓存真实模型的推理结果，mock回退结果不缓存。
+"""
+import json
+import os
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from patient_records.models import PatientInfo
+from patient_records.tasks import file_sha256
+from .models import InferenceCache, InferenceCacheCounter
+
+PREPROCESS_VERSION = 'medcoss-v2'
+
+_checkpoint_hashes = {}
+_checkpoint_lock = threading.Lock()
+
+
+def _manifest_sha256(checkpoint_path, stat):
+    """MedCoss_inference/checkpoint_manifest.py 生成的清单中的哈希，过期或不存在时返回None"""
+    try:
+        with open(checkpoint_path + '.manifest.json', 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('source') != {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}:
+        return None
+    return manifest.get('sha256')
+
+
+def checkpoint_sha256(checkpoint_path, compute=True):
+    """权重哈希；compute=False 时只使用进程内记忆或未过期的清单，都没有时返回None"""
+    stat = os.stat(checkpoint_path)
+    memo_key = (os.path.abspath(checkpoint_path), stat.st_size, stat.st_mtime_ns)
+    with _checkpoint_lock:
+        digest = _checkpoint_hashes.get(memo_key)
+    if digest is None:
+        digest = _manifest_sha256(checkpoint_path, stat)
+        if digest is None:
+            if not compute:
+                return None
+            digest = file_sha256(checkpoint_path)
+        with _checkpoint_lock:
+            _checkpoint_hashes[memo_key] = digest
+    return digest
+
+
+def image_sha256(image_path, patient_info=None, compute=True):
+    """影像内容哈希；compute=False 时只使用已保存的哈希（用于Web请求中的快速判断）"""
+    if patient_info is not None and patient_info.content_sha256:
+        return patient_info.content_sha256
+    if not compute:
+        return None
+    digest = file_sha256(image_path)
+    if patient_info is not None:
+        PatientInfo.objects.filter(pk=patient_info.pk).update(content_sha256=digest)
+    return digest
+
+
+def preprocess_version(input_size=None, num_classes=None, fit_strategy=None):
+    input_size = input_size or settings.MEDCOSS_INPUT_SIZE
+    num_classes = num_classes or settings.MEDCOSS_NUM_CLASSES
+    fit_strategy = fit_strategy or settings.MEDCOSS_FIT_STRATEGY
+    tiling = settings.MEDCOSS_TILING
+    if tiling:
+        # 滑窗模式不做尺寸调整，结果取决于重叠比例、窗口上限和聚合方式
+        fit_strategy = 'tiled:{}:{}:{}'.format(
+            tiling.get('overlap', 0.25), tiling.get('max_tiles', 16), tiling.get('aggregation', 'max')
+        )
+    version = f"{PREPROCESS_VERSION}|{'x'.join(str(s) for s in input_size)}|{num_classes}|{fit_strategy}"
+    pruning = settings.MEDCOSS_TOKEN_PRUNING
+    if pruning and not tiling:
+        # 剪枝结果与完整推理略有偏差，单独缓存
+        version += '|pruned:{}:{}:{}:{}'.format(
+            pruning.get('threshold'), pruning.get('min_fraction', 0.01),
+            ','.join(str(i) for i in pruning.get('drop_after', ())), pruning.get('keep_ratio', 0.7)
+        )
+    if settings.MEDCOSS_PRECISION != 'fp32':
+        version += f'|{settings.MEDCOSS_PRECISION}:{settings.MEDCOSS_PRECISION_MODE}'
+    return version
+
+
+def make_key(image_path, checkpoint_path, patient_info=None, compute=True):
+    """返回缓存键三元组，影像或权重哈希不可用时返回None"""
+    image_hash = image_sha256(image_path, patient_info, compute=compute)
+    if image_hash is None:
+        return None
+    checkpoint_hash = checkpoint_sha256(checkpoint_path, compute=compute)
+    if checkpoint_hash is None:
+        return None
+    return image_hash, checkpoint_hash, preprocess_version()
+
+
+def _count(name):
+    updated = InferenceCacheCounter.objects.filter(name=name).update(value=F('value') + 1)
+    if not updated:
+        try:
+            InferenceCacheCounter.objects.create(name=name, value=1)
+        except IntegrityError:
+            InferenceCacheCounter.objects.filter(name=name).update(value=F('value') + 1)
+
+
+def lookup(key, count_miss=True):
+    """查找缓存结果，命中时更新命中次数；预检查（未命中后仍会正常推理）时不计未命中"""
+    if not settings.INFERENCE_CACHE_ENABLED or key is None:
+        return None
+    image_hash, checkpoint_hash, version = key
+    entry = InferenceCache.objects.filter(
+        image_sha256=image_hash,
+        checkpoint_sha256=checkpoint_hash,
+        preprocess_version=version,
+    ).first()
+    if entry is None:
+        if count_miss:
+            _count('misses')
+        return None
+    InferenceCache.objects.filter(pk=entry.pk).update(hit_count=F('hit_count') + 1, last_hit_at=timezone.now())
+    _count('hits')
+    return entry.result
+
+
+def store(key, result):
+    if not settings.INFERENCE_CACHE_ENABLED or key is None:
+        return
+    image_hash, checkpoint_hash, version = key
+    InferenceCache.objects.update_or_create(
+        image_sha256=image_hash,
+        checkpoint_sha256=checkpoint_hash,
+        preprocess_version=version,
+        defaults={'result': result, 'size_bytes': len(json.dumps(result, ensure_ascii=False))},
+    )
+
+
+def evict(max_age_days=None, max_bytes=None):
+    """
+    清理缓存: 先删除超过 max_age_days 未使用的条目，
+    再按最近使用时间从旧到新删除，直到总大小不超过 max_bytes。返回删除条数。
+    """
+    max_age_days = settings.INFERENCE_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    max_bytes = settings.INFERENCE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    removed = 0
+
+    if max_age_days:
+        cutoff = timezone.now() - timedelta(days=max_age_days)
+        stale = InferenceCache.objects.filter(created_at__lt=cutoff).exclude(last_hit_at__gte=cutoff)
+        removed += stale.delete()[0]
+
+    if max_bytes:
+        total = InferenceCache.objects.aggregate(total=Sum('size_bytes'))['total'] or 0
+        if total > max_bytes:
+            doomed = []
+            entries = InferenceCache.objects.annotate(last_used=Coalesce('last_hit_at', 'created_at'))
+            for pk, size in entries.order_by('last_used').values_list('pk', 'size_bytes'):
+                if total <= max_bytes:
+                    break
+                doomed.append(pk)
+                total -= size
+            removed += InferenceCache.objects.filter(pk__in=doomed).delete()[0]
+    return removed
+
+
+def stats():
+    counters = dict(InferenceCacheCounter.objects.values_list('name', 'value'))
+    hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+    aggregate = InferenceCache.objects.aggregate(total=Sum('size_bytes'))
+    return {
+        'enabled': settings.INFERENCE_CACHE_ENABLED,
+        'entries': InferenceCache.objects.count(),
+        'total_bytes': aggregate['total'] or 0,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+        'preprocess_version': preprocess_version(),
+    }
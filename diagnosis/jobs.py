@@ -0,0 +1,96 @@
+"""
+诊断任务的提交与状态更新
+
+任务状态保存在 DiagnosisJob 表中，Web进程和Celery worker通过数据库共享，
+同一患者同一类型的进行中任务通过 active_key 唯一约束去重。
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import DiagnosisJob
+
+
+def _expire_stale_job(active_key):
+    """worker崩溃等原因遗留的进行中任务，超过时限后标记为失败并释放去重键"""
+    stale_before = timezone.now() - timedelta(seconds=settings.DIAGNOSIS_JOB_STALE_SECONDS)
+    expired = DiagnosisJob.objects.filter(
+        active_key=active_key,
+        updated_at__lt=stale_before,
+    ).update(
+        status='failed',
+        error='任务超时未完成',
+        active_key=None,
+        finished_at=timezone.now(),
+        updated_at=timezone.now(),
+    )
+    if expired:
+        print(f"已释放超时的诊断任务: {active_key}")
+
+
+def _enqueue(job_id):
+    from .tasks import run_diagnosis_job
+
+    try:
+        async_result = run_diagnosis_job.delay(job_id)
+    except Exception as e:
+        # broker不可用时立即失败，避免任务永远停留在排队状态
+        print(f"诊断任务 {job_id} 提交到队列失败: {str(e)}")
+        finish_job(job_id, 'failed', error=f'任务队列不可用: {str(e)}')
+        return
+    DiagnosisJob.objects.filter(id=job_id).update(celery_task_id=async_result.id or '')
+
+
+def submit_job(job_type, patient_info, doctor=None, params=None):
+    """
+    提交诊断任务，立即返回 (job, created)
+    如果该患者已有同类型的进行中任务，返回已有任务且 created=False
+    """
+    active_key = DiagnosisJob.make_active_key(job_type, patient_info.patient_id)
+    _expire_stale_job(active_key)
+
+    try:
+        with transaction.atomic():
+            job = DiagnosisJob.objects.create(
+                job_type=job_type,
+                patient=patient_info,
+                active_key=active_key,
+                params=params or {},
+                message='排队中',
+                created_by=doctor,
+            )
+    except IntegrityError:
+        existing = DiagnosisJob.objects.filter(active_key=active_key).first()
+        if existing is not None:
+            print(f"患者 {patient_info.patient_id} 已有进行中的诊断任务 {existing.id}，不重复提交")
+            return existing, False
+        # 已有任务恰好在此期间结束，重新提交一次
+        return submit_job(job_type, patient_info, doctor, params)
+
+    print(f"已提交患者 {patient_info.patient_id} 的诊断任务 {job.id}（{job_type}）")
+    transaction.on_commit(lambda: _enqueue(job.id))
+    return job, True
+
+
+def update_job(job_id, **fields):
+    fields['updated_at'] = timezone.now()
+    DiagnosisJob.objects.filter(id=job_id).update(**fields)
+
+
+def report_progress(job_id, progress, message=''):
+    update_job(job_id, progress=int(progress), message=message[:200])
+
+
+def finish_job(job_id, status, result=None, error=''):
+    update_job(
+        job_id,
+        status=status,
+        progress=100,
+        message='诊断完成' if status == 'completed' else '诊断失败',
+        result=result,
+        error=error,
+        active_key=None,
+        finished_at=timezone.now(),
+    )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from diagnosis import inference_cache
+
+
+class Command(BaseCommand):
+    help = '按使用时间和总大小清理MedCoss推理结果缓存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-days', type=int, default=None,
+                            help='删除超过该天数未使用的结果（默认 INFERENCE_CACHE_MAX_AGE_DAYS）')
+        parser.add_argument('--max-bytes', type=int, default=None,
+                            help='缓存总大小上限（默认 INFERENCE_CACHE_MAX_BYTES）')
+
+    def handle(self, *args, **options):
+        removed = inference_cache.evict(options['max_age_days'], options['max_bytes'])
+        stats = inference_cache.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"已删除 {removed} 条缓存，剩余 {stats['entries']} 条，共 {stats['total_bytes']} 字节，"
+            f"命中 {stats['hits']} 次，未命中 {stats['misses']} 次"
+        ))
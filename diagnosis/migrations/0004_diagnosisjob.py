@@ -0,0 +1,41 @@
+# Generated by Django 4.2.20 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient_records', '0002_alter_patient_options_alter_patient_table_and_more'),
+        ('diagnosis', '0003_diagresult_data_source_diagresult_data_source_label'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiagnosisJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_type', models.CharField(choices=[('medcoss', 'MedCoss盆腹腔外伤诊断'), ('remote', 'HUST-19远程肺炎诊断')], max_length=20, verbose_name='任务类型')),
+                ('status', models.CharField(choices=[('pending', '排队中'), ('running', '运行中'), ('completed', '已完成'), ('failed', '失败')], default='pending', max_length=20, verbose_name='任务状态')),
+                ('progress', models.IntegerField(default=0, verbose_name='进度')),
+                ('message', models.CharField(blank=True, default='', max_length=200, verbose_name='进度说明')),
+                ('active_key', models.CharField(blank=True, max_length=64, null=True, unique=True, verbose_name='去重键')),
+                ('params', models.JSONField(blank=True, default=dict, verbose_name='任务参数')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='任务结果')),
+                ('error', models.TextField(blank=True, default='', verbose_name='错误信息')),
+                ('celery_task_id', models.CharField(blank=True, default='', max_length=64, verbose_name='Celery任务ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='提交时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='patient_records.doctor', verbose_name='提交医生')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='diagnosis_jobs', to='patient_records.patientinfo')),
+            ],
+            options={
+                'verbose_name': '诊断任务',
+                'verbose_name_plural': '诊断任务',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
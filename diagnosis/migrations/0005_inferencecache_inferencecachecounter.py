@@ -0,0 +1,44 @@
+# Generated by Django 4.2.20 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diagnosis', '0004_diagnosisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InferenceCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_sha256', models.CharField(max_length=64, verbose_name='影像内容SHA256')),
+                ('checkpoint_sha256', models.CharField(max_length=64, verbose_name='权重文件SHA256')),
+                ('preprocess_version', models.CharField(max_length=100, verbose_name='预处理版本')),
+                ('result', models.JSONField(verbose_name='推理结果')),
+                ('size_bytes', models.IntegerField(default=0, verbose_name='结果大小')),
+                ('hit_count', models.IntegerField(default=0, verbose_name='命中次数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('last_hit_at', models.DateTimeField(blank=True, null=True, verbose_name='最后命中时间')),
+            ],
+            options={
+                'verbose_name': '推理结果缓存',
+                'verbose_name_plural': '推理结果缓存',
+                'unique_together': {('image_sha256', 'checkpoint_sha256', 'preprocess_version')},
+            },
+        ),
+        migrations.CreateModel(
+            name='InferenceCacheCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=20, unique=True, verbose_name='计数项')),
+                ('value', models.BigIntegerField(default=0, verbose_name='计数')),
+            ],
+            options={
+                'verbose_name': '推理缓存计数',
+                'verbose_name_plural': '推理缓存计数',
+            },
+        ),
+    ]
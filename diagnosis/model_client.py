@@ -0,0 +1,108 @@
+"""
+MedCoss 常驻推理服务的客户端（服务端见 MedCoss_inference/model_server.py）
+"""
+import os
+from multiprocessing.connection import Client
+
+from django.conf import settings
+
+
+class ModelServerError(Exception):
+    """推理服务不可用或返回错误"""
+
+
+def _server_address():
+    host, port = settings.MEDCOSS_SERVER_ADDRESS
+    return host, int(port)
+
+
+def _authkey():
+    key = settings.MEDCOSS_SERVER_AUTHKEY
+    return key.encode() if isinstance(key, str) else key
+
+
+def _request(message, timeout=None):
+    if timeout is None:
+        timeout = settings.MEDCOSS_SERVER_TIMEOUT
+    try:
+        conn = Client(_server_address(), authkey=_authkey())
+    except (OSError, EOFError) as e:
+        raise ModelServerError(f"无法连接MedCoss推理服务 {_server_address()}: {e}")
+
+    try:
+        conn.send(message)
+        if not conn.poll(timeout):
+            raise ModelServerError(f"MedCoss推理服务响应超时（{timeout}秒）")
+        reply = conn.recv()
+    except (OSError, EOFError) as e:
+        raise ModelServerError(f"与MedCoss推理服务通信失败: {e}")
+    finally:
+        conn.close()
+
+    if not reply.get('ok'):
+        raise ModelServerError(reply.get('error', '未知错误'))
+    return reply
+
+
+def resolve_checkpoint():
+    """
+    查找模型权重：优先 settings.MEDCOSS_CHECKPOINT，
+    其次 <MEDCOSS_PATH>/pth/checkpoint.pth，最后 <MEDCOSS_PATH>/weights/*.pth
+    """
+    configured = getattr(settings, 'MEDCOSS_CHECKPOINT', None)
+    if configured:
+        return str(configured) if os.path.exists(configured) else None
+
+    medcoss_path = str(settings.MEDCOSS_PATH)
+    model_weights = os.path.join(medcoss_path, 'pth', 'checkpoint.pth')
+    if os.path.exists(model_weights):
+        return model_weights
+
+    weights_dir = os.path.join(medcoss_path, 'weights')
+    if os.path.exists(weights_dir):
+        weight_files = sorted(f for f in os.listdir(weights_dir) if f.endswith('.pth'))
+        if weight_files:
+            return os.path.join(weights_dir, weight_files[0])
+    return None
+
+
+def ping():
+    try:
+        _request({'cmd': 'ping'}, timeout=5)
+        return True
+    except ModelServerError:
+        return False
+
+
+def server_status():
+    """返回已加载模型列表及其内存占用"""
+    return _request({'cmd': 'status'}, timeout=10)['status']
+
+
+def infer(nifti_path, checkpoint_path, input_size=None, num_classes=None, dataset='custom', fit_strategy=None,
+          precision=None):
+    """请求推理服务，返回 [num_classes] 概率列表"""
+    if input_size is None:
+        input_size = settings.MEDCOSS_INPUT_SIZE
+    if num_classes is None:
+        num_classes = settings.MEDCOSS_NUM_CLASSES
+    if fit_strategy is None:
+        fit_strategy = settings.MEDCOSS_FIT_STRATEGY
+    if precision is None:
+        precision = settings.MEDCOSS_PRECISION
+
+    reply = _request({
+        'cmd': 'infer',
+        'nifti_path': os.path.abspath(nifti_path),
+        'checkpoint_path': os.path.abspath(checkpoint_path),
+        'input_size': list(input_size),
+        'num_classes': num_classes,
+        'dataset': dataset,
+        'fit_strategy': fit_strategy,
+        # 未配置时明确关闭，与推理缓存键一致，不使用推理服务的启动参数
+        'tiling': settings.MEDCOSS_TILING or False,
+        'pruning': settings.MEDCOSS_TOKEN_PRUNING or False,
+        'precision': precision,
+        'precision_mode': settings.MEDCOSS_PRECISION_MODE,
+    })
+    return reply['probs'][0]
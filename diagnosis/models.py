@@ -108,3 +108,104 @@ class DiagnosisResult(models.Model):
 
         return self.probability_severe * 100
 
+
+
+# 异步诊断任务（由Celery worker执行，状态保存在数据库中供多进程共享）
+class DiagnosisJob(models.Model):
+    JOB_TYPES = [
+        ('medcoss', 'MedCoss盆腹腔外伤诊断'),
+        ('remote', 'HUST-19远程肺炎诊断'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', '排队中'),
+        ('running', '运行中'),
+        ('completed', '已完成'),
+        ('failed', '失败'),
+    ]
+    ACTIVE_STATUSES = ('pending', 'running')
+
+    job_type = models.CharField(max_length=20, choices=JOB_TYPES, verbose_name='任务类型')
+    patient = models.ForeignKey(PatientInfo, on_delete=models.CASCADE, related_name='diagnosis_jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name='任务状态')
+    progress = models.IntegerField(default=0, verbose_name='进度')
+    message = models.CharField(max_length=200, blank=True, default='', verbose_name='进度说明')
+
+    # 同一患者同一类型只允许一个进行中的任务，结束后清空
+    active_key = models.CharField(max_length=64, unique=True, null=True, blank=True, verbose_name='去重键')
+
+    params = models.JSONField(default=dict, blank=True, verbose_name='任务参数')
+    result = models.JSONField(null=True, blank=True, verbose_name='任务结果')
+    error = models.TextField(blank=True, default='', verbose_name='错误信息')
+    celery_task_id = models.CharField(max_length=64, blank=True, default='', verbose_name='Celery任务ID')
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='提交时间')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='开始时间')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='结束时间')
+    created_by = models.ForeignKey(Doctor, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='提交医生')
+
+    class Meta:
+        verbose_name = '诊断任务'
+        verbose_name_plural = '诊断任务'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.get_job_type_display()} - {self.patient_id} ({self.status})"
+
+    @staticmethod
+    def make_active_key(job_type, patient_id):
+        return f"{job_type}:{patient_id}"
+
+    @property
+    def is_finished(self):
+        return self.status not in self.ACTIVE_STATUSES
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'job_type': self.job_type,
+            'patient_id': self.patient_id,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class InferenceCache(models.Model):
+    """
+    推理结果缓存，按 (影像内容哈希, 权重文件哈希, 预处理版本) 唯一确定，
+    相同影像重新上传或服务重启后再次诊断时直接返回
+    """
+    image_sha256 = models.CharField(max_length=64, verbose_name='影像内容SHA256')
+    checkpoint_sha256 = models.CharField(max_length=64, verbose_name='权重文件SHA256')
+    preprocess_version = models.CharField(max_length=100, verbose_name='预处理版本')
+    result = models.JSONField(verbose_name='推理结果')
+    size_bytes = models.IntegerField(default=0, verbose_name='结果大小')
+    hit_count = models.IntegerField(default=0, verbose_name='命中次数')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    last_hit_at = models.DateTimeField(null=True, blank=True, verbose_name='最后命中时间')
+
+    class Meta:
+        verbose_name = '推理结果缓存'
+        verbose_name_plural = '推理结果缓存'
+        unique_together = ('image_sha256', 'checkpoint_sha256', 'preprocess_version')
+
+    def __str__(self):
+        return f"{self.image_sha256[:12]} / {self.checkpoint_sha256[:12]} / {self.preprocess_version}"
+
+
+class InferenceCacheCounter(models.Model):
+    """推理缓存的命中/未命中计数（跨Web和Celery进程累计）"""
+    name = models.CharField(max_length=20, unique=True, verbose_name='计数项')
+    value = models.BigIntegerField(default=0, verbose_name='计数')
+
+    class Meta:
+        verbose_name = '推理缓存计数'
+        verbose_name_plural = '推理缓存计数'
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
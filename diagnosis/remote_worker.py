@@ -0,0 +1,327 @@
+"""
+常驻远程推理worker的通信协议
+
+代替每次 `conda activate && python run.py ...` 的调用方式：远程worker进程启动一次、
+模型常驻内存，客户端通过一个SSH channel（或转发端口）以JSON行协议发送请求。
+
+每行一个JSON对象:
+    请求  {"id": "c1f0...", "method": "diagnose", "params": {"patient_id": 12}}
+    进度  {"id": "c1f0...", "type": "status", "stage": "inference", "progress": 50, "message": "..."}
+    结果  {"id": "c1f0...", "type": "result", "result": {...}}
+    错误  {"id": "c1f0...", "type": "error", "error": "..."}
+
+同一连接上可以并发多个请求，按 id 分发。本模块不依赖Django，
+worker端（serve）可直接拷贝到远程服务器运行，也可在本地作为替身worker离线测试：
+    python remote_worker.py --stdio
+    python remote_worker.py --port 7100
+"""
+import argparse
+import hashlib
+import json
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+
+class RemoteWorkerError(Exception):
+    """worker返回错误或连接中断"""
+
+
+# ---------- 客户端 ----------
+
+class _PendingCall:
+    def __init__(self, on_status=None):
+        self.messages = queue.Queue()
+        self.on_status = on_status
+
+
+class RemoteWorkerClient:
+    """
+    rfile/wfile 为二进制文件对象（socket.makefile / paramiko channel.makefile），
+    close_callback 在连接关闭时调用
+    """
+
+    def __init__(self, rfile, wfile, close_callback=None, name='remote-worker'):
+        self.name = name
+        self._rfile = rfile
+        self._wfile = wfile
+        self._close_callback = close_callback
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_loop, name=f"{name}-reader", daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self):
+        return not self._closed and self._reader.is_alive()
+
+    def _read_loop(self):
+        try:
+            for raw in self._rfile:
+                line = raw.decode('utf-8', errors='ignore').strip()
+                if not line:
+                    continue
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    # worker端的普通日志输出，忽略
+                    print(f"[{self.name}] {line}")
+                    continue
+                with self._pending_lock:
+                    pending = self._pending.get(message.get('id'))
+                if pending is not None:
+                    pending.messages.put(message)
+        except Exception as e:
+            print(f"[{self.name}] 读取worker响应出错: {str(e)}")
+        finally:
+            self._closed = True
+            with self._pending_lock:
+                pendings = list(self._pending.values())
+            for pending in pendings:
+                pending.messages.put({'type': 'error', 'error': '与远程worker的连接已断开'})
+
+    def call(self, method, params=None, timeout=120, on_status=None):
+        """发送请求并等待结果；on_status(message) 接收worker推送的进度"""
+        if not self.alive:
+            raise RemoteWorkerError('与远程worker的连接已断开')
+
+        request_id = uuid.uuid4().hex
+        pending = _PendingCall(on_status)
+        with self._pending_lock:
+            self._pending[request_id] = pending
+
+        try:
+            # reader可能在上面的检查之后退出，此时它已取走_pending的快照，不会再通知本次调用
+            if not self.alive:
+                raise RemoteWorkerError('与远程worker的连接已断开')
+            payload = json.dumps({'id': request_id, 'method': method, 'params': params or {}}, ensure_ascii=False)
+            with self._write_lock:
+                self._wfile.write((payload + '\n').encode('utf-8'))
+                self._wfile.flush()
+
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RemoteWorkerError(f'远程worker响应超时（{timeout}秒）')
+                try:
+                    message = pending.messages.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+
+                msg_type = message.get('type')
+                if msg_type == 'status':
+                    if pending.on_status is not None:
+                        pending.on_status(message)
+                elif msg_type == 'result':
+                    return message.get('result')
+                else:
+                    raise RemoteWorkerError(message.get('error', '未知错误'))
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+
+    def close(self):
+        self._closed = True
+        # 先关闭底层连接，使阻塞在读取上的reader线程退出
+        if self._close_callback is not None:
+            try:
+                self._close_callback()
+            except Exception:
+                pass
+        self._reader.join(timeout=5)
+        for f in (self._wfile, self._rfile):
+            try:
+                f.close()
+            except Exception:
+                pass
+
+
+def connect_ssh(pool, command, name='remote-worker'):
+    """在连接池的一个channel上启动worker命令（stdio模式），channel在close时归还"""
+    ctx = pool.channel()
+    chan = ctx.__enter__()
+    try:
+        chan.exec_command(command)
+    except Exception:
+        ctx.__exit__(None, None, None)
+        raise
+    # worker的日志和异常堆栈写到stderr，持续读出，避免写满channel窗口后阻塞JSON行输出
+    threading.Thread(target=_drain_stderr, args=(chan.makefile_stderr('rb'), name),
+                     name=f"{name}-stderr", daemon=True).start()
+    return RemoteWorkerClient(
+        chan.makefile('rb'), chan.makefile('wb'),
+        close_callback=lambda: ctx.__exit__(None, None, None),
+        name=name,
+    )
+
+
+def _drain_stderr(stream, name):
+    try:
+        for raw in stream:
+            line = raw.decode('utf-8', errors='ignore').rstrip()
+            if line:
+                print(f"[{name} stderr] {line}")
+    except Exception:
+        # channel关闭时读取会出错，直接退出
+        pass
+
+
+def connect_tcp(host, port, timeout=30, name='remote-worker'):
+    """连接以 --port 模式运行的worker（通常为SSH转发到本地的端口）"""
+    sock = socket.create_connection((host, int(port)), timeout=timeout)
+    sock.settimeout(None)
+    return RemoteWorkerClient(sock.makefile('rb'), sock.makefile('wb'),
+                              close_callback=lambda: _close_socket(sock), name=name)
+
+
+def connect_local(handlers=None, name='local-worker'):
+    """进程内替身worker，用于离线测试完整调用路径"""
+    client_sock, worker_sock = socket.socketpair()
+    worker = threading.Thread(
+        target=serve,
+        args=(worker_sock.makefile('rb'), worker_sock.makefile('wb'), handlers or STANDIN_HANDLERS),
+        name=f"{name}-server",
+        daemon=True,
+    )
+    worker.start()
+    return RemoteWorkerClient(client_sock.makefile('rb'), client_sock.makefile('wb'),
+                              close_callback=lambda: _close_socket(client_sock), name=name)
+
+
+def _close_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_worker_client(server_name):
+    """
+    按 settings.REMOTE_SERVERS[server_name] 获取（并缓存）worker客户端:
+    daemon_command -> 通过SSH channel启动; daemon_port -> TCP连接; local_worker -> 本地替身;
+    均未配置时返回None，调用方退回 python run.py 方式
+    """
+    from .ssh_pool import get_pool, get_server_config
+
+    config = get_server_config(server_name)
+    with _clients_lock:
+        client = _clients.get(server_name)
+        if client is not None:
+            if client.alive:
+                return client
+            # 关闭已断开的客户端，归还其占用的连接池channel
+            client.close()
+            _clients.pop(server_name, None)
+
+        if config.get('daemon_command'):
+            command = f"{config['python_env']} && cd {config['project_path']} && {config['daemon_command']}"
+            client = connect_ssh(get_pool(server_name), command, name=server_name)
+        elif config.get('daemon_port'):
+            client = connect_tcp(config.get('daemon_host', '127.0.0.1'), config['daemon_port'], name=server_name)
+        elif config.get('local_worker'):
+            client = connect_local(name=server_name)
+        else:
+            return None
+
+        _clients[server_name] = client
+        return client
+
+
+# ---------- worker端 ----------
+
+def serve(rfile, wfile, handlers):
+    """
+    handlers: {method: fn(params, report)}，report(stage, progress, message='') 推送进度。
+    每个请求在单独线程中处理，响应按行写回。
+    """
+    write_lock = threading.Lock()
+
+    def send(message):
+        data = (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+        with write_lock:
+            wfile.write(data)
+            wfile.flush()
+
+    def handle(request):
+        request_id = request.get('id')
+
+        def report(stage, progress, message=''):
+            send({'id': request_id, 'type': 'status', 'stage': stage, 'progress': progress, 'message': message})
+
+        handler = handlers.get(request.get('method'))
+        if handler is None:
+            send({'id': request_id, 'type': 'error', 'error': f"未知方法: {request.get('method')}"})
+            return
+        try:
+            result = handler(request.get('params') or {}, report)
+            send({'id': request_id, 'type': 'result', 'result': result})
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            send({'id': request_id, 'type': 'error', 'error': str(e)})
+
+    for raw in rfile:
+        line = raw.decode('utf-8', errors='ignore').strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError:
+            send({'id': None, 'type': 'error', 'error': '无效的JSON请求'})
+            continue
+        threading.Thread(target=handle, args=(request,), daemon=True).start()
+
+
+def _standin_diagnose(params, report):
+    """替身HUST-19诊断：由patient_id确定性生成三分类概率"""
+    report('inference', 50, '替身worker推理中')
+    digest = hashlib.md5(str(params.get('patient_id')).encode()).digest()
+    weights = [b + 1 for b in digest[:3]]
+    total = float(sum(weights))
+    return {'normal': weights[0] / total, 'mild': weights[1] / total, 'severe': weights[2] / total}
+
+
+def _standin_segment(params, report):
+    """替身LanGuideMedSeg分割：返回约定的结果文件名"""
+    report('inference', 50, '替身worker分割中')
+    return {'result_path': f"segmentation_{params.get('image')}"}
+
+
+STANDIN_HANDLERS = {
+    'ping': lambda params, report: {'pong': True},
+    'diagnose': _standin_diagnose,
+    'segment': _standin_segment,
+}
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="远程推理worker（替身实现）")
+    p.add_argument("--stdio", action="store_true", help="通过标准输入输出通信（SSH channel）")
+    p.add_argument("--host", type=str, default="127.0.0.1")
+    p.add_argument("--port", type=int, default=None)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.port:
+        listener = socket.create_server((args.host, args.port))
+        print(f"worker监听 {args.host}:{args.port}", file=sys.stderr)
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(
+                target=serve, args=(conn.makefile('rb'), conn.makefile('wb'), STANDIN_HANDLERS), daemon=True
+            ).start()
+    else:
+        serve(sys.stdin.buffer, sys.stdout.buffer, STANDIN_HANDLERS)
@@ -0,0 +1,312 @@
+"""
+远程服务器SSH/SFTP连接池（诊断和分割共用）
+
+每个 (主机, 端口, 用户) 维护 pool_size 个已认证的 paramiko.Transport，
+每次执行命令只在已有连接上新开一个channel，省去TCP握手、密钥交换和认证。
+连接断开时自动剔除，重连按指数退避重试。
+
+测试时可传入 transport_factory（返回已认证的 paramiko.Transport），
+例如连接本地sshd或进程内的 paramiko.ServerInterface 桩服务。
+"""
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import paramiko
+from django.conf import settings
+
+
+class SSHPoolError(Exception):
+    """连接池无法提供可用连接"""
+
+
+class _PooledSession:
+    def __init__(self, transport):
+        self.transport = transport
+        self.active_channels = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    def is_healthy(self):
+        return self.transport.is_active() and self.transport.is_authenticated()
+
+
+class SSHConnectionPool:
+
+    def __init__(self, hostname, port=22, username=None, password=None, pool_size=2,
+                 max_channels_per_session=4, connect_timeout=30, keepalive_interval=30,
+                 connect_retries=3, backoff_base=1.0, backoff_max=30.0, acquire_timeout=60,
+                 transport_factory=None):
+        self.hostname = hostname
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.max_channels_per_session = max_channels_per_session
+        self.connect_timeout = connect_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_retries = connect_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.transport_factory = transport_factory or self._open_transport
+
+        self._sessions = []
+        # 已断开但仍有channel在用的连接，最后一个channel释放时关闭
+        self._retired = []
+        self._connecting = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._metrics = {
+            'connects': 0,
+            'connect_failures': 0,
+            'dropped_sessions': 0,
+            'channels_opened': 0,
+            'commands': 0,
+            'acquire_wait_total': 0.0,
+            'acquire_wait_max': 0.0,
+        }
+
+    def __repr__(self):
+        return f"SSHConnectionPool({self.username}@{self.hostname}:{self.port})"
+
+    # ---------- 连接管理 ----------
+
+    def _open_transport(self):
+        sock = socket.create_connection((self.hostname, self.port), timeout=self.connect_timeout)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.start_client(timeout=self.connect_timeout)
+            transport.auth_password(self.username, self.password)
+        except Exception:
+            transport.close()
+            raise
+        return transport
+
+    def _connect_with_backoff(self):
+        last_error = None
+        for attempt in range(self.connect_retries):
+            try:
+                transport = self.transport_factory()
+                if self.keepalive_interval:
+                    transport.set_keepalive(self.keepalive_interval)
+                with self._cond:
+                    self._metrics['connects'] += 1
+                print(f"SSH连接池已建立新连接: {self.username}@{self.hostname}:{self.port}")
+                return transport
+            except (paramiko.SSHException, socket.error, EOFError) as e:
+                last_error = e
+                with self._cond:
+                    self._metrics['connect_failures'] += 1
+                delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+                print(f"SSH连接失败（第{attempt + 1}次）: {str(e)}，{delay:.1f}秒后重试")
+                if attempt + 1 < self.connect_retries:
+                    time.sleep(delay)
+        raise SSHPoolError(f"无法连接到 {self.hostname}:{self.port}: {last_error}")
+
+    def _close_session(self, session):
+        """调用方需持有 self._cond"""
+        self._metrics['dropped_sessions'] += 1
+        try:
+            session.transport.close()
+        except Exception:
+            pass
+
+    def _drop_dead_sessions(self):
+        """调用方需持有 self._cond"""
+        alive = []
+        for session in self._sessions:
+            if session.is_healthy():
+                alive.append(session)
+            elif session.active_channels == 0:
+                self._close_session(session)
+            else:
+                self._retired.append(session)
+        self._sessions = alive
+
+    def _acquire(self):
+        start = time.time()
+        deadline = start + self.acquire_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise SSHPoolError("连接池已关闭")
+                self._drop_dead_sessions()
+
+                candidates = [s for s in self._sessions
+                              if s.is_healthy() and s.active_channels < self.max_channels_per_session]
+                if candidates:
+                    session = min(candidates, key=lambda s: s.active_channels)
+                    session.active_channels += 1
+                    session.last_used = time.time()
+                    break
+
+                if len(self._sessions) + self._connecting < self.pool_size:
+                    self._connecting += 1
+                    session = None
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SSHPoolError(f"等待可用SSH连接超时（{self.acquire_timeout}秒）")
+                self._cond.wait(remaining)
+
+        if session is None:
+            # 在锁外建立新连接，避免阻塞其他线程复用已有连接
+            transport = None
+            try:
+                transport = self._connect_with_backoff()
+            finally:
+                # 计数减一与加入连接池在同一把锁内完成，其他线程不会看到名额空出而多建连接
+                with self._cond:
+                    self._connecting -= 1
+                    if transport is not None:
+                        session = _PooledSession(transport)
+                        session.active_channels = 1
+                        self._sessions.append(session)
+                    self._cond.notify_all()
+
+        waited = time.time() - start
+        with self._cond:
+            self._metrics['acquire_wait_total'] += waited
+            self._metrics['acquire_wait_max'] = max(self._metrics['acquire_wait_max'], waited)
+        return session
+
+    def _release(self, session):
+        with self._cond:
+            session.active_channels -= 1
+            if session.active_channels == 0 and session in self._retired:
+                self._retired.remove(session)
+                self._close_session(session)
+            self._cond.notify_all()
+
+    # ---------- 对外接口 ----------
+
+    @contextmanager
+    def channel(self, timeout=None):
+        """在池中连接上打开一个session channel"""
+        session = self._acquire()
+        chan = None
+        try:
+            chan = session.transport.open_session(timeout=self.connect_timeout)
+            with self._cond:
+                self._metrics['channels_opened'] += 1
+            if timeout is not None:
+                chan.settimeout(timeout)
+            yield chan
+        finally:
+            if chan is not None:
+                chan.close()
+            self._release(session)
+
+    @contextmanager
+    def sftp(self):
+        """在池中连接上打开SFTP会话"""
+        session = self._acquire()
+        client = None
+        try:
+            client = paramiko.SFTPClient.from_transport(session.transport)
+            with self._cond:
+                self._metrics['channels_opened'] += 1
+            yield client
+        finally:
+            if client is not None:
+                client.close()
+            self._release(session)
+
+    def exec_command(self, command, timeout=None):
+        """
+        执行远程命令，返回 (退出状态, 标准输出, 标准错误)
+        标准输出和标准错误交替读取，任一方向写满channel窗口都不会使远程命令阻塞
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        stdout, stderr = [], []
+        with self.channel(timeout=timeout) as chan:
+            chan.exec_command(command)
+            while True:
+                received = False
+                while chan.recv_ready():
+                    stdout.append(chan.recv(32768))
+                    received = True
+                while chan.recv_stderr_ready():
+                    stderr.append(chan.recv_stderr(32768))
+                    received = True
+                if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                    break
+                if deadline is not None and time.time() > deadline:
+                    raise socket.timeout(f"远程命令执行超时（{timeout}秒）: {command}")
+                if not received:
+                    time.sleep(0.01)
+            exit_status = chan.recv_exit_status()
+        stdout_str = b''.join(stdout).decode('utf-8', errors='ignore')
+        stderr_str = b''.join(stderr).decode('utf-8', errors='ignore')
+        with self._cond:
+            self._metrics['commands'] += 1
+        return exit_status, stdout_str, stderr_str
+
+    def metrics(self):
+        with self._cond:
+            self._drop_dead_sessions()
+            metrics = dict(self._metrics)
+            metrics['acquire_wait_total'] = round(metrics['acquire_wait_total'], 3)
+            metrics['acquire_wait_max'] = round(metrics['acquire_wait_max'], 3)
+            metrics.update({
+                'server': f"{self.username}@{self.hostname}:{self.port}",
+                'pool_size': self.pool_size,
+                'sessions': len(self._sessions),
+                'retired_sessions': len(self._retired),
+                'active_channels': sum(s.active_channels for s in self._sessions + self._retired),
+                'connecting': self._connecting,
+            })
+        return metrics
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for session in self._sessions + self._retired:
+                try:
+                    session.transport.close()
+                except Exception:
+                    pass
+            self._sessions = []
+            self._retired = []
+            self._cond.notify_all()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_server_config(server_name):
+    """settings.REMOTE_SERVERS 中的远程服务器配置"""
+    try:
+        return settings.REMOTE_SERVERS[server_name]
+    except KeyError:
+        raise SSHPoolError(f"未配置远程服务器: {server_name}")
+
+
+def get_pool(server_name):
+    """按服务器名获取连接池，同一主机/端口/用户的服务器共用一个池"""
+    config = get_server_config(server_name)
+    key = (config['hostname'], int(config.get('port', 22)), config['username'])
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SSHConnectionPool(
+                hostname=config['hostname'],
+                port=config.get('port', 22),
+                username=config['username'],
+                password=config.get('password'),
+                pool_size=config.get('pool_size', 2),
+                max_channels_per_session=config.get('max_channels_per_session', 4),
+                keepalive_interval=config.get('keepalive_interval', 30),
+            )
+            _pools[key] = pool
+        return pool
+
+
+def pool_metrics():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.metrics() for pool in pools]
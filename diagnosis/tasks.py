@@ -0,0 +1,135 @@
+"""
+诊断Celery任务，worker启动方式: celery -A Demo worker -l info
+"""
+import traceback
+
+from celery import shared_task
+from django.utils import timezone
+
+from .jobs import finish_job, report_progress
+from .models import DiagnosisJob, DiagnosisResult, DiagResult
+
+
+def save_medcoss_result(patient_info, confidences, result_type, doctor=None):
+    """保存MedCoss诊断结果到DiagResult，返回前端使用的结果字典"""
+    confidence_keys = [f'confidence_{i}' for i in range(8)]
+    max_confidence = max(confidences[k] for k in confidence_keys)
+
+    diag_result = DiagResult.objects.create(
+        patient=patient_info,
+        result_type=result_type,
+        image=patient_info.image,
+        data_source=confidences.get('data_source', 'unknown'),
+        data_source_label=confidences.get('data_source_label', '未知数据源'),
+        created_by=doctor,
+        **{k: confidences[k] for k in confidence_keys}
+    )
+    print(f"成功创建患者 {patient_info.patient_id} 的DiagResult记录，ID: {diag_result.id}")
+
+    return {
+        'success': True,
+        'diagnosis_id': diag_result.id,
+        'result_type': result_type,
+        'confidence': max_confidence * 100,
+        'confidences': {k: confidences[k] * 100 for k in confidence_keys},
+        'data_source': confidences.get('data_source', 'unknown'),
+        'data_source_label': confidences.get('data_source_label', '未知数据源'),
+        'message': '盆腹腔外伤诊断完成',
+    }
+
+
+def _run_medcoss_job(job):
+    """MedCoss盆腹腔外伤诊断，结果写入DiagResult"""
+    from .views import mock_diagnosis
+
+    patient_info = job.patient
+    if not patient_info.image:
+        raise ValueError(f'患者{patient_info.patient_id}没有关联的医学图像')
+
+    report_progress(job.id, 20, '模型推理中')
+    confidences, result_type = mock_diagnosis(patient_info.patient_id, patient_info.image.path)
+
+    report_progress(job.id, 90, '保存诊断结果')
+    return save_medcoss_result(patient_info, confidences, result_type, job.created_by)
+
+
+def _run_remote_job(job):
+    """HUST-19远程肺炎诊断，结果写入DiagnosisResult"""
+    from .views import run_remote_model
+
+    patient_info = job.patient
+
+    report_progress(job.id, 20, '远程模型运行中')
+
+    def on_status(message):
+        # worker进度(0-100)映射到任务进度20-90
+        progress = 20 + int(message.get('progress', 0)) * 70 // 100
+        report_progress(job.id, progress, message.get('message') or '远程模型运行中')
+
+    probabilities = run_remote_model(patient=patient_info, from_api=True, on_status=on_status)
+    if probabilities is None:
+        raise RuntimeError('无法获取远程执行结果')
+
+    report_progress(job.id, 90, '保存诊断结果')
+    max_prob_type = max(probabilities, key=probabilities.get)
+    max_prob = probabilities[max_prob_type]
+    result_type = {'normal': 'Normal', 'mild': 'Mild', 'severe': 'Severe'}[max_prob_type]
+
+    diagnosis_result = DiagnosisResult.objects.create(
+        patient=patient_info,
+        result_type=result_type,
+        confidence=max_prob,
+        probability_normal=probabilities['normal'],
+        probability_mild=probabilities['mild'],
+        probability_severe=probabilities['severe'],
+        ct_image=job.params.get('ct_image', ''),
+        notes=job.params.get('notes', ''),
+        created_by=job.created_by,
+    )
+    print(f"成功创建患者 {patient_info.patient_id} 的诊断结果记录，ID: {diagnosis_result.id}，结果: {result_type}")
+
+    return {
+        'success': True,
+        'diagnosis_id': diagnosis_result.id,
+        'result_type': result_type,
+        'confidence': max_prob * 100,
+        'probabilities': {k: v * 100 for k, v in probabilities.items()},
+        'message': '诊断完成',
+    }
+
+
+JOB_RUNNERS = {
+    'medcoss': _run_medcoss_job,
+    'remote': _run_remote_job,
+}
+
+
+@shared_task
+def run_diagnosis_job(job_id):
+    try:
+        job = DiagnosisJob.objects.select_related('patient', 'created_by').get(id=job_id)
+    except DiagnosisJob.DoesNotExist:
+        print(f"诊断任务 {job_id} 不存在")
+        return None
+
+    # 只有排队中的任务可以被领取。acks_late 下重复投递的消息遇到运行中或已结束的任务直接返回，
+    # 避免重复推理和重复写入诊断结果；worker崩溃遗留的运行中任务由 jobs._expire_stale_job 释放
+    now = timezone.now()
+    claimed = DiagnosisJob.objects.filter(id=job_id, status='pending').update(
+        status='running', progress=5, message='任务开始', started_at=now, updated_at=now,
+    )
+    if not claimed:
+        job.refresh_from_db(fields=['status'])
+        print(f"诊断任务 {job_id} 已被领取（{job.status}），跳过重复投递")
+        return job.status
+
+    try:
+        result = JOB_RUNNERS[job.job_type](job)
+    except Exception as e:
+        print(f"诊断任务 {job_id} 执行失败: {str(e)}")
+        traceback.print_exc()
+        finish_job(job_id, 'failed', error=str(e))
+        return 'failed'
+
+    finish_job(job_id, 'completed', result=result)
+    return 'completed'
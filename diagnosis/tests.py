@@ -0,0 +1,189 @@
+import socket
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from .ssh_pool import SSHConnectionPool, SSHPoolError
+
+
+class StubChannel:
+    """进程内的paramiko.Channel桩，一次性返回预设的输出"""
+
+    def __init__(self, stdout=b'', stderr=b'', exit_status=0):
+        self._stdout = stdout
+        self._stderr = stderr
+        self._exit_status = exit_status
+        self.command = None
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        self.command = command
+
+    def recv_ready(self):
+        return bool(self._stdout)
+
+    def recv(self, nbytes):
+        data, self._stdout = self._stdout[:nbytes], self._stdout[nbytes:]
+        return data
+
+    def recv_stderr_ready(self):
+        return bool(self._stderr)
+
+    def recv_stderr(self, nbytes):
+        data, self._stderr = self._stderr[:nbytes], self._stderr[nbytes:]
+        return data
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return self._exit_status
+
+    def close(self):
+        self.closed = True
+
+
+class StubTransport:
+    """已认证的paramiko.Transport桩"""
+
+    def __init__(self, stdout=b'ok', stderr=b''):
+        self.active = True
+        self.closed = False
+        self.stdout = stdout
+        self.stderr = stderr
+        self.channels = []
+
+    def is_active(self):
+        return self.active and not self.closed
+
+    def is_authenticated(self):
+        return True
+
+    def set_keepalive(self, interval):
+        pass
+
+    def open_session(self, timeout=None):
+        chan = StubChannel(self.stdout, self.stderr)
+        self.channels.append(chan)
+        return chan
+
+    def close(self):
+        self.closed = True
+
+
+class StubTransportFactory:
+    """按顺序返回新的桩连接，前 failures 次抛出连接错误"""
+
+    def __init__(self, failures=0, **transport_kwargs):
+        self.failures = failures
+        self.transport_kwargs = transport_kwargs
+        self.transports = []
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise socket.error('connection refused')
+        transport = StubTransport(**self.transport_kwargs)
+        self.transports.append(transport)
+        return transport
+
+
+def make_pool(factory, **kwargs):
+    kwargs.setdefault('pool_size', 2)
+    kwargs.setdefault('keepalive_interval', 0)
+    return SSHConnectionPool('stub', username='user', transport_factory=factory, **kwargs)
+
+
+class SSHConnectionPoolTests(SimpleTestCase):
+
+    def test_reuses_session_for_sequential_commands(self):
+        factory = StubTransportFactory(stdout=b'hello')
+        pool = make_pool(factory)
+
+        results = [pool.exec_command('echo hello') for _ in range(3)]
+
+        self.assertEqual(results, [(0, 'hello', '')] * 3)
+        self.assertEqual(factory.calls, 1)
+        self.assertEqual(len(factory.transports[0].channels), 3)
+        metrics = pool.metrics()
+        self.assertEqual(metrics['connects'], 1)
+        self.assertEqual(metrics['commands'], 3)
+        self.assertEqual(metrics['sessions'], 1)
+
+    def test_reads_large_stderr(self):
+        factory = StubTransportFactory(stdout=b'out', stderr=b'e' * 200000)
+        pool = make_pool(factory)
+
+        status, stdout, stderr = pool.exec_command('noisy')
+
+        self.assertEqual((status, stdout), (0, 'out'))
+        self.assertEqual(len(stderr), 200000)
+
+    def test_retries_with_exponential_backoff(self):
+        factory = StubTransportFactory(failures=2)
+        pool = make_pool(factory, connect_retries=3, backoff_base=1.0, backoff_max=30.0)
+
+        with mock.patch('diagnosis.ssh_pool.time.sleep') as sleep:
+            pool.exec_command('true')
+
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [1.0, 2.0])
+        self.assertEqual(pool.metrics()['connect_failures'], 2)
+
+    def test_raises_after_last_retry(self):
+        factory = StubTransportFactory(failures=10)
+        pool = make_pool(factory, connect_retries=2, backoff_base=0.5)
+
+        with mock.patch('diagnosis.ssh_pool.time.sleep'):
+            with self.assertRaises(SSHPoolError):
+                pool.exec_command('true')
+
+        self.assertEqual(factory.calls, 2)
+        # 失败的连接不占用连接池名额
+        self.assertEqual(pool.metrics()['connecting'], 0)
+
+    def test_replaces_dead_session(self):
+        factory = StubTransportFactory()
+        pool = make_pool(factory)
+        pool.exec_command('true')
+        first = factory.transports[0]
+        first.active = False
+
+        pool.exec_command('true')
+
+        self.assertEqual(factory.calls, 2)
+        self.assertTrue(first.closed)
+        metrics = pool.metrics()
+        self.assertEqual(metrics['sessions'], 1)
+        self.assertEqual(metrics['dropped_sessions'], 1)
+
+    def test_closes_dead_busy_session_after_release(self):
+        factory = StubTransportFactory()
+        pool = make_pool(factory)
+
+        with pool.channel():
+            first = factory.transports[0]
+            first.active = False
+            pool.exec_command('true')
+            # 仍有channel在用，连接先保留
+            self.assertFalse(first.closed)
+            self.assertEqual(pool.metrics()['retired_sessions'], 1)
+
+        self.assertTrue(first.closed)
+        metrics = pool.metrics()
+        self.assertEqual(metrics['retired_sessions'], 0)
+        self.assertEqual(metrics['dropped_sessions'], 1)
+
+    def test_close_closes_all_sessions(self):
+        factory = StubTransportFactory()
+        pool = make_pool(factory)
+        pool.exec_command('true')
+
+        pool.close()
+
+        self.assertTrue(factory.transports[0].closed)
+        with self.assertRaises(SSHPoolError):
+            pool.exec_command('true')
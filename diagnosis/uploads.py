@@ -0,0 +1,185 @@
+"""
+患者影像的分块（可续传）上传
+
+流程: init 创建/恢复上传会话 -> 按偏移量逐块 chunk -> complete 移动到正式目录并创建PatientInfo
+-> Celery任务 process_patient_image 校验文件头、计算哈希、提取几何信息并生成切片缓存。
+每个文件的数据库操作都在各自的短事务中完成，不会因为一批文件长时间占用事务。
+"""
+import os
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+
+from patient_records.models import PatientImageUpload, PatientInfo
+from patient_records.tasks import schedule_image_processing
+
+# 图像类型对应的存储文件夹
+TYPE_FOLDER_MAP = {
+    'US': 'US',
+    'CT': 'CT',
+    'MRI': 'MRI',
+    'X-ray': 'X-ray',
+}
+
+
+class UploadError(Exception):
+    """上传请求无效；status 为返回给前端的HTTP状态码"""
+
+    def __init__(self, message, status=400, upload=None):
+        super().__init__(message)
+        self.status = status
+        self.upload = upload
+
+
+def _partial_path(upload):
+    os.makedirs(str(settings.UPLOAD_PARTIAL_DIR), exist_ok=True)
+    return os.path.join(str(settings.UPLOAD_PARTIAL_DIR), f'{upload.upload_id}.part')
+
+
+def validate_filename(filename):
+    from .views import extract_patient_id_from_filename
+
+    if not filename.lower().endswith('.nii.gz'):
+        raise UploadError(f"{filename}: 不支持的文件格式，只支持.nii.gz格式")
+    patient_id = extract_patient_id_from_filename(filename)
+    if not patient_id:
+        raise UploadError(f"{filename}: 无法从文件名中提取患者ID")
+    return patient_id
+
+
+def store_patient_image(patient_id, filename, image_type, doctor, source_path=None, chunks=None):
+    """
+    将影像保存到 data/upload/<类型>/ 并创建PatientInfo（单独的短事务），
+    调用方随后通过 schedule_image_processing 启动后台处理。
+    source_path 为已接收完整的临时文件（直接移动），chunks 为上传文件的数据块迭代器。
+    患者已存在时返回409，不会覆盖其已有影像；文件先写到临时文件，记录创建成功后才移动到正式位置。
+    """
+    if PatientInfo.objects.filter(pk=patient_id).exists():
+        raise UploadError(f"{filename}: 患者 {patient_id} 已存在，不能覆盖已有影像", status=409)
+
+    folder_name = TYPE_FOLDER_MAP.get(image_type, 'CT')
+    upload_dir = os.path.join('data', 'upload', folder_name)
+    full_upload_dir = os.path.join(settings.BASE_DIR, upload_dir)
+    os.makedirs(full_upload_dir, exist_ok=True)
+
+    file_path = os.path.join(upload_dir, filename)
+    full_file_path = os.path.join(full_upload_dir, filename)
+
+    if source_path is not None:
+        temp_path = source_path
+    else:
+        temp_path = os.path.join(full_upload_dir, f'.{uuid.uuid4().hex}.part')
+        with open(temp_path, 'wb+') as destination:
+            for chunk in chunks:
+                destination.write(chunk)
+
+    try:
+        with transaction.atomic():
+            patient_info = PatientInfo.objects.create(
+                patient_id=patient_id,
+                image_style=image_type,
+                image=file_path,
+                created_by=doctor
+            )
+            os.replace(temp_path, full_file_path)
+    except Exception:
+        if source_path is None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return patient_info
+
+
+def init_upload(doctor, filename, total_size, image_type, fingerprint):
+    """创建上传会话；同一医生重新上传同一文件（标识相同）时返回未完成的会话以便续传"""
+    validate_filename(filename)
+    if total_size <= 0:
+        raise UploadError(f"{filename}: 文件为空")
+    if total_size > settings.UPLOAD_MAX_FILE_SIZE:
+        raise UploadError(f"{filename}: 文件超过大小限制")
+
+    existing = PatientImageUpload.objects.filter(
+        created_by=doctor,
+        fingerprint=fingerprint,
+        total_size=total_size,
+        status='uploading',
+    ).first()
+    if existing is not None:
+        # 以磁盘上实际写入的字节数为准
+        path = _partial_path(existing)
+        on_disk = os.path.getsize(path) if os.path.exists(path) else 0
+        if on_disk != existing.received_bytes:
+            existing.received_bytes = min(on_disk, existing.received_bytes)
+            existing.save(update_fields=['received_bytes', 'updated_at'])
+        print(f"续传文件 {filename}，已接收 {existing.received_bytes}/{total_size} 字节")
+        return existing
+
+    return PatientImageUpload.objects.create(
+        filename=os.path.basename(filename),
+        image_type=image_type,
+        fingerprint=fingerprint,
+        total_size=total_size,
+        created_by=doctor,
+    )
+
+
+def write_chunk(upload_id, doctor, offset, data):
+    """
+    在指定偏移量写入一个数据块。偏移量与已接收字节数不一致时抛出409，
+    前端据返回的 received_bytes 从正确位置继续。
+    """
+    with transaction.atomic():
+        try:
+            upload = PatientImageUpload.objects.select_for_update().get(upload_id=upload_id, created_by=doctor)
+        except PatientImageUpload.DoesNotExist:
+            raise UploadError('上传会话不存在', status=404)
+
+        if upload.status != 'uploading':
+            raise UploadError('上传会话已结束', status=409, upload=upload)
+        if offset != upload.received_bytes:
+            raise UploadError('数据块偏移量不一致', status=409, upload=upload)
+        if offset + len(data) > upload.total_size:
+            raise UploadError('数据超出文件大小', status=400, upload=upload)
+
+        path = _partial_path(upload)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+
+        upload.received_bytes = offset + len(data)
+        upload.save(update_fields=['received_bytes', 'updated_at'])
+    return upload
+
+
+def complete_upload(upload_id, doctor):
+    """所有数据块接收完毕后保存影像、创建记录并提交后台处理"""
+    with transaction.atomic():
+        try:
+            upload = PatientImageUpload.objects.select_for_update().get(upload_id=upload_id, created_by=doctor)
+        except PatientImageUpload.DoesNotExist:
+            raise UploadError('上传会话不存在', status=404)
+        if upload.status != 'uploading':
+            # 重复提交complete时直接返回当前状态
+            return upload
+        if upload.received_bytes != upload.total_size:
+            raise UploadError('文件尚未上传完整', status=409, upload=upload)
+        upload.status = 'processing'
+        upload.message = '保存文件'
+        upload.save(update_fields=['status', 'message', 'updated_at'])
+
+    try:
+        patient_id = validate_filename(upload.filename)
+        patient_info = store_patient_image(
+            patient_id, upload.filename, upload.image_type, doctor, source_path=_partial_path(upload)
+        )
+    except Exception as e:
+        print(f"保存上传文件 {upload.filename} 失败: {str(e)}")
+        PatientImageUpload.objects.filter(pk=upload.pk).update(status='failed', error=str(e))
+        upload.refresh_from_db()
+        return upload
+
+    PatientImageUpload.objects.filter(pk=upload.pk).update(patient=patient_info, progress=10, message='排队等待校验')
+    schedule_image_processing(patient_info.pk, upload.upload_id)
+    upload.refresh_from_db()
+    return upload
@@ -13,6 +13,10 @@ urlpatterns = [
     
     # 上传患者图像（新功能）
     path('upload-images/', views.upload_patient_images, name='upload_patient_images'),
+    path('upload-images/init/', views.upload_init, name='upload_init'),
+    path('upload-images/<uuid:upload_id>/', views.upload_status, name='upload_status'),
+    path('upload-images/<uuid:upload_id>/chunk/', views.upload_chunk, name='upload_chunk'),
+    path('upload-images/<uuid:upload_id>/complete/', views.upload_complete, name='upload_complete'),
     
     # 处理CT图像上传
     path('process-ct/', views.process_ct, name='process_ct'),
@@ -30,4 +34,8 @@ urlpatterns = [
     path('api/patient-info/<int:patient_id>/', views.get_patient_info, name='patient_info'),
     path('api/diagnose/', views.ajax_diagnose, name='ajax_diagnose'),
     path('api/remote-diagnose/', views.run_remote_diagnosis, name='remote_diagnose'),
+    path('api/jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('api/model-status/', views.model_server_status, name='model_server_status'),
+    path('api/ssh-pool-status/', views.remote_pool_status, name='remote_pool_status'),
+    path('api/inference-cache-status/', views.inference_cache_status, name='inference_cache_status'),
 ]
@@ -4,25 +4,25 @@ from django.contrib import messages
 from django.urls import reverse
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from patient_records.models import Patient, ClinicalFeature, Doctor, PatientInfo
-from .models import DiagnosisResult, DiagResult
+from patient_records.models import Patient, ClinicalFeature, Doctor, PatientInfo, PatientImageUpload
+from .models import DiagnosisResult, DiagResult, DiagnosisJob
+from .jobs import submit_job
+from .tasks import save_medcoss_result
+from . import inference_cache
+from .uploads import UploadError, complete_upload, init_upload, store_patient_image, validate_filename, write_chunk
+from patient_records.tasks import schedule_image_processing
+from .ssh_pool import SSHPoolError, get_pool, get_server_config, pool_metrics
+from .remote_worker import RemoteWorkerError, get_worker_client
+from . import model_client
+from django.conf import settings
 import os
 import json
 from datetime import datetime, timedelta
 import random
-import time
 import paramiko  # 用于SSH连接
 import base64
 import socket
 from django.db.models import Q
-import sys
-import numpy as np
-
-# 添加一个全局变量，用于跟踪正在进行的远程命令执行
-# 格式: {patient_id: (timestamp, status, result)}
-# status: 'running', 'completed', 'error'
-# result: 远程执行结果，如果有
-_remote_executions = {}
 
 # 真实模型诊断函数
 def real_model_diagnosis(patient_id, image_path):
@@ -31,53 +31,43 @@ def real_model_diagnosis(patient_id, image_path):
     返回8种外伤类型的置信度
     """
     try:
-        # 添加MedCoss_inference目录到Python路径
-        medcoss_path = 'H:\Projects_code\VSCodeProjects\PADiagnosis\MedCoss_inference'
-        if medcoss_path not in sys.path:
-            sys.path.insert(0, medcoss_path)
-        
-        # 导入MedCoss推理函数
-        from inference_single_case import inference_single_case
-        
         # 检查图像文件是否存在
         if not os.path.exists(image_path):
             print(f"图像文件不存在: {image_path}")
             return mock_diagnosis_fallback(patient_id, image_path)
         
-        # 调用MedCoss模型进行推理
-        print(f"正在使用MedCoss模型对患者{patient_id}的图像进行推理: {image_path}")
-        
         # 设置模型参数
-        model_weights = os.path.join(medcoss_path, 'pth', 'checkpoint.pth')  # 假设权重文件路径
-        if not os.path.exists(model_weights):
-            # 如果权重文件不存在，查找其他可能的权重文件
-            weights_dir = os.path.join(medcoss_path, 'weights')
-            if os.path.exists(weights_dir):
-                weight_files = [f for f in os.listdir(weights_dir) if f.endswith('.pth')]
-                if weight_files:
-                    model_weights = os.path.join(weights_dir, weight_files[0])
-                    print(f"使用找到的权重文件: {model_weights}")
-                else:
-                    print("未找到模型权重文件，使用mock数据")
-                    return mock_diagnosis_fallback(patient_id, image_path)
-            else:
-                print("权重目录不存在，使用mock数据")
-                return mock_diagnosis_fallback(patient_id, image_path)
+        model_weights = model_client.resolve_checkpoint()
+        if model_weights is None:
+            print("未找到模型权重文件，使用mock数据")
+            return mock_diagnosis_fallback(patient_id, image_path)
+        
+        # 相同影像、权重和预处理版本的结果直接复用
+        try:
+            cache_key = inference_cache.make_key(
+                image_path, model_weights, PatientInfo.objects.filter(pk=patient_id).first()
+            )
+        except Exception as e:
+            print(f"计算推理缓存键失败: {str(e)}")
+            cache_key = None
+        cached = inference_cache.lookup(cache_key)
+        if cached is not None:
+            print(f"患者{patient_id}的影像命中推理缓存，直接返回结果")
+            confidences = dict(cached['confidences'])
+            confidences['data_source_label'] = 'AI模型推理结果（缓存）'
+            return confidences, cached['result_type']
         
-        # 调用推理函数
-        probs = inference_single_case(
+        # 交给常驻推理服务（模型只加载一次并保持预热）
+        print(f"正在使用MedCoss模型对患者{patient_id}的图像进行推理: {image_path}")
+        probs = model_client.infer(
             nifti_path=image_path,
             checkpoint_path=model_weights,
-            input_size=(64, 192, 192),  # 根据模型要求调整
-            num_classes=8  # 8种外伤类型
+            input_size=settings.MEDCOSS_INPUT_SIZE,
+            num_classes=settings.MEDCOSS_NUM_CLASSES
         )
         
-        # 确保probs是numpy数组或列表
-        if isinstance(probs, np.ndarray):
-            # probs的形状是(1, num_classes)，需要取第一个元素
-            probs_list = probs[0].tolist()
-        else:
-            probs_list = probs
+        # 推理服务返回单个病例的概率列表
+        probs_list = list(probs)
         
         # 构建置信度字典，与原有格式保持一致
         confidences = {}
@@ -132,6 +122,7 @@ def real_model_diagnosis(patient_id, image_path):
         confidences['data_source'] = 'model'
         confidences['data_source_label'] = 'AI模型推理结果'
         
+        inference_cache.store(cache_key, {'confidences': confidences, 'result_type': result_type})
         return confidences, result_type
         
     except Exception as e:
@@ -239,47 +230,6 @@ def mock_diagnosis(patient_id, image_path):
     # 优先尝试使用真实模型
     return real_model_diagnosis(patient_id, image_path)
 
-# 添加一个等待远程结果的函数
-def wait_for_remote_result(patient_id, timeout=60, polling_interval=1):
-    """
-    等待远程执行结果返回
-    
-    参数:
-    - patient_id: 患者ID
-    - timeout: 最大等待时间（秒），默认60秒
-    - polling_interval: 轮询间隔（秒），默认1秒
-    
-    返回:
-    - 远程执行结果字典或None
-    """
-    global _remote_executions
-    start_time = datetime.now()
-    elapsed_time = 0
-    
-    print(f"开始等待患者 {patient_id} 的远程执行结果，最长等待 {timeout} 秒")
-    
-    while elapsed_time < timeout:
-        # 检查患者的远程执行状态
-        if patient_id in _remote_executions:
-            timestamp, status, result = _remote_executions[patient_id]
-            
-            # 如果执行已完成且有结果，返回结果
-            if status == 'completed' and result is not None:
-                print(f"患者 {patient_id} 的远程执行结果已返回，等待时间: {elapsed_time} 秒")
-                return result
-            
-            # 如果执行已完成但没有结果，或者执行出错，停止等待
-            if status == 'completed' or status == 'error':
-                print(f"患者 {patient_id} 的远程执行已结束，但未返回有效结果，状态: {status}")
-                return None
-        
-        # 等待一段时间后再次检查
-        time.sleep(polling_interval)
-        elapsed_time = (datetime.now() - start_time).total_seconds()
-    
-    print(f"等待患者 {patient_id} 的远程执行结果超时，已等待 {timeout} 秒")
-    return None
-
 # 诊断首页视图
 def diagnosis_home(request):
     # 获取搜索参数
@@ -363,20 +313,20 @@ def upload_ct(request, patient_id=None):
         return redirect('diagnosis:home')
 
 # 远程执行HUST-19模型
-def run_remote_model(temp_image_path=None, patient=None, clinical_features=None, form_data=None, from_api=False):
+def run_remote_model(temp_image_path=None, patient=None, clinical_features=None, form_data=None, from_api=False,
+                     on_status=None):
     """
     在远程服务器上运行HUST-19模型
     
     参数:
     - patient: 患者对象（用于创建诊断结果记录）
     - from_api: 是否来自API调用
+    - on_status: 接收常驻worker推送进度的回调（仅常驻worker模式有效）
     
     返回:
     - 解析后的结果概率字典或None
     """
-    global _remote_executions
     result_probabilities = None
-    client = None
     
     try:
         # 如果未提供患者信息且提供了表单数据，则从表单获取患者ID
@@ -403,61 +353,39 @@ def run_remote_model(temp_image_path=None, patient=None, clinical_features=None,
             
         patient_id = patient.patient_id
         
-        # 检查是否有正在进行的相同患者命令执行
+        # 去重由DiagnosisJob负责，这里只负责执行
         current_time = datetime.now()
         execution_id = f"run_remote_model_{patient_id}_{current_time.strftime('%Y%m%d%H%M%S')}"
         print(f"开始执行ID: {execution_id} 的远程模型")
         
-        if patient_id in _remote_executions:
-            timestamp, status, cached_result = _remote_executions[patient_id]
-            
-            # 如果有已完成的结果且不超过10分钟，直接返回缓存的结果
-            if status == 'completed' and cached_result is not None and (current_time - timestamp).total_seconds() < 600:
-                print(f"患者 {patient_id} 已有缓存的远程执行结果，将直接返回")
-                return cached_result
-        
-        # 标记此患者的远程执行为进行中
-        print(f"标记患者 {patient_id} 的远程执行状态为进行中")
-        _remote_executions[patient_id] = (current_time, 'running', None)
-        
-        # 远程服务器连接信息
-        hostname = "202.197.33.114"
-        port = 223
-        username = "xuchang"
-        password = "1"
-        
         # HUST-19项目路径和python环境
-        remote_project_path = "/data8t/xuchang/PycharmProjects/HUST-19"
-        python_env = "source /data8t/xuchang/anaconda3/etc/profile.d/conda.sh && conda activate hust19"
-        
-        # 创建SSH客户端
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        server = get_server_config('hust19')
+        remote_project_path = server['project_path']
+        python_env = server['python_env']
         
         try:
-            # 连接到远程服务器
-            print(f"正在连接到远程服务器 {hostname}:{port}")
-            client.connect(
-                hostname=hostname, 
-                port=port, 
-                username=username, 
-                password=password,
-                timeout=30,
-                allow_agent=False,
-                look_for_keys=False
-            )
+            # 优先使用常驻worker（模型常驻内存，JSON协议返回结构化结果）
+            worker = get_worker_client('hust19')
+            if worker is not None:
+                print(f"通过常驻worker诊断患者 {patient_id}")
+                result = worker.call('diagnose', {'patient_id': patient_id}, timeout=120, on_status=on_status)
+                result_probabilities = {
+                    'normal': float(result['normal']),
+                    'mild': float(result['mild']),
+                    'severe': float(result['severe'])
+                }
+                print(f"执行ID: {execution_id} 的远程模型完成，结果: {result_probabilities}")
+                return result_probabilities
+            
+            # 未配置常驻worker时，每次启动 run.py 并解析标准输出
+            pool = get_pool('hust19')
             
             # 构建命令（使用patient_id替代id）
             command = f"{python_env} && cd {remote_project_path} && python run.py --patient_id={patient.patient_id}"
             print(f"执行远程命令: {command}")
             
             # 执行命令
-            stdin, stdout, stderr = client.exec_command(command, timeout=120)  # 增加超时时间到120秒
-            
-            # 读取输出
-            stdout_str = stdout.read().decode('utf-8', errors='ignore')
-            stderr_str = stderr.read().decode('utf-8', errors='ignore')
-            exit_status = stdout.channel.recv_exit_status()
+            exit_status, stdout_str, stderr_str = pool.exec_command(command, timeout=120)  # 增加超时时间到120秒
             
             print(f"远程执行命令完成，退出状态: {exit_status}")
             print(f"标准输出: {stdout_str}")
@@ -483,16 +411,8 @@ def run_remote_model(temp_image_path=None, patient=None, clinical_features=None,
                     'severe': probability_severe
                 }
                 
-                # 更新此患者的远程执行状态为完成，同时缓存结果
-                _remote_executions[patient_id] = (current_time, 'completed', result_probabilities)
-                
                 print(f"执行ID: {execution_id} 的远程模型完成，结果: {result_probabilities}")
                 
-                # 立即关闭SSH连接
-                if client:
-                    client.close()
-                    client = None
-                    
                 return result_probabilities
             else:
                 # 尝试其他格式匹配，查找包含概率信息的行
@@ -525,53 +445,31 @@ def run_remote_model(temp_image_path=None, patient=None, clinical_features=None,
                             'severe': probability_severe
                         }
                         
-                        # 更新此患者的远程执行状态为完成，同时缓存结果
-                        _remote_executions[patient_id] = (current_time, 'completed', result_probabilities)
-                        
                         print(f"执行ID: {execution_id} 的远程模型完成，结果: {result_probabilities}")
                         
-                        # 立即关闭SSH连接
-                        if client:
-                            client.close()
-                            client = None
-                        
                         return result_probabilities
                 
                 print("无法从远程输出中解析出结果概率")
-                # 更新此患者的远程执行状态为完成，但没有有效结果
-                _remote_executions[patient_id] = (current_time, 'completed', None)
             
+        except RemoteWorkerError as e:
+            print(f"常驻worker执行失败: {str(e)}")
+        except SSHPoolError as e:
+            print(f"SSH连接池错误: {str(e)}")
         except paramiko.AuthenticationException:
             print("SSH认证失败: 用户名或密码错误")
-            _remote_executions[patient_id] = (current_time, 'error', None)
         except paramiko.SSHException as e:
             print(f"SSH连接错误: {str(e)}")
-            _remote_executions[patient_id] = (current_time, 'error', None)
         except socket.timeout:
             print("SSH连接超时，请检查网络或服务器状态")
-            _remote_executions[patient_id] = (current_time, 'error', None)
         except socket.error as e:
             print(f"Socket错误: {str(e)}")
-            _remote_executions[patient_id] = (current_time, 'error', None)
         except Exception as e:
             print(f"远程执行过程中出错: {str(e)}")
             import traceback
             traceback.print_exc()
-            _remote_executions[patient_id] = (current_time, 'error', None)
         
     except Exception as e:
         print(f"运行远程模型时发生错误: {str(e)}")
-        # 更新状态为错误
-        if patient and hasattr(patient, 'patient_id'):
-            _remote_executions[patient.patient_id] = (current_time, 'error', None)
-    finally:
-        # 确保连接被关闭
-        if client:
-            try:
-                client.close()
-                print("SSH连接已关闭")
-            except:
-                pass
     
     return result_probabilities
 
@@ -661,6 +559,35 @@ def check_recent_diagnosis(patient_id, time_threshold_seconds=30):
     
     return None
 
+# 获取当前登录的医生信息
+def get_current_doctor(request):
+    """依次从登录用户、会话中获取医生，均获取不到时使用ID为1的医生"""
+    if not request.user.is_anonymous and hasattr(request.user, 'doctor'):
+        return request.user.doctor
+    
+    doctor_id = request.session.get('doctor_id')
+    if doctor_id:
+        try:
+            doctor = Doctor.objects.get(doctor_id=doctor_id)
+            print(f"从会话中恢复医生信息，ID: {doctor_id}")
+            return doctor
+        except Doctor.DoesNotExist:
+            print(f"无法找到ID为{doctor_id}的医生")
+    
+    print(f"使用默认医生，ID: 1")
+    return get_object_or_404(Doctor, doctor_id=1)
+
+# 返回任务提交结果
+def job_submitted_response(job, created):
+    return JsonResponse({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'deduplicated': not created,
+        'status_url': reverse('diagnosis:job_status', args=[job.id]),
+        'message': '诊断任务已提交' if created else '该患者已有进行中的诊断任务',
+    }, status=202)
+
 # 处理CT图像上传视图
 def process_ct(request):
     if request.method == 'POST':
@@ -677,189 +604,24 @@ def process_ct(request):
         print(f"接收到患者 {patient_id} 的诊断请求")
         
         try:
-            from django.db import transaction
-            
-            # 检查最近120秒内是否已经创建了诊断记录
-            recent_diagnosis = check_recent_diagnosis(patient_id, 120)
-            if recent_diagnosis:
-                # 如果存在最近的诊断记录，使用该记录的结果
-                print(f"发现患者 {patient_id} 最近的诊断记录（ID: {recent_diagnosis.id}），直接返回")
-                return JsonResponse({
-                    'success': True,
-                    'diagnosis_id': recent_diagnosis.id,
-                    'message': '使用现有的诊断结果',
-                    'result_type': recent_diagnosis.result_type,
-                    'confidence': recent_diagnosis.confidence * 100,
-                    'probabilities': {
-                        'normal': recent_diagnosis.probability_normal * 100,
-                        'mild': recent_diagnosis.probability_mild * 100,
-                        'severe': recent_diagnosis.probability_severe * 100
-                    }
-                })
-            
             # 获取患者信息
-            patient = get_object_or_404(Patient, patient_id=patient_id)
+            patient_info = get_object_or_404(PatientInfo, patient_id=patient_id)
             
-            # 上传的CT图像（可选）
-            ct_image = None
+            # 上传的CT图像（可选），先保存到存储中再交给worker
+            params = {'notes': request.POST.get('notes', '')}
             if 'ct_image' in request.FILES:
+                from django.core.files.storage import default_storage
                 ct_image = request.FILES['ct_image']
                 print(f"成功获取CT图像: {ct_image.name}, 大小: {ct_image.size} 字节")
+                params['ct_image'] = default_storage.save(
+                    f"ct_images/{datetime.now().strftime('%Y/%m/%d')}/{ct_image.name}", ct_image
+                )
             else:
                 print("未上传CT图像")
             
-            # 检查是否有正在进行的远程执行
-            global _remote_executions
-            current_time = datetime.now()
-            
-            # 如果有进行中的执行，不要开始新的执行
-            if patient_id in _remote_executions:
-                timestamp, status, _ = _remote_executions[patient_id]
-                if status == 'running' and (current_time - timestamp).total_seconds() < 180:  # 3分钟内
-                    print(f"患者 {patient_id} 有正在进行的远程执行，将等待结果")
-                    
-                    # 使用一个更长的超时时间等待结果
-                    print(f"等待患者 {patient_id} 的远程执行结果，最多等待180秒...")
-                    probabilities = wait_for_remote_result(patient_id, timeout=180, polling_interval=3)
-                    
-                    if probabilities:
-                        print(f"成功获取到患者 {patient_id} 的远程执行结果: {probabilities}")
-                    else:
-                        print(f"等待超时，未能获取患者 {patient_id} 的远程执行结果")
-                        return JsonResponse({
-                            'success': False,
-                            'message': '远程执行超时，请稍后重试',
-                            'status': 'timeout'
-                        })
-                else:
-                    # 如果状态不是running或者已经超过3分钟，重置执行状态
-                    print(f"重置患者 {patient_id} 的远程执行状态")
-            
-            # 如果没有获取到结果，启动新的远程执行
-            if 'probabilities' not in locals() or probabilities is None:
-                print(f"为患者 {patient_id} 启动新的远程执行")
-                
-                # 标记执行状态为running
-                _remote_executions[patient_id] = (current_time, 'running', None)
-                
-                # 执行远程模型并等待结果
-                probabilities = run_remote_model(None, patient, patient.clinical_features, None, False)
-                
-                # 如果仍然没有结果，再等待一次
-                if probabilities is None:
-                    print(f"首次执行未获取结果，再次等待患者 {patient_id} 的远程执行结果...")
-                    probabilities = wait_for_remote_result(patient_id, timeout=120, polling_interval=3)
-                
-                # 最终验证是否有结果
-                if probabilities is None:
-                    print(f"多次尝试后仍未获取到患者 {patient_id} 的远程执行结果，返回错误")
-                    return JsonResponse({
-                        'success': False,
-                        'message': '无法获取远程执行结果，请稍后重试',
-                        'status': 'failed'
-                    })
-            
-            # 确定最大概率所对应的类型
-            max_prob_type = max(probabilities, key=probabilities.get)
-            max_prob = probabilities[max_prob_type]
-            
-            # 映射回前端使用的类型
-            result_type_map = {
-                'normal': 'Normal',
-                'mild': 'Mild',
-                'severe': 'Severe'
-            }
-            result_type = result_type_map[max_prob_type]
-            
-            # 使用事务创建诊断结果记录
-            with transaction.atomic():
-                # 检查最近的DiagResult诊断记录
-                from django.utils import timezone
-                import pytz
-                
-                # 获取当前时间（带时区）
-                current_time = timezone.now()
-                time_threshold = current_time - timedelta(seconds=10)
-                
-                recent_diag_result = DiagResult.objects.filter(
-                    patient_id=patient_id,
-                    created_at__gte=time_threshold
-                ).first()
-                
-                if recent_diag_result:
-                    print(f"发现患者 {patient_id} 的最近DiagResult记录（ID: {recent_diag_result.id}），直接返回")
-                    return JsonResponse({
-                        'success': True,
-                        'diagnosis_id': recent_diag_result.id,
-                        'message': '使用等待期间创建的诊断结果',
-                        'result_type': recent_diag_result.result_type,
-                        'confidence': max_confidence * 100,
-                        'confidences': {
-                            'confidence_0': recent_diag_result.confidence_0 * 100,
-                            'confidence_1': recent_diag_result.confidence_1 * 100,
-                            'confidence_2': recent_diag_result.confidence_2 * 100,
-                            'confidence_3': recent_diag_result.confidence_3 * 100,
-                            'confidence_4': recent_diag_result.confidence_4 * 100,
-                            'confidence_5': recent_diag_result.confidence_5 * 100,
-                            'confidence_6': recent_diag_result.confidence_6 * 100,
-                            'confidence_7': recent_diag_result.confidence_7 * 100
-                        }
-                    })
-                
-                # 创建诊断结果记录，使用真实的远程执行结果
-                # 添加用户身份调试信息
-                print(f"当前用户: {request.user}, 是否匿名: {request.user.is_anonymous}")
-                if not request.user.is_anonymous:
-                    print(f"用户ID: {request.user.id}, 用户名: {request.user.username}")
-                    if hasattr(request.user, 'doctor'):
-                        print(f"关联的医生ID: {request.user.doctor.doctor_id}")
-                
-                # 获取当前登录的医生信息
-                doctor = None
-                if not request.user.is_anonymous and hasattr(request.user, 'doctor'):
-                    doctor = request.user.doctor
-                else:
-                    # 尝试从会话中获取医生ID
-                    doctor_id = request.session.get('doctor_id')
-                    if doctor_id:
-                        try:
-                            doctor = Doctor.objects.get(doctor_id=doctor_id)
-                            print(f"从会话中恢复医生信息，ID: {doctor_id}")
-                        except Doctor.DoesNotExist:
-                            print(f"无法找到ID为{doctor_id}的医生")
-                    
-                    # 如果仍然无法获取医生信息，使用ID为1的医生
-                    if not doctor:
-                        doctor = get_object_or_404(Doctor, doctor_id=1)
-                        print(f"使用默认医生，ID: 1")
-                
-                diagnosis_result = DiagnosisResult.objects.create(
-                    patient=patient,
-                    result_type=result_type,
-                    confidence=max_prob,
-                    probability_normal=probabilities['normal'],
-                    probability_mild=probabilities['mild'],
-                    probability_severe=probabilities['severe'],
-                    ct_image=ct_image,
-                    notes=request.POST.get('notes', ''),
-                    created_by=doctor
-                )
-                
-                print(f"成功创建患者 {patient_id} 的诊断结果记录，ID: {diagnosis_result.id}，结果: {result_type}")
-            
-            # 返回统一格式的响应
-            return JsonResponse({
-                'success': True,
-                'diagnosis_id': diagnosis_result.id,
-                'result_type': result_type,
-                'confidence': max_prob * 100,
-                'probabilities': {
-                    'normal': probabilities['normal'] * 100,
-                    'mild': probabilities['mild'] * 100,
-                    'severe': probabilities['severe'] * 100
-                },
-                'message': '诊断完成'
-            })
+            # 提交远程诊断任务，立即返回任务ID
+            job, created = submit_job('remote', patient_info, get_current_doctor(request), params)
+            return job_submitted_response(job, created)
         
         except Exception as e:
             print(f"处理CT图像过程中发生错误: {str(e)}")
@@ -989,12 +751,9 @@ def get_patient_info(request, patient_id):
 # AJAX接口：执行诊断
 @csrf_exempt
 def ajax_diagnose(request):
-    """AJAX接口：执行诊断"""
+    """AJAX接口：提交诊断任务，结果通过任务状态接口获取"""
     if request.method == 'POST':
         try:
-            import threading
-            from django.db import transaction
-            
             data = json.loads(request.body)
             patient_id = data.get('patient_id')
 
@@ -1002,24 +761,6 @@ def ajax_diagnose(request):
                 return JsonResponse({'success': False, 'error': '缺少患者ID'})
             
             print(f"接收到患者 {patient_id} 的AJAX诊断请求")
-
-            # 检查最近的诊断记录
-            recent_diagnosis = check_recent_diagnosis(patient_id, 120)
-            if recent_diagnosis:
-                # 如果存在最近的诊断记录，使用该记录的结果
-                print(f"发现患者 {patient_id} 的最近诊断记录，ID: {recent_diagnosis.id}，跳过重复创建")
-                return JsonResponse({
-                    'success': True,
-                    'diagnosis_id': recent_diagnosis.id,
-                    'result_type': recent_diagnosis.result_type,
-                    'confidence': recent_diagnosis.confidence * 100,  # 转换为百分比
-                    'probabilities': {
-                        'normal': recent_diagnosis.probability_normal * 100,
-                        'mild': recent_diagnosis.probability_mild * 100,
-                        'severe': recent_diagnosis.probability_severe * 100
-                    },
-                    'message': '使用现有的诊断结果'
-                })
             
             # 获取PatientInfo中的患者信息和图像信息
             try:
@@ -1033,232 +774,27 @@ def ajax_diagnose(request):
                         'success': False, 
                         'error': f'当前仅支持US超声诊断，患者图像类型为: {patient_info.image_style}'
                     })
-                
-                image_path = patient_info.image.path
-                print(f"使用PatientInfo中的图像: {image_path}")
                     
             except PatientInfo.DoesNotExist:
                 print(f"找不到ID为{patient_id}的患者图像信息")
                 return JsonResponse({'success': False, 'error': f'找不到ID为{patient_id}的患者图像信息'})
-            except Exception as e:
-                print(f"获取患者数据失败: {str(e)}")
-                return JsonResponse({'success': False, 'error': f'获取患者数据失败: {str(e)}'})
-            
-            # 检查此患者是否正在执行远程诊断
-            global _remote_executions
-            current_time = datetime.now()
-            
-            if patient_id in _remote_executions:
-                timestamp, status, cached_result = _remote_executions[patient_id]
-                
-                # 如果已有已完成的结果且不超过10分钟，直接使用缓存的结果
-                if status == 'completed' and cached_result is not None and (current_time - timestamp).total_seconds() < 600:
-                    print(f"患者 {patient_id} 已有缓存的远程执行结果，将直接使用")
-                    
-                    # 检查cached_result的类型，如果是tuple则转换为字典
-                    if isinstance(cached_result, tuple) and len(cached_result) >= 3:
-                        probabilities = {
-                            'normal': cached_result[0],
-                            'mild': cached_result[1], 
-                            'severe': cached_result[2]
-                        }
-                    elif isinstance(cached_result, dict):
-                        probabilities = cached_result
-                    else:
-                        print(f"缓存结果格式不正确: {type(cached_result)}, 值: {cached_result}")
-                        # 使用mock数据
-                        probabilities = mock_diagnosis(patient_id, patient_info.image.path if patient_info.image else None)
-                    
-                    # 确定最大概率所对应的类型
-                    max_prob_type = max(probabilities, key=probabilities.get)
-                    max_prob = probabilities[max_prob_type]
-                    
-                    # 映射回前端使用的类型
-                    result_type_map = {
-                        'normal': 'Normal',
-                        'mild': 'Mild',
-                        'severe': 'Severe'
-                    }
-                    result_type = result_type_map[max_prob_type]
-                    
-                    # 使用事务创建诊断结果记录
-                    with transaction.atomic():
-                        # 再次检查最近的诊断记录（防止并发）
-                        recent_check = check_recent_diagnosis(patient_id, 5)
-                        if recent_check:
-                            print(f"发现患者 {patient_id} 的最近诊断记录，ID: {recent_check.id}，使用该记录")
-                            return JsonResponse({
-                                'success': True,
-                                'diagnosis_id': recent_check.id,
-                                'result_type': recent_check.result_type,
-                                'confidence': recent_check.confidence * 100,
-                                'probabilities': {
-                                    'normal': recent_check.probability_normal * 100,
-                                    'mild': recent_check.probability_mild * 100,
-                                    'severe': recent_check.probability_severe * 100
-                                },
-                                'message': '使用已创建的诊断结果'
-                            })
-                        
-                        # 创建诊断结果
-                        diagnosis_result = DiagnosisResult.objects.create(
-                            patient=patient_info,
-                            result_type=result_type,
-                            confidence=max_prob,
-                            probability_normal=probabilities['normal'],
-                            probability_mild=probabilities['mild'],
-                            probability_severe=probabilities['severe'],
-                            notes=data.get('notes', ''),
-                            created_by=request.user.doctor if not request.user.is_anonymous else get_object_or_404(Doctor, doctor_id=1)  # 未登录时使用ID为1的医生
-                        )
-                        
-                        print(f"成功从缓存创建患者 {patient_id} 的诊断结果记录，ID: {diagnosis_result.id}")
-                        
-                        return JsonResponse({
-                            'success': True,
-                            'diagnosis_id': diagnosis_result.id,
-                            'result_type': result_type,
-                            'confidence': max_prob * 100,
-                            'probabilities': {
-                                'normal': probabilities['normal'] * 100,
-                                'mild': probabilities['mild'] * 100,
-                                'severe': probabilities['severe'] * 100
-                            },
-                            'message': '诊断完成（使用缓存结果）'
-                        })
-                
-                # 如果正在执行中且不超过3分钟，等待结果
-                elif status == 'running' and (current_time - timestamp).total_seconds() < 180:
-                    print(f"患者 {patient_id} 已有正在进行的远程执行任务，将等待结果")
-                    
-                    # 等待结果最多60秒
-                    probabilities = wait_for_remote_result(patient_id, timeout=60, polling_interval=3)
-                    
-                    if probabilities:
-                        print(f"成功获取到患者 {patient_id} 的远程执行结果: {probabilities}")
-                    else:
-                        print(f"等待超时，未能获取患者 {patient_id} 的远程执行结果")
-                        return JsonResponse({
-                            'success': False,
-                            'message': '远程执行超时，请稍后重试',
-                            'status': 'timeout'
-                        })
-            
-            # 如果没有获取到结果，或者没有正在执行的任务，启动新的Mock诊断
-            if 'probabilities' not in locals() or probabilities is None:
-                print(f"为患者 {patient_id} 启动Mock诊断")
-                
-                # 标记执行状态为running
-                _remote_executions[patient_id] = (current_time, 'running', None)
-                
-                # 使用Mock诊断替代远程模型调用
-                try:
-                    confidences, result_type = mock_diagnosis(patient_id, image_path)
-                    
-                    # 更新执行状态为完成
-                    _remote_executions[patient_id] = (current_time, 'completed', (confidences, result_type))
-                    
-                except Exception as e:
-                    print(f"Mock诊断执行失败: {str(e)}")
-                    _remote_executions[patient_id] = (current_time, 'error', None)
-                    return JsonResponse({
-                        'success': False,
-                        'message': f'诊断执行失败: {str(e)}',
-                        'status': 'failed'
-                    })
-                
-                # 最终验证是否有结果
-                if 'confidences' not in locals() or confidences is None:
-                    print(f"Mock诊断未返回有效结果")
-                    return JsonResponse({
-                        'success': False,
-                        'message': '诊断未返回有效结果，请稍后重试',
-                        'status': 'failed'
-                    })
             
-            # 确定最大置信度（只考虑confidence_开头的键）
-            confidence_keys = [k for k in confidences.keys() if k.startswith('confidence_')]
-            max_confidence_key = max(confidence_keys, key=lambda k: confidences[k])
-            max_confidence = confidences[max_confidence_key]
+            # 命中推理缓存时直接返回，不再排队
+            cached = cached_medcoss_result(patient_info)
+            if cached is not None:
+                print(f"患者 {patient_id} 命中推理缓存，直接返回诊断结果")
+                confidences = dict(cached['confidences'])
+                confidences['data_source_label'] = 'AI模型推理结果（缓存）'
+                result = save_medcoss_result(patient_info, confidences, cached['result_type'], get_current_doctor(request))
+                result['cache_hit'] = True
+                return JsonResponse(result)
             
-            # 使用事务创建诊断结果记录
-            with transaction.atomic():
-                # 再次检查最近的诊断记录（可能在等待期间由其他请求创建）
-                recent_check = check_recent_diagnosis(patient_id, 10)
-                if recent_check:
-                    print(f"发现患者 {patient_id} 在等待期间创建的诊断记录（ID: {recent_check.id}），直接返回")
-                    return JsonResponse({
-                        'success': True,
-                        'diagnosis_id': recent_check.id,
-                        'message': '使用等待期间创建的诊断结果',
-                        'result_type': recent_check.result_type,
-                        'confidence': recent_check.confidence * 100,
-                        'probabilities': {
-                            'normal': recent_check.probability_normal * 100,
-                            'mild': recent_check.probability_mild * 100,
-                            'severe': recent_check.probability_severe * 100
-                        }
-                    })
-                
-                # 获取当前登录的医生信息
-                doctor = None
-                if not request.user.is_anonymous and hasattr(request.user, 'doctor'):
-                    doctor = request.user.doctor
-                else:
-                    # 尝试从会话中获取医生ID
-                    doctor_id = request.session.get('doctor_id')
-                    if doctor_id:
-                        try:
-                            doctor = Doctor.objects.get(doctor_id=doctor_id)
-                            print(f"从会话中恢复医生信息，ID: {doctor_id}")
-                        except Doctor.DoesNotExist:
-                            print(f"无法找到ID为{doctor_id}的医生")
-                    
-                    # 如果仍然无法获取医生信息，使用ID为1的医生
-                    if not doctor:
-                        doctor = get_object_or_404(Doctor, doctor_id=1)
-                        print(f"使用默认医生，ID: 1")
-                
-                # 创建DiagResult诊断结果
-                diag_result = DiagResult.objects.create(
-                    patient=patient_info,
-                    result_type=result_type,
-                    confidence_0=confidences['confidence_0'],
-                    confidence_1=confidences['confidence_1'],
-                    confidence_2=confidences['confidence_2'],
-                    confidence_3=confidences['confidence_3'],
-                    confidence_4=confidences['confidence_4'],
-                    confidence_5=confidences['confidence_5'],
-                    confidence_6=confidences['confidence_6'],
-                    confidence_7=confidences['confidence_7'],
-                    image=patient_info.image,
-                    data_source=confidences.get('data_source', 'unknown'),
-                    data_source_label=confidences.get('data_source_label', '未知数据源'),
-                    created_by=doctor
-                )
-                
-                print(f"成功创建患者 {patient_id} 的DiagResult记录，ID: {diag_result.id}")
-                
-                return JsonResponse({
-                    'success': True,
-                    'diagnosis_id': diag_result.id,
-                    'result_type': result_type,
-                    'confidence': max_confidence * 100,
-                    'confidences': {
-                        'confidence_0': confidences['confidence_0'] * 100,
-                        'confidence_1': confidences['confidence_1'] * 100,
-                        'confidence_2': confidences['confidence_2'] * 100,
-                        'confidence_3': confidences['confidence_3'] * 100,
-                        'confidence_4': confidences['confidence_4'] * 100,
-                        'confidence_5': confidences['confidence_5'] * 100,
-                        'confidence_6': confidences['confidence_6'] * 100,
-                        'confidence_7': confidences['confidence_7'] * 100
-                    },
-                    'data_source': confidences.get('data_source', 'unknown'),
-                    'data_source_label': confidences.get('data_source_label', '未知数据源'),
-                    'message': '盆腹腔外伤诊断完成'
-                })
+            # 提交诊断任务（同一患者进行中的任务不会重复提交）
+            job, created = submit_job('medcoss', patient_info, get_current_doctor(request))
+            return job_submitted_response(job, created)
 
+        except json.JSONDecodeError:
+            return JsonResponse({'success': False, 'error': '无效的JSON数据'})
         except Exception as e:
             print(f"诊断过程发生错误: {str(e)}")
             import traceback
@@ -1267,10 +803,35 @@ def ajax_diagnose(request):
 
     return JsonResponse({'success': False, 'error': '仅支持POST请求'})
 
+def cached_medcoss_result(patient_info):
+    """只使用已保存的影像哈希和权重哈希做快速预检查，不在请求中读取整个影像或权重文件"""
+    try:
+        model_weights = model_client.resolve_checkpoint()
+        if model_weights is None:
+            return None
+        key = inference_cache.make_key(patient_info.image.path, model_weights, patient_info, compute=False)
+        return inference_cache.lookup(key, count_miss=False)
+    except Exception as e:
+        print(f"查询推理缓存失败: {str(e)}")
+        return None
+
+# 推理结果缓存状态
+def inference_cache_status(request):
+    """返回推理缓存的条目数、大小和命中率"""
+    return JsonResponse({'status': 'success', 'data': inference_cache.stats()})
+
+# 诊断任务状态
+def job_status(request, job_id):
+    """返回诊断任务的状态、进度和结果，只能查看自己提交的或自己患者的任务"""
+    doctor = get_current_doctor(request)
+    jobs = DiagnosisJob.objects.filter(Q(created_by=doctor) | Q(patient__created_by=doctor))
+    job = get_object_or_404(jobs, id=job_id)
+    return JsonResponse({'success': True, 'job': job.to_dict()})
+
 # 直接运行远程模型（不需要上传CT图像）
 @csrf_exempt
 def run_remote_diagnosis(request):
-    """运行远程模型诊断，可直接从前端调用"""
+    """提交远程模型诊断任务，可直接从前端调用"""
     if request.method != 'POST':
         return JsonResponse({'status': 'error', 'message': '仅支持POST请求'}, status=405)
     
@@ -1284,28 +845,43 @@ def run_remote_diagnosis(request):
         
         # 获取患者对象
         try:
-            patient = Patient.objects.get(patient_id=patient_id)
-        except Patient.DoesNotExist:
+            patient_info = PatientInfo.objects.get(patient_id=patient_id)
+        except PatientInfo.DoesNotExist:
             return JsonResponse({'status': 'error', 'message': f'未找到ID为{patient_id}的患者'}, status=404)
         
-        # 直接运行远程模型
-        run_remote_model(patient=patient, from_api=True)
+        # 提交远程诊断任务
+        job, created = submit_job('remote', patient_info, get_current_doctor(request))
         
-        # 直接返回成功响应
         return JsonResponse({
             'status': 'success',
-            'message': '模型诊断请求已提交',
+            'message': '模型诊断请求已提交' if created else '该患者已有进行中的诊断任务',
             'data': {
                 'patient_id': patient_id,
+                'job_id': job.id,
+                'status_url': reverse('diagnosis:job_status', args=[job.id]),
                 'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             }
-        })
+        }, status=202)
     
     except json.JSONDecodeError:
         return JsonResponse({'status': 'error', 'message': '无效的JSON数据'}, status=400)
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
+# MedCoss推理服务状态
+def model_server_status(request):
+    """返回常驻推理服务中已加载的模型及其内存占用"""
+    try:
+        status = model_client.server_status()
+    except model_client.ModelServerError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=503)
+    return JsonResponse({'status': 'success', 'data': status})
+
+# 远程服务器SSH连接池状态
+def remote_pool_status(request):
+    """返回SSH连接池的连接数、channel数、重连次数等指标"""
+    return JsonResponse({'status': 'success', 'data': pool_metrics()})
+
 def diagnosis_database(request):
     """
     诊断数据库页面视图，仅渲染前端模板
@@ -1324,9 +900,6 @@ def upload_patient_images(request):
                 messages.error(request, '请选择要上传的图像文件')
                 return redirect('diagnosis:upload_patient_images')
             
-            from patient_records.models import PatientInfo
-            from django.db import transaction
-            
             # 获取当前登录的医生
             doctor_id = request.session.get('doctor_id')
             if not doctor_id:
@@ -1338,62 +911,19 @@ def upload_patient_images(request):
             success_count = 0
             error_files = []
             
-            with transaction.atomic():
-                for uploaded_file in uploaded_files:
-                    try:
-                        # 检查文件格式
-                        if not uploaded_file.name.lower().endswith('.nii.gz'):
-                            error_files.append(f"{uploaded_file.name}: 不支持的文件格式，只支持.nii.gz格式")
-                            continue
-                        
-                        # 从文件名中提取患者ID
-                        file_name = uploaded_file.name
-                        patient_id = extract_patient_id_from_filename(file_name)
-                        
-                        if not patient_id:
-                            error_files.append(f"{uploaded_file.name}: 无法从文件名中提取患者ID")
-                            continue
-                        
-                        # 确定存储路径
-                        import os
-                        from django.conf import settings
-                        
-                        # 获取图像类型对应的文件夹
-                        type_folder_map = {
-                            'US': 'US',
-                            'CT': 'CT', 
-                            'MRI': 'MRI',
-                            'X-ray': 'X-ray'
-                        }
-                        folder_name = type_folder_map.get(image_type, 'CT')
-                        
-                        # 创建目标目录
-                        upload_dir = os.path.join('data', 'upload', folder_name)
-                        full_upload_dir = os.path.join(settings.BASE_DIR, upload_dir)
-                        os.makedirs(full_upload_dir, exist_ok=True)
-                        
-                        # 构建文件路径
-                        file_path = os.path.join(upload_dir, uploaded_file.name)
-                        full_file_path = os.path.join(full_upload_dir, uploaded_file.name)
-                        
-                        # 保存文件到指定目录
-                        with open(full_file_path, 'wb+') as destination:
-                            for chunk in uploaded_file.chunks():
-                                destination.write(chunk)
-                        
-                        # 创建PatientInfo记录
-                        patient_info = PatientInfo.objects.create(
-                            patient_id=patient_id,
-                            image_style=image_type,
-                            image=file_path,
-                            created_by=doctor
-                        )
-                        
-                        success_count += 1
-                        
-                    except Exception as e:
-                        error_files.append(f"{uploaded_file.name}: {str(e)}")
-                        continue
+            # 每个文件单独保存和提交，不再让整批文件共用一个事务
+            for uploaded_file in uploaded_files:
+                try:
+                    patient_id = validate_filename(uploaded_file.name)
+                    patient_info = store_patient_image(patient_id, uploaded_file.name, image_type, doctor,
+                                                       chunks=uploaded_file.chunks())
+                    # 后台校验文件头、计算哈希并生成切片缓存
+                    schedule_image_processing(patient_info.pk)
+                    success_count += 1
+                except UploadError as e:
+                    error_files.append(str(e))
+                except Exception as e:
+                    error_files.append(f"{uploaded_file.name}: {str(e)}")
             
             # 显示结果消息
             if success_count > 0:
@@ -1412,6 +942,88 @@ def upload_patient_images(request):
     # GET请求，显示上传页面
     return render(request, 'diagnosis/upload_patient_images.html')
 
+def _upload_error_response(error):
+    data = {'success': False, 'error': str(error)}
+    if error.upload is not None:
+        data['upload'] = error.upload.to_dict()
+    return JsonResponse(data, status=error.status)
+
+def _session_doctor(request):
+    doctor_id = request.session.get('doctor_id')
+    if not doctor_id:
+        return None
+    return Doctor.objects.filter(doctor_id=doctor_id).first()
+
+# 分块上传：创建或恢复上传会话
+def upload_init(request):
+    """POST: filename, size, image_type, fingerprint；返回upload_id和已接收字节数"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': '仅支持POST请求'}, status=405)
+    doctor = _session_doctor(request)
+    if doctor is None:
+        return JsonResponse({'success': False, 'error': '请先登录'}, status=401)
+    
+    try:
+        filename = os.path.basename(request.POST.get('filename', ''))
+        total_size = int(request.POST.get('size', 0))
+        upload = init_upload(
+            doctor,
+            filename,
+            total_size,
+            request.POST.get('image_type', 'CT'),
+            request.POST.get('fingerprint') or f"{filename}|{total_size}",
+        )
+    except UploadError as e:
+        return _upload_error_response(e)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': '文件大小参数无效'}, status=400)
+    
+    return JsonResponse({'success': True, 'upload': upload.to_dict(), 'chunk_size': settings.UPLOAD_CHUNK_SIZE})
+
+# 分块上传：写入一个数据块
+def upload_chunk(request, upload_id):
+    """POST: offset, chunk(文件字段)"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': '仅支持POST请求'}, status=405)
+    doctor = _session_doctor(request)
+    if doctor is None:
+        return JsonResponse({'success': False, 'error': '请先登录'}, status=401)
+    
+    chunk = request.FILES.get('chunk')
+    if chunk is None:
+        return JsonResponse({'success': False, 'error': '缺少数据块'}, status=400)
+    try:
+        offset = int(request.POST.get('offset', -1))
+        upload = write_chunk(upload_id, doctor, offset, chunk.read())
+    except UploadError as e:
+        return _upload_error_response(e)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': '偏移量参数无效'}, status=400)
+    
+    return JsonResponse({'success': True, 'upload': upload.to_dict()})
+
+# 分块上传：全部数据块接收完毕
+def upload_complete(request, upload_id):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': '仅支持POST请求'}, status=405)
+    doctor = _session_doctor(request)
+    if doctor is None:
+        return JsonResponse({'success': False, 'error': '请先登录'}, status=401)
+    
+    try:
+        upload = complete_upload(upload_id, doctor)
+    except UploadError as e:
+        return _upload_error_response(e)
+    return JsonResponse({'success': upload.status != 'failed', 'upload': upload.to_dict(), 'error': upload.error})
+
+# 分块上传：查询上传和后台处理进度
+def upload_status(request, upload_id):
+    doctor = _session_doctor(request)
+    if doctor is None:
+        return JsonResponse({'success': False, 'error': '请先登录'}, status=401)
+    upload = get_object_or_404(PatientImageUpload, upload_id=upload_id, created_by=doctor)
+    return JsonResponse({'success': True, 'upload': upload.to_dict()})
+
 def extract_patient_id_from_filename(filename):
     """从文件名中提取患者ID"""
     import re
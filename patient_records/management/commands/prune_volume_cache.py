@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from patient_records import volume_cache
+
+
+class Command(BaseCommand):
+    help = '按使用时间和总大小清理影像切片缓存（多分辨率金字塔）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-days', type=int, default=None,
+                            help='删除超过该天数未打开的金字塔（默认 VOLUME_CACHE_MAX_AGE_DAYS）')
+        parser.add_argument('--max-bytes', type=int, default=None,
+                            help='缓存目录总大小上限（默认 VOLUME_CACHE_MAX_BYTES）')
+
+    def handle(self, *args, **options):
+        removed = volume_cache.evict(options['max_age_days'], options['max_bytes'])
+        stats = volume_cache.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"已删除 {removed} 个金字塔，剩余 {stats['entries']} 个，共 {stats['total_bytes']} 字节"
+        ))
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.20 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient_records', '0002_alter_patient_options_alter_patient_table_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientinfo',
+            name='image_status',
+            field=models.CharField(choices=[('pending', '待校验'), ('valid', '有效'), ('invalid', '无效')], default='pending', max_length=20, verbose_name='影像校验状态'),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='image_error',
+            field=models.TextField(blank=True, default='', verbose_name='影像校验错误'),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='content_sha256',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64, verbose_name='文件内容SHA256'),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='image_shape',
+            field=models.JSONField(blank=True, null=True, verbose_name='影像维度'),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='image_spacing',
+            field=models.JSONField(blank=True, null=True, verbose_name='体素间距'),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='image_affine',
+            field=models.JSONField(blank=True, null=True, verbose_name='仿射矩阵'),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='image_dtype',
+            field=models.CharField(blank=True, default='', max_length=20, verbose_name='数据类型'),
+        ),
+        migrations.CreateModel(
+            name='PatientImageUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name='上传ID')),
+                ('filename', models.CharField(max_length=255, verbose_name='文件名')),
+                ('image_type', models.CharField(max_length=30, verbose_name='医学图像类别')),
+                ('fingerprint', models.CharField(db_index=True, max_length=300, verbose_name='文件标识')),
+                ('total_size', models.BigIntegerField(verbose_name='文件大小')),
+                ('received_bytes', models.BigIntegerField(default=0, verbose_name='已接收字节数')),
+                ('status', models.CharField(choices=[('uploading', '上传中'), ('processing', '后台处理中'), ('completed', '已完成'), ('failed', '失败')], default='uploading', max_length=20, verbose_name='状态')),
+                ('progress', models.IntegerField(default=0, verbose_name='处理进度')),
+                ('message', models.CharField(blank=True, default='', max_length=200, verbose_name='进度说明')),
+                ('error', models.TextField(blank=True, default='', verbose_name='错误信息')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='patient_records.doctor', verbose_name='上传医生')),
+                ('patient', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='uploads', to='patient_records.patientinfo', verbose_name='患者医学图像')),
+            ],
+            options={
+                'verbose_name': '影像上传',
+                'verbose_name_plural': '影像上传',
+                'db_table': 'patient_image_upload',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
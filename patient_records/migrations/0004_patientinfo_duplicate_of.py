@@ -0,0 +1,19 @@
+# Generated by Django 4.2.20 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient_records', '0003_patientinfo_image_metadata_patientimageupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientinfo',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='patient_records.patientinfo', verbose_name='重复影像'),
+        ),
+    ]
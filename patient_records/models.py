@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import User
@@ -30,6 +32,23 @@ class PatientInfo(models.Model):
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
     created_by = models.ForeignKey('Doctor', on_delete=models.CASCADE, verbose_name='创建人')
 
+    # 上传后由后台任务校验NIfTI文件头并提取（patient_records.tasks.process_patient_image）
+    IMAGE_STATUS_CHOICES = [
+        ('pending', '待校验'),
+        ('valid', '有效'),
+        ('invalid', '无效'),
+    ]
+    image_status = models.CharField(max_length=20, choices=IMAGE_STATUS_CHOICES, default='pending', verbose_name='影像校验状态')
+    image_error = models.TextField(blank=True, default='', verbose_name='影像校验错误')
+    content_sha256 = models.CharField(max_length=64, blank=True, default='', db_index=True, verbose_name='文件内容SHA256')
+    image_shape = models.JSONField(null=True, blank=True, verbose_name='影像维度')
+    image_spacing = models.JSONField(null=True, blank=True, verbose_name='体素间距')
+    image_affine = models.JSONField(null=True, blank=True, verbose_name='仿射矩阵')
+    image_dtype = models.CharField(max_length=20, blank=True, default='', verbose_name='数据类型')
+    # 与已有影像内容完全相同（SHA256一致）时指向最早的那条记录
+    duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='duplicates', verbose_name='重复影像')
+
     
     class Meta:
         db_table = 'patient_image_info'
@@ -40,6 +59,55 @@ class PatientInfo(models.Model):
         return f"{self.patient_id} - {self.image_style}"
 
 
+class PatientImageUpload(models.Model):
+    """分块上传会话，记录已接收的字节数以便断点续传"""
+    STATUS_CHOICES = [
+        ('uploading', '上传中'),
+        ('processing', '后台处理中'),
+        ('completed', '已完成'),
+        ('failed', '失败'),
+    ]
+
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False, verbose_name='上传ID')
+    filename = models.CharField(max_length=255, verbose_name='文件名')
+    image_type = models.CharField(max_length=30, verbose_name='医学图像类别')
+    # 客户端文件标识（文件名|大小|修改时间），用于重新选择同一文件时续传
+    fingerprint = models.CharField(max_length=300, db_index=True, verbose_name='文件标识')
+    total_size = models.BigIntegerField(verbose_name='文件大小')
+    received_bytes = models.BigIntegerField(default=0, verbose_name='已接收字节数')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading', verbose_name='状态')
+    progress = models.IntegerField(default=0, verbose_name='处理进度')
+    message = models.CharField(max_length=200, blank=True, default='', verbose_name='进度说明')
+    error = models.TextField(blank=True, default='', verbose_name='错误信息')
+    patient = models.ForeignKey(PatientInfo, on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='uploads', verbose_name='患者医学图像')
+    created_by = models.ForeignKey('Doctor', on_delete=models.CASCADE, verbose_name='上传医生')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+
+    class Meta:
+        db_table = 'patient_image_upload'
+        verbose_name = '影像上传'
+        verbose_name_plural = '影像上传'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.filename} ({self.status})"
+
+    def to_dict(self):
+        return {
+            'upload_id': str(self.upload_id),
+            'filename': self.filename,
+            'status': self.status,
+            'total_size': self.total_size,
+            'received_bytes': self.received_bytes,
+            'progress': self.progress,
+            'message': self.message,
+            'error': self.error,
+            'patient_id': self.patient_id,
+        }
+
+
 class Patient(models.Model):
     """患者信息表"""
     GENDER_CHOICES = (
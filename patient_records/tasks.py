@@ -0,0 +1,141 @@
+"""
+影像上传后处理和缓存相关的Celery任务
+"""
+import hashlib
+import logging
+import math
+
+from celery import shared_task
+
+from . import volume_cache
+from .models import PatientImageUpload, PatientInfo
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _update_upload(upload_id, **fields):
+    if upload_id:
+        PatientImageUpload.objects.filter(upload_id=upload_id).update(**fields)
+
+
+def file_sha256(path):
+    """按块计算文件内容的SHA256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_nifti_geometry(path):
+    """读取并校验NIfTI文件头（不解码体素数据），返回几何信息字典"""
+    import nibabel as nib
+
+    try:
+        img = nib.load(path)
+    except Exception as e:
+        raise ValueError(f'无法解析NIfTI文件头: {str(e)}')
+
+    shape = [int(s) for s in img.header.get_data_shape()]
+    if len(shape) not in (3, 4):
+        raise ValueError(f'不支持的影像维度: {shape}')
+    if any(s <= 0 for s in shape):
+        raise ValueError(f'影像维度无效: {shape}')
+
+    spacing = [float(z) for z in img.header.get_zooms()[:3]]
+    if any(not math.isfinite(z) or z <= 0 for z in spacing):
+        raise ValueError(f'体素间距无效: {spacing}')
+
+    affine = img.affine
+    if not all(math.isfinite(float(v)) for v in affine.flat):
+        raise ValueError('仿射矩阵包含无效数值')
+
+    return {
+        'image_shape': shape,
+        'image_spacing': spacing,
+        'image_affine': [[float(v) for v in row] for row in affine],
+        'image_dtype': str(img.get_data_dtype()),
+    }
+
+
+@shared_task
+def process_patient_image(patient_info_id, upload_id=None):
+    """
+    上传完成后的处理: 校验NIfTI文件头、计算内容哈希、提取几何信息写入PatientInfo，
+    然后提交切片缓存生成任务。进度写回上传记录供页面轮询。
+    """
+    patient_info = PatientInfo.objects.filter(pk=patient_info_id).first()
+    if patient_info is None or not patient_info.image:
+        _update_upload(upload_id, status='failed', error='影像记录不存在')
+        return None
+
+    image_path = patient_info.image.path
+    try:
+        _update_upload(upload_id, progress=20, message='计算文件哈希')
+        sha256 = file_sha256(image_path)
+
+        _update_upload(upload_id, progress=50, message='校验文件头')
+        geometry = read_nifti_geometry(image_path)
+    except Exception as e:
+        logger.warning(f"影像 {image_path} 校验失败: {str(e)}")
+        PatientInfo.objects.filter(pk=patient_info_id).update(image_status='invalid', image_error=str(e))
+        _update_upload(upload_id, status='failed', progress=100, message='校验失败', error=str(e))
+        return 'invalid'
+
+    # 内容完全相同的影像只关联到最早的记录，推理结果缓存也按内容哈希复用
+    original = PatientInfo.objects.filter(
+        content_sha256=sha256, duplicate_of__isnull=True
+    ).exclude(pk=patient_info_id).order_by('created_at').first()
+
+    PatientInfo.objects.filter(pk=patient_info_id).update(
+        image_status='valid',
+        image_error='',
+        content_sha256=sha256,
+        duplicate_of=original,
+        **geometry
+    )
+    logger.info(f"影像 {image_path} 校验通过，维度 {geometry['image_shape']}，SHA256 {sha256[:12]}")
+
+    schedule_volume_pyramid(image_path)
+    if original is not None:
+        logger.info(f"影像 {image_path} 与患者 {original.patient_id} 的影像内容相同")
+        message = f'处理完成（与患者 {original.patient_id} 的影像内容相同）'
+    else:
+        message = '处理完成'
+    _update_upload(upload_id, status='completed', progress=100, message=message)
+    return 'valid'
+
+
+def schedule_image_processing(patient_info_id, upload_id=None):
+    """提交上传后处理任务；队列不可用时标记失败，不影响已保存的文件"""
+    try:
+        process_patient_image.delay(patient_info_id, str(upload_id) if upload_id else None)
+    except Exception as e:
+        logger.warning(f"提交影像处理任务失败 {patient_info_id}: {str(e)}")
+        _update_upload(upload_id, status='failed', error=f'文件已保存，但后台处理任务提交失败: {str(e)}')
+
+
+@shared_task
+def build_volume_pyramid(image_path):
+    """上传后在后台生成多分辨率切片缓存，查看器首次打开时无需等待解码"""
+    try:
+        key = volume_cache.build_pyramid(image_path)
+    except Exception as e:
+        logger.error(f"生成影像金字塔失败 {image_path}: {str(e)}", exc_info=True)
+        return None
+    try:
+        # 新金字塔写入后按总大小和使用时间清理，缓存目录不会随上传无限增长
+        volume_cache.evict()
+    except Exception as e:
+        logger.warning(f"清理影像金字塔缓存失败: {str(e)}")
+    return key
+
+
+def schedule_volume_pyramid(image_path):
+    """提交后台生成任务；队列不可用时只记录日志，首次查看时会同步生成"""
+    try:
+        build_volume_pyramid.delay(str(image_path))
+    except Exception as e:
+        logger.warning(f"提交影像金字塔任务失败 {image_path}: {str(e)}")
@@ -30,6 +30,11 @@ urlpatterns = [
     
     # 医学影像预览
     path('image_preview/<int:patient_info_id>/', views.image_preview, name='image_preview'),
+
+    # 服务端切片服务：元信息、单张切片、批量预取
+    path('volume/<int:patient_info_id>/meta/', views.volume_meta, name='volume_meta'),
+    path('volume/<int:patient_info_id>/slice/', views.volume_slice, name='volume_slice'),
+    path('volume/<int:patient_info_id>/slices/', views.volume_slices, name='volume_slices'),
     
     # 调试视图
     path('debug/session/', views.debug_session, name='debug_session'),
@@ -10,6 +10,8 @@ from django.core.mail import send_mail
 from django.views.decorators.csrf import csrf_exempt
 import re
 from .models import Patient, Doctor, ClinicalFeature, PatientInfo
+from . import volume_cache
+import base64
 import os
 import csv
 import logging
@@ -1065,4 +1067,126 @@ def debug_session(request):
         'session_cookie_age': settings.SESSION_COOKIE_AGE,
     }
     
-    return JsonResponse(debug_info)
\ No newline at end of file
+    return JsonResponse(debug_info)
+
+# ---------- 服务端切片服务（patient_records/volume_cache.py） ----------
+
+def _load_patient_volume(patient_info_id):
+    """返回 (PatientInfo, VolumePyramid)，影像不存在时抛出 VolumeCacheError"""
+    patient_info = get_object_or_404(PatientInfo, pk=patient_info_id)
+    if not patient_info.image or not os.path.exists(patient_info.image.path):
+        raise volume_cache.VolumeCacheError('该记录没有关联的影像文件')
+    return patient_info, volume_cache.get_pyramid(patient_info.image.path)
+
+
+def _slice_params(request, pyramid):
+    """解析切片请求的公共参数: 方向、窗位、窗宽（默认取影像统计的默认窗）、格式"""
+    axis = request.GET.get('axis', 'axial')
+    fmt = request.GET.get('format', 'png').lower()
+    default_center, default_width = pyramid.meta['stats']['default_window']
+    try:
+        center = float(request.GET.get('wc', default_center))
+        width = float(request.GET.get('ww', default_width))
+    except ValueError:
+        raise volume_cache.VolumeCacheError('窗宽窗位参数无效')
+    if axis not in volume_cache.AXES:
+        raise volume_cache.VolumeCacheError(f'不支持的切片方向: {axis}')
+    if fmt not in volume_cache.FORMATS:
+        raise volume_cache.VolumeCacheError(f'不支持的图像格式: {fmt}')
+    return axis, center, width, fmt
+
+
+@login_required_custom
+def volume_meta(request, patient_info_id):
+    """影像体数据元信息（金字塔未生成时同步生成）"""
+    try:
+        patient_info, pyramid = _load_patient_volume(patient_info_id)
+    except volume_cache.VolumeCacheError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=404)
+    except Exception as e:
+        logger.error(f"加载影像体数据失败: {str(e)}", exc_info=True)
+        return JsonResponse({'success': False, 'error': f'加载影像失败: {str(e)}'}, status=500)
+
+    meta = pyramid.meta
+    return JsonResponse({
+        'success': True,
+        'version': pyramid.key,
+        'shape': meta['shape'],
+        'spacing': meta['spacing'],
+        'datatype': meta['datatype'],
+        'levels': [level['factor'] for level in meta['levels']],
+        'stats': meta['stats'],
+        'default_window': meta['stats']['default_window'],
+        'depths': {axis: pyramid.level(1).depth(axis) for axis in volume_cache.AXES},
+        'max_prefetch': settings.VOLUME_PREFETCH_MAX_SLICES,
+    })
+
+
+@login_required_custom
+def volume_slice(request, patient_info_id):
+    """
+    单张窗宽窗位后的切片图像
+    GET参数: axis, index(原始分辨率下的索引，默认中间层), level(1/2/4), wc, ww, format(png/webp), v(元信息中的version)
+    """
+    try:
+        patient_info, pyramid = _load_patient_volume(patient_info_id)
+        axis, center, width, fmt = _slice_params(request, pyramid)
+        # 未指定索引时取中间层
+        index = int(request.GET.get('index', pyramid.level(1).depth(axis) // 2))
+        level = int(request.GET.get('level', 1))
+        pyramid.level(level)
+    except (volume_cache.VolumeCacheError, ValueError) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    etag = volume_cache.slice_etag(pyramid, axis, index, center, width, fmt, level)
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponse(status=304)
+    else:
+        try:
+            content = volume_cache.render_slice(pyramid, axis, index, center, width, fmt, level)
+        except volume_cache.VolumeCacheError as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        response = HttpResponse(content, content_type=volume_cache.FORMATS[fmt])
+
+    response['ETag'] = etag
+    if request.GET.get('v') == pyramid.key:
+        # URL中带有缓存版本，影像内容变化时版本随之变化
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'private, max-age=300'
+    return response
+
+
+@login_required_custom
+def volume_slices(request, patient_info_id):
+    """
+    批量预取一段切片，返回 {index: dataURL}
+    GET参数: axis, start, end(含), wc, ww, format
+    """
+    try:
+        patient_info, pyramid = _load_patient_volume(patient_info_id)
+        axis, center, width, fmt = _slice_params(request, pyramid)
+        start = int(request.GET.get('start', 0))
+        end = int(request.GET.get('end', start))
+    except (volume_cache.VolumeCacheError, ValueError) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    depth = pyramid.level(1).depth(axis)
+    start = max(0, start)
+    end = min(depth - 1, end, start + settings.VOLUME_PREFETCH_MAX_SLICES - 1)
+
+    slices = {}
+    for index in range(start, end + 1):
+        content = volume_cache.render_slice(pyramid, axis, index, center, width, fmt)
+        slices[index] = f"data:{volume_cache.FORMATS[fmt]};base64,{base64.b64encode(content).decode('ascii')}"
+
+    response = JsonResponse({
+        'success': True,
+        'version': pyramid.key,
+        'axis': axis,
+        'start': start,
+        'end': end,
+        'slices': slices,
+    })
+    response['Cache-Control'] = 'private, max-age=300'
+    return response
@@ -8,16 +8,16 @@ from django.conf import settings
 from diagnosis.models import DiagnosisResult
 from django.db.models import Q
 from .models import SegmentationResult
-import paramiko
-import tempfile
+from django.core.files import File
 from pathlib import Path
 import time
-import shutil
 from django.urls import reverse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.views.decorators.http import require_POST
 import requests
 from patient_records.models import Patient, Doctor
+from diagnosis.ssh_pool import get_pool, get_server_config
+from diagnosis.remote_worker import get_worker_client
 
 # 分割首页
 def segmentation_home(request):
@@ -69,144 +69,131 @@ def upload_xray(request, patient_id=None):
         'diagnosis': diagnosis,
     })
 
+# 等待远程结果文件出现（有界stat轮询）
+def wait_for_remote_file(sftp_client, candidate_paths, timeout, poll_interval):
+    """
+    依次stat候选路径，直到任一文件存在且非空
+    
+    Returns:
+        str: 找到的远程路径，超时返回None
+    """
+    deadline = time.time() + timeout
+    while True:
+        for path in candidate_paths:
+            try:
+                if sftp_client.stat(path).st_size > 0:
+                    return path
+            except FileNotFoundError:
+                continue
+        if time.time() >= deadline:
+            return None
+        time.sleep(poll_interval)
+
 # 远程执行分割任务
-def execute_remote_segmentation(xray_image_path, prompt_text, image_filename):
+def execute_remote_segmentation(xray_file, prompt_text, image_filename, segmentation_result):
     """
-    通过SSH连接远程服务器，执行run.py脚本进行图像分割
+    通过SSH连接远程服务器执行分割，结果直接写入segmentation_result.segmentation_image
     
     Args:
-        xray_image_path: 本地X光图像路径
+        xray_file: 上传的X光图像文件对象
         prompt_text: 医生输入的分割提示文本
         image_filename: 图像文件名
+        segmentation_result: 保存结果的SegmentationResult记录
         
     Returns:
-        tuple: (成功与否, 结果消息, 结果图像本地路径)
+        tuple: (成功与否, 结果消息, 各阶段耗时字典)
     """
+    timings = {}
+    stage_start = time.time()
+    
+    def mark(stage):
+        nonlocal stage_start
+        now = time.time()
+        timings[stage] = round(now - stage_start, 3)
+        stage_start = now
+    
     try:
-        # 远程服务器信息
-        hostname = "202.197.33.114"
-        port = 223
-        username = "xuchang"
-        password = "1"
-        
         # 远程工作目录和结果目录
-        remote_work_dir = "/data8t/xuchang/PycharmProjects/LanGuideMedSeg-MICCAI2023"
+        server = get_server_config('lgms')
+        remote_work_dir = server['project_path']
         remote_image_path = f"{remote_work_dir}/{image_filename}"
         
         # 指定Python环境激活命令，与diagnosis/views.py中的方法相同
-        python_env = "source /data8t/xuchang/anaconda3/etc/profile.d/conda.sh && conda activate lgms"
-        
-        # 创建SSH客户端
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        # 连接到远程服务器
-        ssh_client.connect(
-            hostname=hostname, 
-            port=port, 
-            username=username, 
-            password=password,
-            timeout=30,
-            allow_agent=False,
-            look_for_keys=False
-        )
-        
-        # 创建SFTP客户端
-        sftp_client = ssh_client.open_sftp()
-        
-        # 上传X光图像到远程服务器
-        sftp_client.put(xray_image_path, remote_image_path)
-        
-        # 执行分割命令
-        # 注意：转义提示文本中的引号，防止命令解析错误
-        escaped_prompt_text = prompt_text.replace('"', '\\"')
-        command = f'{python_env} && cd {remote_work_dir} && python run.py --image {image_filename} --prompt "{escaped_prompt_text}"'
-        
-        print(f"执行远程命令: {command}")
-        stdin, stdout, stderr = ssh_client.exec_command(command, timeout=180)  # 增加超时时间到180秒
-        
-        # 读取输出流和错误流，以便记录日志
-        stdout_str = stdout.read().decode('utf-8', errors='ignore')
-        stderr_str = stderr.read().decode('utf-8', errors='ignore')
-        exit_status = stdout.channel.recv_exit_status()  # 等待命令执行完成
-        
-        print(f"远程执行命令完成，退出状态: {exit_status}")
-        print(f"标准输出: {stdout_str}")
-        if stderr_str:
-            print(f"标准错误: {stderr_str}")
-        
-        if exit_status != 0:
-            return False, f"远程执行失败: {stderr_str}", None
-        
-        # 等待结果生成（增加等待时间）
-        time.sleep(10)
-        
-        # 使用正确的分割结果图像命名规则：在文件名前添加segmentation_前缀
-        result_filename = f"segmentation_{image_filename}"
-        remote_result_path = f"{remote_work_dir}/{result_filename}"
-        
-        # 创建临时目录保存结果
-        temp_dir = tempfile.mkdtemp()
-        local_result_path = os.path.join(temp_dir, result_filename)
-        
-        # 从远程服务器下载结果图像
-        try:
-            sftp_client.get(remote_result_path, local_result_path)
-            print(f"成功下载分割结果图像: {local_result_path}")
-        except FileNotFoundError:
-            # 如果找不到结果文件，尝试查找其他可能的格式
-            print(f"远程服务器上未找到默认格式的结果图像 {result_filename}，尝试其他格式...")
+        python_env = server['python_env']
+        
+        # 从连接池获取已认证的SSH连接（与诊断模块共用）
+        pool = get_pool('lgms')
+        
+        # 上传X光图像到远程服务器（直接从上传文件流式写入）
+        xray_file.seek(0)
+        with pool.sftp() as sftp_client:
+            sftp_client.putfo(xray_file, remote_image_path)
+        mark('upload')
+        
+        worker = get_worker_client('lgms')
+        if worker is not None:
+            # 常驻worker直接返回结果文件路径
+            print(f"通过常驻worker执行分割: {image_filename}")
+            result = worker.call('segment', {'image': image_filename, 'prompt': prompt_text}, timeout=180)
+            remote_result_path = result['result_path']
+            if not remote_result_path.startswith('/'):
+                remote_result_path = f"{remote_work_dir}/{remote_result_path}"
+            candidate_paths = [remote_result_path]
+        else:
+            # 执行分割命令
+            # 注意：转义提示文本中的引号，防止命令解析错误
+            escaped_prompt_text = prompt_text.replace('"', '\\"')
+            command = f'{python_env} && cd {remote_work_dir} && python run.py --image {image_filename} --prompt "{escaped_prompt_text}"'
             
-            # 列出远程工作目录中的文件
-            try:
-                remote_files = sftp_client.listdir(remote_work_dir)
-                # 尝试不同的命名规则匹配
-                potential_patterns = [
-                    f"segmentation_{image_filename}",  # segmentation_前缀
-                    f"segmentation_{image_filename.split('.')[0]}.png",  # segmentation_前缀,固定png扩展名
-                    f"{image_filename.split('.')[0]}_result.png",  # _result后缀,固定png扩展名
-                    f"{image_filename.split('.')[0]}_segmentation.png",  # _segmentation后缀
-                ]
-                
-                potential_results = []
-                for pattern in potential_patterns:
-                    if pattern in remote_files:
-                        potential_results.append(pattern)
-                
-                # 如果没找到，尝试更宽松的匹配
-                if not potential_results:
-                    for file in remote_files:
-                        # 检查文件名是否包含原图像名(不含扩展名)，以及是否包含segmentation或result关键词
-                        base_name = image_filename.split('.')[0]
-                        if base_name in file and ('segmentation' in file.lower() or 'result' in file.lower()):
-                            potential_results.append(file)
-                
-                if potential_results:
-                    # 找到可能的结果文件，下载第一个
-                    result_filename = potential_results[0]
-                    remote_result_path = f"{remote_work_dir}/{result_filename}"
-                    local_result_path = os.path.join(temp_dir, result_filename)
-                    
-                    print(f"找到可能的结果文件: {result_filename}，尝试下载...")
-                    sftp_client.get(remote_result_path, local_result_path)
-                    print(f"成功下载可能的结果图像: {local_result_path}")
-                else:
-                    print("未找到任何可能的结果图像文件")
-                    return False, "远程服务器上未找到任何结果图像文件", None
-            except Exception as e:
-                print(f"尝试查找其他结果格式时出错: {str(e)}")
-                return False, f"查找结果图像失败: {str(e)}", None
-        
-        # 关闭连接
-        sftp_client.close()
-        ssh_client.close()
-        
-        return True, "分割成功", local_result_path
+            print(f"执行远程命令: {command}")
+            exit_status, stdout_str, stderr_str = pool.exec_command(command, timeout=180)  # 增加超时时间到180秒
+            
+            print(f"远程执行命令完成，退出状态: {exit_status}")
+            print(f"标准输出: {stdout_str}")
+            if stderr_str:
+                print(f"标准错误: {stderr_str}")
+            
+            if exit_status != 0:
+                return False, f"远程执行失败: {stderr_str}", timings
+            
+            # 结果图像命名规则：默认在文件名前添加segmentation_前缀，其余为兼容的旧命名
+            base_name = os.path.splitext(image_filename)[0]
+            candidate_paths = [f"{remote_work_dir}/{name}" for name in (
+                f"segmentation_{image_filename}",
+                f"segmentation_{base_name}.png",
+                f"{base_name}_result.png",
+                f"{base_name}_segmentation.png",
+            )]
+        mark('remote_run')
+        
+        with pool.sftp() as sftp_client:
+            # 命令退出后结果通常已写好，只在未出现时做有界轮询
+            remote_result_path = wait_for_remote_file(
+                sftp_client, candidate_paths,
+                timeout=settings.SEGMENTATION_RESULT_TIMEOUT,
+                poll_interval=settings.SEGMENTATION_RESULT_POLL_INTERVAL
+            )
+            mark('wait_result')
+            if remote_result_path is None:
+                print(f"远程服务器上未找到分割结果图像: {candidate_paths}")
+                return False, "远程服务器上未找到分割结果图像", timings
+            
+            # 从远程服务器直接流式写入Django存储
+            result_filename = os.path.basename(remote_result_path)
+            with sftp_client.open(remote_result_path, 'rb') as remote_file:
+                remote_file.prefetch()
+                segmentation_result.segmentation_image.save(
+                    result_filename, File(remote_file, name=result_filename), save=True
+                )
+            mark('download')
+        
+        print(f"成功保存分割结果图像: {segmentation_result.segmentation_image.name}，各阶段耗时: {timings}")
+        return True, "分割成功", timings
     
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return False, f"SSH连接或命令执行出错: {str(e)}", None
+        return False, f"SSH连接或命令执行出错: {str(e)}", timings
 
 # 处理X光图像上传的API
 @csrf_exempt
@@ -273,51 +260,21 @@ def api_upload_xray(request):
                 created_by=doctor
             )
             
-            # 保存X光图像到本地临时文件
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(xray_image.name)[1]) as temp_file:
-                for chunk in xray_image.chunks():
-                    temp_file.write(chunk)
-                temp_file_path = temp_file.name
-            
-            print(f"正在处理图像: {xray_image.name}, 临时文件路径: {temp_file_path}")
+            print(f"正在处理图像: {xray_image.name}")
             
-            # 远程执行分割
-            success, message, result_image_path = execute_remote_segmentation(
-                temp_file_path, 
+            # 远程执行分割，结果直接写入segmentation_image
+            request_start = time.time()
+            success, message, timings = execute_remote_segmentation(
+                xray_image, 
                 prompt_text, 
-                os.path.basename(xray_image.name)
+                os.path.basename(xray_image.name),
+                segmentation_result
             )
+            timings['total'] = round(time.time() - request_start, 3)
             
-            print(f"分割执行结果: 成功={success}, 消息={message}, 结果路径={result_image_path}")
+            print(f"分割执行结果: 成功={success}, 消息={message}, 耗时={timings}")
             
-            if success and result_image_path:
-                # 将结果图像保存到数据库
-                result_filename = os.path.basename(result_image_path)
-                result_path = os.path.join('segmentation_results', result_filename)
-                
-                # 确保media目录下有segmentation_results文件夹
-                media_path = os.path.join(settings.MEDIA_ROOT, 'segmentation_results')
-                os.makedirs(media_path, exist_ok=True)
-                
-                # 复制结果图像到media目录
-                destination_path = os.path.join(media_path, result_filename)
-                shutil.copy2(result_image_path, destination_path)
-                
-                print(f"成功将结果图像复制到: {destination_path}")
-                
-                # 更新分割结果记录
-                from django.core.files.base import ContentFile
-                from django.core.files.storage import default_storage
-                
-                with open(result_image_path, 'rb') as f:
-                    content = f.read()
-                    rel_path = os.path.join('segmentation_results', time.strftime('%Y/%m/%d'), result_filename)
-                    segmentation_result.segmentation_image.save(rel_path, ContentFile(content), save=True)
-                
-                # 清理临时文件
-                os.unlink(temp_file_path)
-                shutil.rmtree(os.path.dirname(result_image_path))
-                
+            if success:
                 # 检查是否是AJAX请求
                 is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
                 
@@ -328,6 +285,7 @@ def api_upload_xray(request):
                         'message': '图像上传和分割成功',
                         'filename': xray_image.name,
                         'segmentation_id': segmentation_result.id,
+                        'timings': timings,
                         'redirect_url': reverse('segmentation:segmentation_result', args=[segmentation_result.id])
                     })
                 else:
@@ -340,7 +298,8 @@ def api_upload_xray(request):
                         'success': False,
                         'message': message,
                         'filename': xray_image.name,
-                        'segmentation_id': segmentation_result.id
+                        'segmentation_id': segmentation_result.id,
+                        'timings': timings
                     })
                 else:
                     from django.contrib import messages